@@ -1,26 +1,37 @@
 """This module contains the functions that handle the business logic of the API endpoints."""
 
-from models.models import SchoolListRequest, UserLoginBody, RegionListRequest
+import asyncio
+import os
+import shutil
+import uuid
+
+from pydantic import ValidationError
+
+from models.models import (SchoolListRequest, UserLoginBody, RegionListRequest, HierarchyRequest, RateUpdate,
+                           SchoolRequest, StudentRequest, ResultRequest)
+from db import hierarchy
+from db.async_db import AsyncPgConn
 from db.db import PgConn
 from utils.jwt_funcs import create_access_token
-from fastapi.responses import RedirectResponse, JSONResponse
-from config.config import ACCESS_TOKEN_EXPIRE_MINUTES, PROD
+from utils.export import MEDIA_TYPES, csv_stream, xlsx_stream
+from fastapi.responses import JSONResponse, StreamingResponse
+from config.config import ACCESS_TOKEN_EXPIRE_MINUTES, IMPORT_UPLOAD_DIR
 
-async def school_list(scholl_list_data: SchoolListRequest):
+IMPORT_KINDS = ("exams", "teachers")
+
+async def school_list(scholl_list_data: SchoolListRequest, db: AsyncPgConn):
     """ Function to get the list of schools """
     if scholl_list_data:
-        db = PgConn()
-        results = db.get_schools_by_req(scholl_list_data)
+        results = await db.get_schools_by_req(scholl_list_data)
         return results, 200
     return "Bad request", 400
 
-async def login_user(login: UserLoginBody):
-    db_conn = PgConn()
-    user = db_conn.get_admin(login)
+async def login_user(login: UserLoginBody, db: AsyncPgConn):
+    user = await db.get_admin(login)
 
     if user:        
         # Create JWT token
-        token_data = {"sub": user.username, "user_id": user.user_id}  # Payload
+        token_data = {"sub": user.username, "user_id": user.user_id, "role": user.role}  # Payload
         token = create_access_token(token_data)
         
         # Set token in response header or HTTP-only cookie
@@ -36,10 +47,77 @@ async def login_user(login: UserLoginBody):
         return JSONResponse(content={"error": "Invalid credentials"}, status_code=401)
          
 
-async def region_list(territory_data: RegionListRequest):
+async def region_list(territory_data: RegionListRequest, db: AsyncPgConn):
     """ Function to get the list of schools """
     if territory_data and territory_data.territory.strip() != "":
-        db = PgConn()
-        results = db.get_regions_by_territory(territory_data)
+        results = await db.get_regions_by_territory(territory_data)
         return results, 200
-    return "Bad request", 400
\ No newline at end of file
+    return "Bad request", 400
+
+async def school_hierarchy(hierarchy_data: HierarchyRequest, db: AsyncPgConn):
+    """ Function to get the territory -> region -> school tree of one or several quarters """
+    trees = await db.get_school_hierarchies(hierarchy_data.exam_year, list(dict.fromkeys(hierarchy_data.exam_quarters)))
+    results = {quarter: hierarchy.subtree(tree, hierarchy_data.territory, hierarchy_data.region)
+               for quarter, tree in trees.items()}
+    return results, 200
+
+def _save_upload(upload):
+    os.makedirs(IMPORT_UPLOAD_DIR, exist_ok=True)
+    path = os.path.join(IMPORT_UPLOAD_DIR, f"{uuid.uuid4().hex}_{os.path.basename(upload.filename or 'upload.xlsx')}")
+    with open(path, "wb") as file:
+        shutil.copyfileobj(upload.file, file)
+    return path
+
+async def submit_import(upload, kind, exam_year, exam_quarter, db: AsyncPgConn):
+    """ Function to store an uploaded spreadsheet and queue its import for the worker """
+    if kind not in IMPORT_KINDS or not exam_year or (kind == "exams" and not exam_quarter):
+        return "Bad request", 400
+
+    path = await asyncio.to_thread(_save_upload, upload)
+    job_id = await db.create_import_job(kind, path, exam_year, exam_quarter if kind == "exams" else None)
+    return {"id": job_id, "status": "queued"}, 202
+
+async def import_job(job_id, db: AsyncPgConn):
+    """ Function to get the progress of an import job, with an ETA from its parse rate so far """
+    job = await db.get_import_job(job_id)
+    if job is None:
+        return "Not found", 404
+
+    job["eta_seconds"] = None
+    if job["status"] == "running" and job["rows_total"] and job["rows_parsed"] and job["elapsed_seconds"]:
+        remaining = max(job["rows_total"] - job["rows_parsed"], 0)
+        job["eta_seconds"] = round(job["elapsed_seconds"] * remaining / job["rows_parsed"], 1)
+    return job, 200
+
+async def rates(exam_year, exam_quarter, db: AsyncPgConn):
+    """ Function to get the rates of one period with their previous versions """
+    return await db.get_rates(exam_year, exam_quarter), 200
+
+async def update_rate(rate: RateUpdate, changed_by):
+    """ Function to correct one rate and recompute only the data that depends on it """
+    if not rate.changes():
+        return "Bad request", 400
+
+    # One write transaction plus the cache invalidation of the sync layer, kept off the event loop
+    touched = await asyncio.to_thread(PgConn().update_rate, rate, changed_by)
+    if touched is None:
+        return "Not found", 404
+    return touched, 200
+
+EXPORT_REQUESTS = {"schools": SchoolRequest, "students": StudentRequest, "results": ResultRequest}
+
+async def export_report(kind, file_format, query_params, db: AsyncPgConn):
+    """ Function to stream every row of a report (same filters as its page, no pagination) as CSV or XLSX """
+    if kind not in EXPORT_REQUESTS or file_format not in MEDIA_TYPES:
+        return "Bad request", 400
+    try:
+        request = EXPORT_REQUESTS[kind](**query_params)
+    except ValidationError:
+        return "Invalid data received", 422
+
+    batches = db.export_rows(kind, request)
+    content = csv_stream(batches) if file_format == "csv" else xlsx_stream(batches, kind)
+    filename = f"{kind}_{request.exam_year.replace('/', '-')}_{request.exam_quarter}.{file_format}"
+    response = StreamingResponse(content, media_type=MEDIA_TYPES[file_format],
+                                 headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+    return response, 200
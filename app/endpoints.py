@@ -1,18 +1,27 @@
 """ This module contains the FastAPI endpoints for the bot creation and deletion. """
 
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+import asyncio
+import json
+from typing import Optional
 
-from .controllers import school_list, login_user, region_list
-from models.models import SchoolListRequest, UserLoginBody, RegionListRequest
+from fastapi import APIRouter, HTTPException, Depends, File, Form, Query, Request, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from .controllers import school_list, login_user, region_list, school_hierarchy, submit_import, import_job, rates, update_rate, export_report
+from models.models import SchoolListRequest, UserLoginBody, RegionListRequest, HierarchyRequest, RateUpdate
+from config.config import IMPORT_PROGRESS_INTERVAL
+from db.async_db import AsyncPgConn, get_async_db, get_concurrent_db
+from db.result_cache import result_cache
+from db.instrumentation import query_stats
+from utils.jwt_funcs import admin_checker, jwt_checker
 
 # Create a router instance
 router = APIRouter()
 
 @router.post("/school/list", name="school_list")
-async def get_school_list(school_list_data: SchoolListRequest):
+async def get_school_list(school_list_data: SchoolListRequest, db: AsyncPgConn = Depends(get_async_db)):
     try:
-        success = await school_list(school_list_data)
+        success = await school_list(school_list_data, db)
 
         # Use JSONResponse to return a proper JSON object
         return JSONResponse(content=success[0], status_code=success[1])
@@ -22,9 +31,20 @@ async def get_school_list(school_list_data: SchoolListRequest):
 
 
 @router.post("/region/list", name="region_list")
-async def get_region_list(territory_data: RegionListRequest):
+async def get_region_list(territory_data: RegionListRequest, db: AsyncPgConn = Depends(get_async_db)):
+    try:
+        success = await region_list(territory_data, db)
+
+        # Use JSONResponse to return a proper JSON object
+        return JSONResponse(content=success[0], status_code=success[1])
+
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error: {str(e)}")
+
+@router.post("/hierarchy", name="school_hierarchy")
+async def get_school_hierarchy(hierarchy_data: HierarchyRequest, db: AsyncPgConn = Depends(get_async_db)):
     try:
-        success = await region_list(territory_data)
+        success = await school_hierarchy(hierarchy_data, db)
 
         # Use JSONResponse to return a proper JSON object
         return JSONResponse(content=success[0], status_code=success[1])
@@ -33,12 +53,80 @@ async def get_region_list(territory_data: RegionListRequest):
         raise HTTPException(status_code=400, detail=f"Error: {str(e)}")
 
 @router.post("/login", name="login")
-async def login(login : UserLoginBody):
+async def login(login : UserLoginBody, db: AsyncPgConn = Depends(get_async_db)):
     try:
-        success = await login_user(login)
+        success = await login_user(login, db)
 
         # Use JSONResponse to return a proper JSON object
         return success
 
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=400, detail=f"Error: {str(e)}")
+
+@router.get("/cache/stats", name="cache_stats")
+async def get_cache_stats(payload: dict = Depends(admin_checker)):
+    return JSONResponse(content=result_cache.stats(), status_code=200)
+
+@router.get("/queries/stats", name="query_stats")
+async def get_query_stats(payload: dict = Depends(admin_checker)):
+    return JSONResponse(content=query_stats.snapshot(), status_code=200)
+
+@router.post("/admin/import", name="submit_import")
+async def post_import(upload: UploadFile = File(...), kind: str = Form("exams"),
+                      exam_year: str = Form(..., alias="examYear"), exam_quarter: Optional[str] = Form(None, alias="examQuarter"),
+                      payload: dict = Depends(admin_checker), db: AsyncPgConn = Depends(get_async_db)):
+    try:
+        success = await submit_import(upload, kind, exam_year, exam_quarter, db)
+
+        # Use JSONResponse to return a proper JSON object
+        return JSONResponse(content=success[0], status_code=success[1])
+
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error: {str(e)}")
+
+@router.get("/admin/import/{job_id}", name="import_job")
+async def get_import_job(job_id: int, payload: dict = Depends(admin_checker), db: AsyncPgConn = Depends(get_async_db)):
+    success = await import_job(job_id, db)
+    return JSONResponse(content=success[0], status_code=success[1])
+
+@router.get("/admin/import/{job_id}/events", name="import_job_events")
+async def get_import_job_events(job_id: int, payload: dict = Depends(admin_checker), db: AsyncPgConn = Depends(get_concurrent_db)):
+    """Server-sent events with the job progress until it is done or failed"""
+    async def events():
+        while True:
+            # Unbound db: no connection is held between two polls
+            job, status_code = await import_job(job_id, db)
+            yield f"data: {json.dumps(job)}\n\n"
+            if status_code != 200 or job["status"] in ("done", "failed"):
+                return
+            await asyncio.sleep(IMPORT_PROGRESS_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@router.get("/admin/rates", name="rates")
+async def get_rates(exam_year: str = Query(..., alias="examYear"), exam_quarter: str = Query(..., alias="examQuarter"),
+                    payload: dict = Depends(admin_checker), db: AsyncPgConn = Depends(get_async_db)):
+    success = await rates(exam_year, exam_quarter, db)
+    return JSONResponse(content=success[0], status_code=success[1])
+
+@router.put("/admin/rates", name="update_rate")
+async def put_rate(rate: RateUpdate, payload: dict = Depends(admin_checker)):
+    try:
+        success = await update_rate(rate, payload.get("sub"))
+
+        # Use JSONResponse to return a proper JSON object
+        return JSONResponse(content=success[0], status_code=success[1])
+
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error: {str(e)}")
+
+@router.get("/export/{kind}", name="export_report")
+async def get_export(kind: str, request: Request, format: str = Query("csv"),
+                     payload: dict = Depends(jwt_checker), db: AsyncPgConn = Depends(get_concurrent_db)):
+    """The filters of the schools / students / results pages as query parameters, e.g.
+    /export/students?examYear=...&examQuarter=...&territory=...&format=xlsx"""
+    # Unbound db: the export borrows its connection while the response is streamed, not for the handler
+    success = await export_report(kind, format, dict(request.query_params), db)
+    if success[1] != 200:
+        return JSONResponse(content=success[0], status_code=success[1])
+    return success[0]
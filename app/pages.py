@@ -7,19 +7,20 @@ from fastapi import HTTPException, Request, Form, Depends, status
 from fastapi.responses import HTMLResponse, RedirectResponse
 from collections import defaultdict
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from jose import JWTError, jwt
 import json
 
 from pydantic import ValidationError
+import asyncio
 
-from db.db import PgConn
+from db.async_db import AsyncPgConn, get_async_db, get_concurrent_db, close_async_pool
+from db.pool import close_pool
 from models.models import StudentRequest, ResultRequest, BaseRequest, CompareRequest, SchoolRequest
 from . import app
 from utils.const import table_headers, all_subjects, all_exam_methods
 from utils.tables_title import generate_school_table_title, generate_student_table_title
 from utils.cleaning_results import clean_subjects, clean_results_data, clean_compare_data
-from utils.jwt_funcs import create_access_token
-from config.config import PROD, SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from utils.jwt_funcs import create_access_token, jwt_checker
+from config.config import PROD, ACCESS_TOKEN_EXPIRE_MINUTES
 
 # Initialize Jinja2 templates directory
 templates = Jinja2Templates(directory="templates")
@@ -31,23 +32,21 @@ def https_url_for(request: Request, name: str, **path_params: Any) -> str:
 
 security = HTTPBearer()
 
-def jwt_checker(request: Request):
-    # Extract the token from cookies
-    token = request.cookies.get("access_token")
-    if not token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    try:
-        # Decode the token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload  # Return the payload for use in protected routes
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
-
 templates.env.globals["https_url_for"] = https_url_for
 
+def export_params(request_model) -> dict:
+    """Filters of a report page as query parameters of its /export link (every row, so no page)"""
+    return request_model.model_dump(by_alias=True, exclude_none=True, exclude={"page", "cursor"})
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
+@app.on_event("shutdown")
+async def shutdown_db_pool():
+    await close_async_pool()
+    close_pool()
+
+
 @app.get("/")
 async def redirect_to_home():
     return RedirectResponse(url="/home", status_code=303)
@@ -57,16 +56,15 @@ async def read_root(request: Request):
     return templates.TemplateResponse("login.html", {"request": request, "title" : "Kirish", "is_prod": PROD})
 
 @app.get("/home", response_class=HTMLResponse, name="home")
-async def read_root(request: Request, payload: dict = Depends(jwt_checker)):
-    db = PgConn()
+async def read_root(request: Request, payload: dict = Depends(jwt_checker), db: AsyncPgConn = Depends(get_async_db)):
     # periods = db.get_available_periods()
 
-    year_and_quarter = db.get_last_year_and_quarter()
+    year_and_quarter = await db.get_last_year_and_quarter()
 
     year, quarter = year_and_quarter['exam_year'], year_and_quarter['exam_quarter']
     base_request = BaseRequest(examQuarter=quarter, examYear=year)
 
-    data = db.get_base_results(base_request)
+    data = await db.get_base_results(base_request)
 
     teachers_info_by_territory = data['teachers_info_by_territory']
     if teachers_info_by_territory and len(teachers_info_by_territory) > 0:
@@ -93,12 +91,10 @@ async def read_root(request: Request, payload: dict = Depends(jwt_checker)):
                                                     })
 
 @app.get("/schools", response_class=HTMLResponse, name="schools")
-async def read_root(request: Request, payload: dict = Depends(jwt_checker)):
-    db = PgConn()
-
-    periods = db.get_available_periods()
+async def read_root(request: Request, payload: dict = Depends(jwt_checker), db: AsyncPgConn = Depends(get_concurrent_db)):
 
-    available_info = db.get_available_territories_classes()
+    periods, available_info = await asyncio.gather(db.get_available_periods(),
+                                                   db.get_available_territories_classes())
     all_classes = available_info['all_classes']
     all_territories = available_info['all_territories']
 
@@ -116,11 +112,10 @@ async def read_root(request: Request, payload: dict = Depends(jwt_checker)):
         "is_prod": PROD})
 
 @app.get("/students", response_class=HTMLResponse, name="students")
-async def read_root(request: Request, payload: dict = Depends(jwt_checker)):
-    db = PgConn()
+async def read_root(request: Request, payload: dict = Depends(jwt_checker), db: AsyncPgConn = Depends(get_concurrent_db)):
 
-    periods = db.get_available_periods()
-    available_info = db.get_available_territories_classes()
+    periods, available_info = await asyncio.gather(db.get_available_periods(),
+                                                   db.get_available_territories_classes())
 
     all_classes = map(str, available_info['all_classes'])
     all_territories = available_info['all_territories']
@@ -140,15 +135,13 @@ async def read_root(request: Request, payload: dict = Depends(jwt_checker)):
         })
 
 @app.get("/compare", response_class=HTMLResponse, name="compare")
-async def read_root(request: Request, payload: dict = Depends(jwt_checker)):
-    db = PgConn()
+async def read_root(request: Request, payload: dict = Depends(jwt_checker), db: AsyncPgConn = Depends(get_concurrent_db)):
 
-    periods = db.get_available_paired_periods()
+    periods, available_info = await asyncio.gather(db.get_available_paired_periods(),
+                                                   db.get_available_territories_classes())
     if periods is None:
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
-    available_info = db.get_available_territories_classes()
-
     # convert all_classes elements to string
     all_classes = map(str, available_info['all_classes'])
     all_territories = available_info['all_territories']
@@ -168,11 +161,10 @@ async def read_root(request: Request, payload: dict = Depends(jwt_checker)):
                                        })
 
 @app.get("/results", response_class=HTMLResponse, name="results")
-async def read_root(request: Request, payload: dict = Depends(jwt_checker)):
-    db = PgConn()
+async def read_root(request: Request, payload: dict = Depends(jwt_checker), db: AsyncPgConn = Depends(get_concurrent_db)):
 
-    periods = db.get_available_periods()
-    available_info = db.get_available_territories_classes()
+    periods, available_info = await asyncio.gather(db.get_available_periods(),
+                                                   db.get_available_territories_classes())
 
     # convert all_classes elements to string
     all_classes = map(str, available_info['all_classes'])
@@ -194,24 +186,22 @@ async def read_root(request: Request, payload: dict = Depends(jwt_checker)):
                                        })
 
 @app.post("/schools", response_class=HTMLResponse)
-async def read_school(request: Request, payload: dict = Depends(jwt_checker)):
-
-    db = PgConn()
+async def read_school(request: Request, payload: dict = Depends(jwt_checker), db: AsyncPgConn = Depends(get_concurrent_db)):
     form_data = await request.form()
     try:
         school_results = SchoolRequest(**form_data)
     except ValidationError as e:
         return HTMLResponse(content="Invalid data received", status_code=422)
     
-    school_results_data = db.get_school_results(school_results)
+    # Independent queries, each on its own pooled connection
+    school_results_data, periods, available_info = await asyncio.gather(db.get_school_results(school_results),
+                                                                        db.get_available_periods(),
+                                                                        db.get_available_territories_classes())
     total_pages = school_results_data['pages']
     
     school_info = clean_subjects(school_results_data['school_results'])
     table_title = generate_school_table_title(school_results)
 
-    periods = db.get_available_periods()
-    available_info = db.get_available_territories_classes()
-
     # convert all_classes elements to string
     all_classes = map(str, available_info['all_classes'])
     all_territories = available_info['all_territories']
@@ -239,25 +229,28 @@ async def read_school(request: Request, payload: dict = Depends(jwt_checker)):
                                           "subject": school_results.subject,
                                           "page": school_results.page,
                                           "totalPages": total_pages,
+                                          "nextCursor": school_results_data['next_cursor'],
+                                          "export_params": export_params(school_results),
                                           "is_prod": PROD}
                                           )
 
 @app.post("/students", response_class=HTMLResponse)
-async def read_students(request: Request, payload: dict = Depends(jwt_checker)):
-
-    db = PgConn()
+async def read_students(request: Request, payload: dict = Depends(jwt_checker), db: AsyncPgConn = Depends(get_concurrent_db)):
     form_data = await request.form()
     try:
         student_results = StudentRequest(**form_data)
     except ValidationError as e:
         return HTMLResponse(content="Invalid data received", status_code=422)
     
-    student_info = db.get_students_results(student_results)
+    # Independent queries, each on its own pooled connection
+    student_info, periods, available_info = await asyncio.gather(db.get_students_results(student_results),
+                                                                 db.get_available_periods(),
+                                                                 db.get_available_territories_classes())
     table_title = generate_student_table_title(student_results)
 
     total_pages = student_info['total_pages']
+    next_cursor = student_info['next_cursor']
     student_info = clean_subjects(student_info['results'])
-    available_info = db.get_available_territories_classes()
 
     # convert all_classes elements to string
     all_classes = map(str, available_info['all_classes'])
@@ -266,7 +259,6 @@ async def read_students(request: Request, payload: dict = Depends(jwt_checker)):
     all_classes_dict = {"": "Barcha sinflar", **{k:k for k in all_classes}}
     all_territories_dict = {"": "Barcha hududlar", **{k:k for k in all_territories}}
 
-    periods = db.get_available_periods()
     return templates.TemplateResponse("student.html", 
                                       {
                                         "request": request, 
@@ -289,20 +281,21 @@ async def read_students(request: Request, payload: dict = Depends(jwt_checker)):
                                         "subject": student_results.subject,
                                         "page": student_results.page,
                                         "totalPages": total_pages,
+                                        "nextCursor": next_cursor,
+                                        "export_params": export_params(student_results),
                                         "is_prod": PROD}
                                         )
 
 @app.post("/compare", response_class=HTMLResponse)
-async def read_results(request: Request, payload: dict = Depends(jwt_checker)):
-
-    db = PgConn()
+async def read_results(request: Request, payload: dict = Depends(jwt_checker), db: AsyncPgConn = Depends(get_concurrent_db)):
     form_data = await request.form()
     try:
         compare_request = CompareRequest(**form_data)
     except ValidationError as e:
         return HTMLResponse(content="Invalid data received", status_code=422)
 
-    periods = db.get_available_paired_periods()
+    periods, available_info = await asyncio.gather(db.get_available_paired_periods(),
+                                                   db.get_available_territories_classes())
 
     examYear = compare_request.exam_year
     if compare_request.first_quarter == 'all':
@@ -312,17 +305,14 @@ async def read_results(request: Request, payload: dict = Depends(jwt_checker)):
 
     # Initialize data_by_quarters as a nested defaultdict
     data_by_quarters = defaultdict(lambda: defaultdict(list))
+
+    # One grouped query for all quarters, keyed by quarter
+    compare_results = await db.get_compare_results(compare_request, quarters)
    
     for quarter in quarters:
-        result_request = ResultRequest(examQuarter=quarter, examYear=examYear, 
-                                       territory=compare_request.territory, 
-                                       studyClass=compare_request.study_class, 
-                                       school=compare_request.school, 
-                                       subject=compare_request.subject, 
-                                       region=compare_request.region, 
-                                       examMethod=compare_request.exam_method)
-        
-        data = db.get_compare_results(result_request)
+        data = compare_results.get(quarter)
+        if data is None:
+            continue
         data['some_subject_result'], data['subject_results'], data['subject_results_keys'] = clean_compare_data(data)
         for key in data:
             if data[key] and len(data[key]) > 0:
@@ -330,8 +320,6 @@ async def read_results(request: Request, payload: dict = Depends(jwt_checker)):
 
     data_by_quarters['exam_method_results'] = {str(key): value for key, value in data_by_quarters['exam_method_results'].items()}
 
-    available_info = db.get_available_territories_classes()
-
     # convert all_classes elements to string
     all_classes = map(str, available_info['all_classes'])
     all_territories = available_info['all_territories']
@@ -370,9 +358,7 @@ async def read_results(request: Request, payload: dict = Depends(jwt_checker)):
                                        )
 
 @app.post("/results", response_class=HTMLResponse)
-async def read_results(request: Request, payload: dict = Depends(jwt_checker)):
-
-    db = PgConn()
+async def read_results(request: Request, payload: dict = Depends(jwt_checker), db: AsyncPgConn = Depends(get_concurrent_db)):
 
     form_data = await request.form()
     try:
@@ -380,13 +366,14 @@ async def read_results(request: Request, payload: dict = Depends(jwt_checker)):
     except ValidationError as e:
         return HTMLResponse(content="Invalid data received", status_code=422)
     
-    results_info = db.get_results(results)
-    periods = db.get_available_periods()
+    # Independent queries, each on its own pooled connection
+    results_info, periods, available_info = await asyncio.gather(db.get_results(results),
+                                                                 db.get_available_periods(),
+                                                                 db.get_available_territories_classes())
 
     total_pages = results_info['total_pages']
 
     students_results, some_subject_result, subject_results, subject_results_keys = clean_results_data(results_info)
-    available_info = db.get_available_territories_classes()
 
     # convert all_classes elements to string
     all_classes = map(str, available_info['all_classes'])
@@ -408,6 +395,7 @@ async def read_results(request: Request, payload: dict = Depends(jwt_checker)):
                                        "periods": periods, 
                                        "subject_results_keys": subject_results_keys,
                                        "totalPages": total_pages,
+                                       "nextCursor": results_info['next_cursor'],
                                        "page": results.page,
 
                                        "all_classes": all_classes_dict, 
@@ -424,6 +412,7 @@ async def read_results(request: Request, payload: dict = Depends(jwt_checker)):
                                        "region": results.region,
                                        "examMethod": results.exam_method,
                                        "subject_not_chosen": results.subject is None or results.subject == "",
+                                       "export_params": export_params(results),
                                        "is_prod": PROD}
                                        )
 
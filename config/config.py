@@ -13,6 +13,43 @@ POSTGRES_DB = os.getenv("POSTGRES_DB")
 POSTGRES_HOST = os.getenv("POSTGRES_HOST")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT")
 
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL", "30"))
+
+PAGE_COUNT_TTL = float(os.getenv("PAGE_COUNT_TTL", "300"))
+PAGE_COUNT_CACHE_SIZE = int(os.getenv("PAGE_COUNT_CACHE_SIZE", "1024"))
+
+METADATA_CHECK_INTERVAL = float(os.getenv("METADATA_CHECK_INTERVAL", "30"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "512"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+# Capture EXPLAIN (ANALYZE, BUFFERS) of queries slower than this, unset to disable
+QUERY_EXPLAIN_THRESHOLD_MS = float(os.getenv("QUERY_EXPLAIN_THRESHOLD_MS")) if os.getenv("QUERY_EXPLAIN_THRESHOLD_MS") else None
+QUERY_EXPLAIN_INTERVAL = float(os.getenv("QUERY_EXPLAIN_INTERVAL", "300"))
+
+# Rows per COPY batch of the Excel importer
+COPY_CHUNK_ROWS = int(os.getenv("COPY_CHUNK_ROWS", "50000"))
+# Students read, transformed and loaded at a time by the Excel importer
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", "20000"))
+# Processes computing um_school_results of an import, 1 computes it in the importing process
+SCHOOL_RESULTS_WORKERS = int(os.getenv("SCHOOL_RESULTS_WORKERS", "1"))
+
+# Background imports (POST /admin/import, import_worker.py): where uploads are kept and how often an idle
+# worker looks for jobs
+IMPORT_UPLOAD_DIR = os.getenv("IMPORT_UPLOAD_DIR", "imports")
+IMPORT_POLL_INTERVAL = float(os.getenv("IMPORT_POLL_INTERVAL", "5"))
+IMPORT_PROGRESS_INTERVAL = float(os.getenv("IMPORT_PROGRESS_INTERVAL", "1"))
+# How long publishing an imported period waits for the readers of its partitions before it backs
+# off and retries, so a long report never queues every other reader behind the swap
+PUBLISH_LOCK_TIMEOUT_MS = int(os.getenv("PUBLISH_LOCK_TIMEOUT_MS", "2000"))
+PUBLISH_RETRIES = int(os.getenv("PUBLISH_RETRIES", "10"))
+
+# Rows fetched at a time from the server-side cursor of a report export (/export/...)
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "2000"))
+
 PROD = os.getenv("PROD") == "True"
 
 ADMIN_CREDENTIALS = [os.getenv("ADMIN_USERNAME"), os.getenv("ADMIN_PASSWORD")]
@@ -0,0 +1,246 @@
+""" This module is the asyncio counterpart of db.db, used by the FastAPI handlers"""
+
+import asyncio
+import logging
+import time
+
+from psycopg import AsyncClientCursor
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row, tuple_row
+from psycopg_pool import AsyncConnectionPool
+
+from config.config import (POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT,
+                           DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, EXPORT_BATCH_ROWS)
+from db import hierarchy, instrumentation, pagination, queries, result_cache
+from db.db import user_from_row
+from db.metadata import metadata_cache
+from models.models import SchoolRequest, StudentRequest, ResultRequest, BaseRequest, UserLoginBody, User, RegionListRequest, SchoolListRequest, CompareRequest
+
+logger = logging.getLogger(__name__)
+
+_async_pool = None
+_async_pool_lock = asyncio.Lock()
+
+
+async def get_async_pool():
+    """Return the process-wide async pool, opening it on first use"""
+    global _async_pool
+    if _async_pool is None:
+        async with _async_pool_lock:
+            if _async_pool is None:
+                pool = AsyncConnectionPool(
+                    make_conninfo(dbname=POSTGRES_DB, user=POSTGRES_USER, password=POSTGRES_PASSWORD,
+                                  host=POSTGRES_HOST, port=POSTGRES_PORT),
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    check=AsyncConnectionPool.check_connection,
+                    # Client-side binding keeps the psycopg2 semantics of the shared queries (e.g. `%s IS NULL`)
+                    kwargs={"cursor_factory": AsyncClientCursor, "row_factory": dict_row},
+                    open=False,
+                )
+                await pool.open()
+                _async_pool = pool
+                logger.info("Opened async database pool (min=%s, max=%s)", DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE)
+    return _async_pool
+
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
+
+
+@instrumentation.instrument_methods
+class AsyncPgConn:
+    """Async version of PgConn exposing the same query methods.
+
+    Bound to a connection (see `get_async_db`) every call runs on it, otherwise each call
+    borrows its own connection from the async pool, so independent calls may run concurrently.
+    """
+    def __init__(self, conn=None):
+        self.conn = conn
+
+    async def get_admin(self, user: UserLoginBody) -> User:
+        row = await self._fetchone(*queries.admin_query(user))
+        # bcrypt is deliberately slow, keep it off the event loop
+        return await asyncio.to_thread(user_from_row, row, user)
+
+    async def get_schools_by_req(self, data: SchoolListRequest):
+        trees = await self.get_school_hierarchies(data.exam_year, data.quarters)
+        return hierarchy.merge_lists([hierarchy.school_names(tree, data.territory, data.region)
+                                      for tree in trees.values()], data.mode)
+    
+    async def get_regions_by_territory(self, region_list: RegionListRequest):
+        trees = await self.get_school_hierarchies(region_list.exam_year, region_list.quarters)
+        return hierarchy.merge_lists([hierarchy.regions_of(tree, region_list.territory)
+                                      for tree in trees.values()], region_list.mode)
+
+    async def get_school_hierarchy(self, exam_year, exam_quarter):
+        """Territory -> region -> schools of one period, held in memory between imports (treat as read-only)"""
+        trees = await self.get_school_hierarchies(exam_year, [exam_quarter])
+        return trees[exam_quarter]
+
+    async def get_school_hierarchies(self, exam_year, exam_quarters=None):
+        """Hierarchies of several quarters (every quarter of the year if None), the ones not in memory are loaded in one query.
+        A quarter that was never imported gets an empty tree, nothing is written or cached for it"""
+        available = (await self.get_available_periods() or {}).get(exam_year, [])
+        if exam_quarters is None:
+            exam_quarters = available
+
+        versions = await self._data_versions()
+        trees = {quarter: metadata_cache.get(('school_hierarchy', exam_year, quarter), copied=False)
+                 for quarter in exam_quarters}
+        missing = [quarter for quarter, tree in trees.items() if tree is None]
+        if missing:
+            payloads = (await self._fetchone(*queries.school_hierarchies_query(exam_year, missing)))['result'] or {}
+            for quarter in missing:
+                if quarter not in payloads and quarter in available:
+                    # Period imported before the hierarchy existed, build it now
+                    row = await self._fetchone(*queries.refresh_school_hierarchy_query(exam_year, quarter))
+                    payloads[quarter] = row['result']
+                trees[quarter] = hierarchy.index_hierarchy(payloads.get(quarter))
+                if quarter in payloads:
+                    metadata_cache.set(('school_hierarchy', exam_year, quarter), trees[quarter], versions, copied=False)
+        return trees
+
+    async def get_available_periods(self):
+        results = await self._cached_fetchone('available_periods_query', *queries.available_periods_query())
+        return results['result']
+
+    async def get_available_paired_periods(self):
+        results = await self._cached_fetchone('available_paired_periods_query', *queries.available_paired_periods_query())
+        return results['result']
+
+    async def get_last_year_and_quarter(self):
+        return await self._cached_fetchone('last_year_and_quarter_query', *queries.last_year_and_quarter_query())
+
+    async def get_base_results(self, base_request: BaseRequest):
+        results = await self._fetchone(*queries.dashboard_summary_query(base_request))
+        if results is None:
+            # Period imported before the summary existed, materialize it now
+            results = await self._fetchone(*queries.refresh_dashboard_summary_query(base_request))
+        return results['result']
+
+    async def get_school_results(self, school_request: SchoolRequest):
+        return await self._fetch_page('schools', school_request, queries.school_results_query, pagination.RANKING_KEY, 'result', 'pages')
+
+    async def get_students_results(self, students_request: StudentRequest):
+        return await self._fetch_page('students', students_request, queries.students_results_query, pagination.RANKING_KEY, 'result', 'total_pages')
+
+    async def get_results(self, params: ResultRequest):
+        return await self._fetch_page('results', params, queries.results_query, pagination.RESULTS_KEY, 'results', 'total_pages')
+
+    async def get_compare_results(self, params: CompareRequest, exam_quarters):
+        result = await self._fetchone(*queries.compare_results_query(params, exam_quarters))
+        return result['results']
+
+    async def get_available_territories_classes(self):
+        result = await self._cached_fetchone('available_territories_classes_query', *queries.available_territories_classes_query())
+        return result['result']
+
+    async def create_import_job(self, kind, filename, exam_year, exam_quarter=None):
+        row = await self._fetchone(*queries.create_import_job_query(kind, filename, exam_year, exam_quarter))
+        return row['id']
+
+    async def get_import_job(self, job_id):
+        row = await self._fetchone(*queries.import_job_query(job_id))
+        return row['result'] if row else None
+
+    async def get_rates(self, exam_year, exam_quarter):
+        row = await self._fetchone(*queries.rates_query(exam_year, exam_quarter))
+        return row['result'] or []
+
+    async def export_rows(self, kind, request, batch_size=EXPORT_BATCH_ROWS):
+        """Every row of a report (see queries.EXPORT_QUERIES) as (column names, rows) batches of
+        `batch_size`, fetched from a server-side cursor so the whole result is never held in memory.
+        Unbound, the connection is borrowed for as long as the export is consumed."""
+        query, params = queries.EXPORT_QUERIES[kind](request)
+        if self.conn is not None:
+            async for batch in self._stream_rows(self.conn, query, params, batch_size):
+                yield batch
+            return
+
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            async for batch in self._stream_rows(conn, query, params, batch_size):
+                yield batch
+
+    @staticmethod
+    async def _stream_rows(conn, query, params, batch_size):
+        # DECLARE through the client-side binding cursor, a named (server-binding) psycopg cursor
+        # could not type the `%s IS NULL` filters of the shared queries
+        async with conn.transaction():
+            async with conn.cursor(row_factory=tuple_row) as cursor:
+                await cursor.execute("DECLARE export_rows NO SCROLL CURSOR FOR " + query, params)
+                first = True
+                while True:
+                    await cursor.execute(f"FETCH FORWARD {int(batch_size)} FROM export_rows")
+                    rows = await cursor.fetchall()
+                    # An empty report still yields once, for its header
+                    if rows or first:
+                        yield [column.name for column in cursor.description], rows
+                    first = False
+                    if len(rows) < batch_size:
+                        return
+
+    async def _data_versions(self):
+        # um_data_version stamps, re-read at most every METADATA_CHECK_INTERVAL seconds
+        if metadata_cache.needs_check():
+            row = await self._fetchone(*queries.data_versions_query())
+            metadata_cache.update_versions(row['versions'])
+        return metadata_cache.versions
+
+    async def _fetch_page(self, kind, request, build_query, key_types, result_field, pages_field):
+        # Reports only change with an import, see db.result_cache
+        versions = await self._data_versions()
+        cache_key = result_cache.result_key(kind, request, versions)
+        page = result_cache.get(cache_key)
+        if page is None:
+            query, key, total_pages = pagination.paged_query(kind, request, build_query, key_types, versions)
+            row = await self._fetchone(*query)
+            page = pagination.finish_page(row[result_field], key, total_pages, pages_field)
+            result_cache.put(cache_key, page)
+        return page
+
+    async def _cached_fetchone(self, name, query, params=None):
+        # Metadata only changes with an import, see db.metadata
+        versions = await self._data_versions()
+        row = metadata_cache.get(name)
+        if row is None:
+            row = await self._fetchone(query, params)
+            metadata_cache.set(name, row, versions)
+        return row
+
+    async def _fetchone(self, query, params=None):
+        if self.conn is not None:
+            return await self._execute_fetchone(self.conn, query, params)
+
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            return await self._execute_fetchone(conn, query, params)
+
+    @staticmethod
+    async def _execute_fetchone(conn, query, params):
+        async with conn.cursor() as cursor:
+            started = time.perf_counter()
+            await cursor.execute(query, params)
+            row = await cursor.fetchone()
+            if instrumentation.observe_query(query, row, cursor.rowcount, time.perf_counter() - started):
+                await cursor.execute(instrumentation.explain_query(query), params)
+                instrumentation.attach_explain((await cursor.fetchone())['QUERY PLAN'])
+            return row
+
+
+async def get_async_db():
+    """FastAPI dependency that holds one pooled async connection for the lifetime of the request"""
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        yield AsyncPgConn(conn)
+
+
+async def get_concurrent_db():
+    """FastAPI dependency for pages that run independent queries with asyncio.gather, every call
+    borrows its own pooled connection so page latency tracks the slowest query, not their sum"""
+    return AsyncPgConn()
@@ -1,27 +1,115 @@
 """ This module is used to create a connection to the PostgreSQL database"""
 
 from datetime import datetime
+from functools import wraps
+import io
+import re
+import time
 
-import psycopg2
+from psycopg2 import errors, sql
 from psycopg2.extras import RealDictCursor
 import bcrypt
 
-from config.config import POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT, ADMIN_CREDENTIALS ,SUPERADMIN_CREDENTIALS
-from models.models import SchoolRequest, StudentRequest, ResultRequest, BaseRequest, UserLoginBody, User, RegionListRequest, SchoolListRequest
+from config.config import (ADMIN_CREDENTIALS ,SUPERADMIN_CREDENTIALS, COPY_CHUNK_ROWS, PUBLISH_LOCK_TIMEOUT_MS,
+                           PUBLISH_RETRIES)
+from db import hierarchy, instrumentation, pagination, queries, result_cache
+from db.metadata import metadata_cache
+from db.pool import get_pool
+from models.models import SchoolRequest, StudentRequest, ResultRequest, BaseRequest, UserLoginBody, User, RegionListRequest, SchoolListRequest, CompareRequest, RateUpdate
 from utils.const import ADMIN_ROLE, SUPERADMIN_ROLE, USER_ROLE
 
+# Indexes derived from the report queries: period filter + school join with the class/method filters
+# covered, the per-class/method breakdowns, the um_school location filters and the period scan of
+# um_school_results. Subject ordering reads um_student_scores, so no JSONB expression indexes are needed.
+WORKLOAD_INDEXES = {
+    "idx_um_student_exams_period_school": """
+        CREATE INDEX IF NOT EXISTS idx_um_student_exams_period_school
+        ON um_student_exams (exam_year, exam_quarter, school_id) INCLUDE (studystream, studyclass, exam_method)
+    """,
+    "idx_um_student_exams_period_stream": """
+        CREATE INDEX IF NOT EXISTS idx_um_student_exams_period_stream
+        ON um_student_exams (exam_year, exam_quarter, studystream, exam_method)
+    """,
+    "idx_um_student_exams_school": """
+        CREATE INDEX IF NOT EXISTS idx_um_student_exams_school ON um_student_exams (school_id)
+    """,
+    "idx_um_school_location": """
+        CREATE INDEX IF NOT EXISTS idx_um_school_location ON um_school (territory, region, name)
+    """,
+    "idx_um_school_results_period": """
+        CREATE INDEX IF NOT EXISTS idx_um_school_results_period ON um_school_results (exam_year, exam_quarter)
+    """,
+}
+
+# Partitioned by exam_year, each year sub-partitioned by exam_quarter (see ensure_period_partitions)
+PARTITIONED_TABLES = ("um_student_exams", "um_school_results")
+
+
+def partition_name(table, exam_year, exam_quarter=None):
+    """um_student_exams + 2024/2025 + 1 -> um_student_exams_2024_2025_q1"""
+    name = f"{table}_{re.sub(r'[^0-9A-Za-z]+', '_', exam_year)}"
+    if exam_quarter is not None:
+        name += f"_q{re.sub(r'[^0-9A-Za-z]+', '_', exam_quarter)}"
+    return name
+
+
+def staging_name(table, exam_year, exam_quarter):
+    """Standalone table an import loads one period of `table` into before publish_period swaps it in"""
+    return f"{partition_name(table, exam_year, exam_quarter)}_staging"
+
+
+def user_from_row(row, user: UserLoginBody) -> User:
+    """Map an um_users row to the User model if the login password matches"""
+    if not row:
+        return None  # Return None if no matching user is found
+
+    # Map the row to the User model
+    user_data = {
+        "id": str(row['id']),
+        "username": row['username'],
+        "password": row['password'],
+        "createdAt": row['created_at'],
+        "lastLogin": row['last_login'],
+        "role": row['role'],
+    }
+
+    if bcrypt.checkpw(user.password.encode('utf-8'), user_data['password'].encode('utf-8')):
+        # Create a User instance
+        return User(**user_data)
+    return None
+
+
+def pooled(method):
+    """Run a PgConn method on a pooled connection unless the instance is already bound to one"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.conn is not None:
+            return method(self, *args, **kwargs)
+
+        pool = get_pool()
+        self.conn = pool.getconn()
+        self.cur = self.conn.cursor()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.cur.close()
+            pool.putconn(self.conn)
+            self.conn, self.cur = None, None
+    return wrapper
+
 
+@instrumentation.instrument_methods
 class PgConn:
-    """This class is used to create a connection to the PostgreSQL database"""
-    def __init__(self):
-        self.conn = None
-        try:
-            self.conn = psycopg2.connect(database=POSTGRES_DB, user=POSTGRES_USER, password=POSTGRES_PASSWORD, host=POSTGRES_HOST, port=POSTGRES_PORT)
-            self.cur = self.conn.cursor()
+    """This class is used to run queries against the PostgreSQL database.
 
-        except (psycopg2.DatabaseError, psycopg2.OperationalError) as error:
-            print(error)
+    A PgConn created with a connection (see import_worker.py) uses it for every call, otherwise
+    each method borrows a connection from the process-wide pool and returns it afterwards.
+    """
+    def __init__(self, conn=None):
+        self.conn = conn
+        self.cur = conn.cursor() if conn is not None else None
 
+    @pooled
     def create_tables(self):
         with self.conn:
 
@@ -54,13 +142,14 @@ class PgConn:
             self.cur.execute(
                 """
                     CREATE TABLE IF NOT EXISTS um_school_results(
-                        id SERIAL PRIMARY KEY NOT NULL,
+                        id SERIAL NOT NULL,
                         school_id VARCHAR(255) REFERENCES um_school(id) NOT NULL,
                         average_point JSONB,
                         results JSONB,
-                        exam_year CHARACTER VARYING(255),
-                        exam_quarter CHARACTER VARYING(255)
-                    );
+                        exam_year CHARACTER VARYING(255) NOT NULL,
+                        exam_quarter CHARACTER VARYING(255) NOT NULL,
+                        PRIMARY KEY (id, exam_year, exam_quarter)
+                    ) PARTITION BY LIST (exam_year);
                 """
                 )
             # self.conn.commit()
@@ -93,7 +182,7 @@ class PgConn:
             self.cur.execute(
                 """
                     CREATE TABLE IF NOT EXISTS um_student_exams(
-                        id CHARACTER VARYING(50) PRIMARY KEY NOT NULL NOT NULL,
+                        id CHARACTER VARYING(50) NOT NULL,
                         student_id CHARACTER VARYING(50) NOT NULL,
                         name CHARACTER VARYING(255) NOT NULL,
                         surname CHARACTER VARYING(255) NOT NULL,
@@ -101,13 +190,14 @@ class PgConn:
                         studyLang CHARACTER VARYING(255),
                         studyClass CHARACTER VARYING(255),
                         studyStream CHARACTER VARYING(255),
-                        exam_year CHARACTER VARYING(255),
-                        exam_quarter CHARACTER VARYING(255),
+                        exam_year CHARACTER VARYING(255) NOT NULL,
+                        exam_quarter CHARACTER VARYING(255) NOT NULL,
                         results JSONB,
                         average_point FLOAT,
                         exam_method CHARACTER VARYING(255),
-                        school_id CHARACTER VARYING(255) REFERENCES um_school(id) NOT NULL
-                        );
+                        school_id CHARACTER VARYING(255) REFERENCES um_school(id) NOT NULL,
+                        PRIMARY KEY (id, exam_year, exam_quarter)
+                        ) PARTITION BY LIST (exam_year);
                 """
                 )
             # self.conn.commit()
@@ -130,970 +220,812 @@ class PgConn:
                         )
                 """
             )
+
+            # Every correction of a rate makes a new version, the replaced ones are kept in um_rate_history
+            self.cur.execute("ALTER TABLE um_rate ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1")
+            self.cur.execute("ALTER TABLE um_rate ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+            self.cur.execute(
+                """
+                    CREATE TABLE IF NOT EXISTS um_rate_history(
+                        id SERIAL PRIMARY KEY NOT NULL,
+                        exam_year CHARACTER VARYING(255),
+                        exam_quarter CHARACTER VARYING(255),
+                        subject CHARACTER VARYING(255) NOT NULL,
+                        version INTEGER NOT NULL,
+                        rate JSONB NOT NULL,
+                        replaced_by CHARACTER VARYING(255),
+                        replaced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )
+                """
+            )
+
+            # Content hash of the source row, a re-import only rewrites rows whose hash changed
+            self.cur.execute("ALTER TABLE um_school ADD COLUMN IF NOT EXISTS row_hash BIGINT")
+            self.cur.execute("ALTER TABLE um_student_exams ADD COLUMN IF NOT EXISTS row_hash BIGINT")
+
+            self.cur.execute(
+                """
+                    CREATE TABLE IF NOT EXISTS um_student_scores(
+                        id CHARACTER VARYING(50) NOT NULL,
+                        exam_year CHARACTER VARYING(255) NOT NULL,
+                        exam_quarter CHARACTER VARYING(255) NOT NULL,
+                        average NUMERIC,
+                        math NUMERIC,
+                        mother_tongue_literature NUMERIC,
+                        literature NUMERIC,
+                        mother_tongue NUMERIC,
+                        russian NUMERIC,
+                        chemistry NUMERIC,
+                        biology NUMERIC,
+                        english NUMERIC,
+                        physics NUMERIC,
+                        algebra NUMERIC,
+                        geometry NUMERIC,
+                        PRIMARY KEY (id, exam_year, exam_quarter)
+                        )
+                """
+            )
+            self._rekey_student_scores()
+            # A foreign key into um_student_exams would forbid detaching the partition of a period that
+            # still has scores, so publish_period / detach_period_partitions maintain the rows themselves
+            self.cur.execute(
+                "ALTER TABLE um_student_scores DROP CONSTRAINT IF EXISTS um_student_scores_id_exam_year_exam_quarter_fkey"
+            )
+
+            self.cur.execute(
+                """
+                    CREATE TABLE IF NOT EXISTS um_dashboard_summary(
+                        exam_year CHARACTER VARYING(255) NOT NULL,
+                        exam_quarter CHARACTER VARYING(255) NOT NULL,
+                        payload JSONB NOT NULL,
+                        refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (exam_year, exam_quarter)
+                        )
+                """
+            )
+            self.conn.commit()
+
+            self.cur.execute(
+                """
+                    CREATE TABLE IF NOT EXISTS um_data_version(
+                        exam_year CHARACTER VARYING(255) NOT NULL,
+                        exam_quarter CHARACTER VARYING(255) NOT NULL,
+                        version BIGINT NOT NULL DEFAULT 1,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (exam_year, exam_quarter)
+                        )
+                """
+            )
+            self.conn.commit()
+
+            self.cur.execute(
+                """
+                    CREATE TABLE IF NOT EXISTS um_school_hierarchy(
+                        exam_year CHARACTER VARYING(255) NOT NULL,
+                        exam_quarter CHARACTER VARYING(255) NOT NULL,
+                        payload JSONB NOT NULL,
+                        refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (exam_year, exam_quarter)
+                        )
+                """
+            )
             self.conn.commit()
 
+            self.cur.execute(
+                """
+                    CREATE TABLE IF NOT EXISTS um_import_jobs(
+                        id SERIAL PRIMARY KEY NOT NULL,
+                        kind CHARACTER VARYING(50) NOT NULL,
+                        filename CHARACTER VARYING(1024) NOT NULL,
+                        exam_year CHARACTER VARYING(255) NOT NULL,
+                        exam_quarter CHARACTER VARYING(255),
+                        status CHARACTER VARYING(50) NOT NULL DEFAULT 'queued',
+                        stage CHARACTER VARYING(255),
+                        rows_total INTEGER,
+                        rows_parsed INTEGER NOT NULL DEFAULT 0,
+                        rows_loaded INTEGER NOT NULL DEFAULT 0,
+                        error TEXT,
+                        report JSONB,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        started_at TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        finished_at TIMESTAMP
+                        )
+                """
+            )
+            self.conn.commit()
+
+            # CREATE TABLE IF NOT EXISTS keeps a table created before partitioning as it is
+            self.cur.execute("SELECT pg_advisory_xact_lock(hashtext('um_period_partitions'))")
+            for table in PARTITIONED_TABLES:
+                if not self._is_partitioned(table):
+                    self._partition_legacy_table(table)
+            self.conn.commit()
+
+    def _rekey_student_scores(self):
+        # Keyed on id alone, a period importing ids of an earlier period took over their rows: key the
+        # table on the period too and recompute the scores of every period
+        self.cur.execute(
+            """
+                SELECT conname, ARRAY_LENGTH(conkey, 1)
+                FROM pg_constraint
+                WHERE conrelid = 'um_student_scores'::regclass AND contype = 'p'
+            """
+        )
+        row = self.cur.fetchone()
+        if row is None or row[1] != 1:
+            return
+
+        self.cur.execute("TRUNCATE um_student_scores")
+        self.cur.execute(
+            sql.SQL("ALTER TABLE um_student_scores DROP CONSTRAINT {}, ADD PRIMARY KEY (id, exam_year, exam_quarter)").format(
+                sql.Identifier(row[0]))
+        )
+        self.cur.execute("SELECT DISTINCT exam_year, exam_quarter FROM um_rate")
+        for exam_year, exam_quarter in self.cur.fetchall():
+            self.cur.execute(*queries.refresh_student_scores_query(exam_year, exam_quarter))
+
+    def _partition_legacy_table(self, table):
+        # Rebuild `table` as a partitioned table with the partitions of every period it holds and swap
+        # it in, in the transaction of create_tables. The indexes come with create_indexes.
+        partitioned = f"{table}_partitioned"
+        self.cur.execute(
+            sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY LIST (exam_year)").format(
+                sql.Identifier(partitioned), sql.Identifier(table))
+        )
+        self.cur.execute(
+            sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY (id, exam_year, exam_quarter)").format(
+                sql.Identifier(partitioned), sql.Identifier(f"{table}_pkey_partitioned"))
+        )
+        self._copy_foreign_keys(table, partitioned)
+        # SERIAL columns keep their sequence, it would be dropped with the old table
+        self.cur.execute(
+            """
+                SELECT attname, pg_get_serial_sequence(%s, attname)
+                FROM pg_attribute
+                WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped
+            """, (table, table)
+        )
+        for column, sequence in self.cur.fetchall():
+            if sequence is not None:
+                self.cur.execute(
+                    sql.SQL("ALTER SEQUENCE {} OWNED BY {}.{}").format(
+                        sql.SQL(sequence), sql.Identifier(partitioned), sql.Identifier(column))
+                )
+
+        self.cur.execute(sql.SQL("SELECT DISTINCT exam_year, exam_quarter FROM {}").format(sql.Identifier(table)))
+        for exam_year, exam_quarter in self.cur.fetchall():
+            self._create_period_partitions(table, exam_year, exam_quarter, parent=partitioned)
+        columns = sql.SQL(", ").join(sql.Identifier(column) for column in self._columns(table))
+        self.cur.execute(
+            sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(
+                sql.Identifier(partitioned), columns, columns, sql.Identifier(table))
+        )
+
+        self.cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(table)))
+        self.cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(partitioned), sql.Identifier(table)))
+        self.cur.execute(
+            sql.SQL("ALTER TABLE {} RENAME CONSTRAINT {} TO {}").format(
+                sql.Identifier(table), sql.Identifier(f"{table}_pkey_partitioned"), sql.Identifier(f"{table}_pkey"))
+        )
+
+    @pooled
     def create_indexes(self):
         self.cur.execute(
             """
                 CREATE UNIQUE INDEX IF NOT EXISTS idx_um_school ON um_school (id);
                 CREATE UNIQUE INDEX IF NOT EXISTS idx_um_rate ON um_rate (exam_year, exam_quarter, subject);
                 CREATE UNIQUE INDEX IF NOT EXISTS idx_um_school_results ON um_school_results (school_id, exam_year, exam_quarter);
-                CREATE UNIQUE INDEX IF NOT EXISTS idx_um_student_exams ON um_student_exams (id, student_id);
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_um_student_exams ON um_student_exams (id, student_id, exam_year, exam_quarter);
                 CREATE UNIQUE INDEX IF NOT EXISTS idx_um_teachers ON um_teachers (year, territory, school);
                 CREATE UNIQUE INDEX IF NOT EXISTS idx_um_users ON um_users (username);
-                CREATE INDEX IF NOT EXISTS idx_exam_year_quarter ON um_student_exams (exam_year, exam_quarter);
+                CREATE INDEX IF NOT EXISTS idx_um_student_scores_period ON um_student_scores (exam_year, exam_quarter);
 
             """
         )
+        for index in WORKLOAD_INDEXES.values():
+            self.cur.execute(index)
+        # Prefix of idx_um_student_exams_period_school
+        self.cur.execute("DROP INDEX IF EXISTS idx_exam_year_quarter")
         self.conn.commit()
 
-    def insert_admins(self):
-        admin_hashed_password = bcrypt.hashpw(ADMIN_CREDENTIALS[1].encode('utf-8'), bcrypt.gensalt(rounds=10)).decode('utf-8')
-        superadmin_hashed_password = bcrypt.hashpw(SUPERADMIN_CREDENTIALS[1].encode('utf-8'), bcrypt.gensalt(rounds=10)).decode('utf-8')
-
+    @pooled
+    def ensure_period_partitions(self, exam_year, exam_quarter):
+        """Create (if missing) the partitions one period is loaded into, run by the importer before inserting it"""
         with self.conn:
-            self.cur.execute(
-                """
-                    INSERT INTO um_users(username, password, role)
-                    VALUES (%s, %s, %s), (%s, %s, %s)
-                    ON CONFLICT(username) DO NOTHING;
-                """, (ADMIN_CREDENTIALS[0], admin_hashed_password, ADMIN_ROLE, 
-                      SUPERADMIN_CREDENTIALS[0], superadmin_hashed_password, SUPERADMIN_ROLE)
-            )
-            self.conn.commit()
+            # Parallel imports of the same year would race on the year partition
+            self.cur.execute("SELECT pg_advisory_xact_lock(hashtext('um_period_partitions'))")
+            for table in PARTITIONED_TABLES:
+                if not self._is_partitioned(table):
+                    raise RuntimeError(f"{table} is not partitioned, run create_tables to migrate it")
+                self._create_period_partitions(table, exam_year, exam_quarter)
+
+    def _create_period_partitions(self, table, exam_year, exam_quarter, parent=None):
+        year_partition = partition_name(table, exam_year)
+        self.cur.execute(
+            sql.SQL("""
+                CREATE TABLE IF NOT EXISTS {} PARTITION OF {}
+                FOR VALUES IN ({}) PARTITION BY LIST (exam_quarter)
+            """).format(sql.Identifier(year_partition), sql.Identifier(parent or table), sql.Literal(exam_year))
+        )
+        self.cur.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES IN ({})").format(
+                sql.Identifier(partition_name(table, exam_year, exam_quarter)),
+                sql.Identifier(year_partition),
+                sql.Literal(exam_quarter))
+        )
 
-    def get_admin(self, user: UserLoginBody) -> User:
+    @pooled
+    def detach_period_partitions(self, exam_year, exam_quarter):
+        """Detach one period from the hot tables, its partitions stay as standalone tables to archive or drop.
+        The derived rows of the period are removed; re-attaching requires refresh_student_scores."""
         with self.conn:
-            # Query to fetch the user
             self.cur.execute(
                 """
-                    SELECT id, username, password, created_at, last_login, role
-                    FROM um_users
-                    WHERE username = %s AND role IN (%s, %s)
+                    DELETE FROM um_student_scores WHERE exam_year = %(exam_year)s AND exam_quarter = %(exam_quarter)s;
+                    DELETE FROM um_dashboard_summary WHERE exam_year = %(exam_year)s AND exam_quarter = %(exam_quarter)s;
                 """,
-                (user.username, SUPERADMIN_ROLE, ADMIN_ROLE)
+                {"exam_year": exam_year, "exam_quarter": exam_quarter}
             )
-            
-            # Fetch the row
-            row = self.cur.fetchone()
-            
-            if not row:
-                return None  # Return None if no matching user is found
-            
-            # Map the row to the User model
-            user_data = {
-                "id": row[0],
-                "username": row[1],
-                "password": row[2],
-                "createdAt": row[3],
-                "lastLogin": row[4],
-                "role": row[5],
-            }
-
-            if bcrypt.checkpw(user.password.encode('utf-8'), user_data['password'].encode('utf-8')):
-                # Create a User instance
-                user_model = User(**user_data)
-                return user_model
-        return None
-
-    def get_schools_by_req(self, data: SchoolListRequest):
-        with self.conn:
-            query = """
-                SELECT JSON_AGG(
-                            DISTINCT um_school.name) schools
-                FROM um_student_exams
-                        LEFT JOIN um_school ON school_id = um_school.id
-                WHERE exam_quarter = %s
-                AND exam_year = %s
-                AND territory = %s
-                AND region = %s;
-            """
-
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, (data.exam_quarter, data.exam_year, data.territory, data.region))
-                results = cursor.fetchone()
-            
-        return results['schools']
-    
-    def get_regions_by_territory(self, region_list: RegionListRequest):
-        with self.conn:
-            query = """
-                SELECT JSON_AGG(
-                            DISTINCT region) regions
-                FROM um_student_exams
-                        LEFT JOIN um_school ON school_id = um_school.id
-                WHERE exam_quarter = %s
-                AND exam_year = %s
-                AND territory = %s;
-            """
-
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, (region_list.exam_quarter, region_list.exam_year, region_list.territory))
-                results = cursor.fetchone()
-            
-        return results['regions']
-    
-    def get_available_periods(self):
+            detached = []
+            for table in PARTITIONED_TABLES:
+                partition = partition_name(table, exam_year, exam_quarter)
+                if not self._table_exists(partition):
+                    continue
+                self.cur.execute(
+                    sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+                        sql.Identifier(partition_name(table, exam_year)), sql.Identifier(partition))
+                )
+                detached.append(partition)
+        self.bump_data_version(exam_year, exam_quarter)
+        return detached
+
+    @pooled
+    def create_period_staging(self, exam_year, exam_quarter):
+        """Create the staging tables one import of a period is loaded into, shaped like its partitions
+        with the same indexes and foreign keys, so publish_period attaches them without rebuilding or
+        re-validating anything, and with the same unique keys the importer upserts on. A re-import
+        starts from a copy of the published rows. Returns {table: staging table to load it into}."""
+        targets = {}
         with self.conn:
-            query = """
-                WITH periods AS (
-                    SELECT DISTINCT exam_year, exam_quarter
-                    FROM um_rate
-                ),
-                grouped_periods AS (
-                    SELECT exam_year, JSON_AGG(exam_quarter ORDER BY exam_quarter) AS quarters
-                    FROM periods
-                    GROUP BY exam_year
-                    ORDER BY exam_year DESC
+            for table in PARTITIONED_TABLES:
+                if not self._is_partitioned(table):
+                    raise RuntimeError(f"{table} is not partitioned, run create_tables to migrate it")
+
+                staging = staging_name(table, exam_year, exam_quarter)
+                partition = partition_name(table, exam_year, exam_quarter)
+                # Left over by a failed import
+                self.cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(staging)))
+                self.cur.execute(
+                    sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING INDEXES)").format(
+                        sql.Identifier(staging), sql.Identifier(table))
                 )
-                SELECT JSON_OBJECT_AGG(exam_year, quarters) AS result
-                FROM grouped_periods;
-            """
-
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query)
-                results = cursor.fetchone()
-
-            return results['result']
-        
-    def get_available_paired_periods(self):
+                # Implies the partition bounds, ATTACH PARTITION then skips its validation scan
+                self.cur.execute(
+                    sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} CHECK (exam_year = {} AND exam_quarter = {})").format(
+                        sql.Identifier(staging), sql.Identifier(f"{partition}_period"),
+                        sql.Literal(exam_year), sql.Literal(exam_quarter))
+                )
+                self._copy_foreign_keys(table, staging)
+
+                # One sequential INSERT ... SELECT of the published period, even when a re-import changes a
+                # few rows: readers keep the previous data until publish_period and the swap stays a
+                # catalog change, instead of upserting into the live partition row by row
+                if self._table_exists(partition):
+                    columns = sql.SQL(", ").join(sql.Identifier(column) for column in self._columns(table))
+                    self.cur.execute(
+                        sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(
+                            sql.Identifier(staging), columns, columns, sql.Identifier(partition))
+                    )
+                targets[table] = staging
+        return targets
+
+    @pooled
+    def drop_period_staging(self, exam_year, exam_quarter):
+        """Throw away the staging tables of an import that failed or had nothing to publish"""
         with self.conn:
-            query = """
-                WITH periods AS (
-                    SELECT DISTINCT exam_year, exam_quarter
-                    FROM um_rate
-                ),
-                grouped_periods AS (
-                    SELECT exam_year, JSON_AGG(exam_quarter ORDER BY exam_quarter) AS quarters
-                    FROM periods
-                    GROUP BY exam_year
-                    HAVING COUNT(exam_quarter) > 1
-                    ORDER BY exam_year DESC
+            for table in PARTITIONED_TABLES:
+                self.cur.execute(
+                    sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(staging_name(table, exam_year, exam_quarter)))
+                )
+            # Rates of a period that was never published, left by imports that wrote them before publish_period
+            if not self._table_exists(partition_name("um_student_exams", exam_year, exam_quarter)):
+                self.cur.execute(
+                    "DELETE FROM um_rate WHERE exam_year = %s AND exam_quarter = %s", (exam_year, exam_quarter)
                 )
-                SELECT JSON_OBJECT_AGG(exam_year, quarters) AS result
-                FROM grouped_periods;
-            """
 
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query)
-                results = cursor.fetchone()
+    @pooled
+    def publish_period(self, exam_year, exam_quarter, changed_ids=None, rate_df=None,
+                       lock_timeout_ms=PUBLISH_LOCK_TIMEOUT_MS, retries=PUBLISH_RETRIES):
+        """Write the um_rate rows of the import (`rate_df`), swap the staging tables of one period in for
+        its partitions and rebuild its scores, /home summary and school hierarchy, all in one transaction:
+        readers see the previous data, and the period is not listed before it is new, until it commits
+        and the new data right after. After a re-import `changed_ids` are the exams it wrote or removed,
+        only their scores are recomputed unless a max point changed. Waiting on a reader of the partitions
+        gives up after `lock_timeout_ms` and retries, so the swap never holds a queue of blocked readers behind it."""
+        for attempt in range(retries + 1):
+            try:
+                with self.conn:
+                    swapped = self._publish_period(exam_year, exam_quarter, changed_ids, rate_df, lock_timeout_ms)
+                break
+            except errors.LockNotAvailable:
+                if attempt == retries:
+                    raise
+                time.sleep(min(0.1 * 2 ** attempt, 5))
+
+        self._invalidate_caches(exam_year, exam_quarter)
+        return swapped
+
+    def _publish_period(self, exam_year, exam_quarter, changed_ids, rate_df, lock_timeout_ms):
+        period = {"exam_year": exam_year, "exam_quarter": exam_quarter}
+        # Same lock as ensure_period_partitions, partition DDL of one year never interleaves
+        self.cur.execute("SELECT pg_advisory_xact_lock(hashtext('um_period_partitions'))")
+        self.cur.execute(sql.SQL("SET LOCAL lock_timeout = {}").format(sql.Literal(f"{lock_timeout_ms}ms")))
+
+        staged = [table for table in PARTITIONED_TABLES if self._table_exists(staging_name(table, exam_year, exam_quarter))]
+        exams_table = (staging_name("um_student_exams", exam_year, exam_quarter)
+                       if "um_student_exams" in staged else "um_student_exams")
+
+        # Plain row changes first, built from the staging table: they do not block the readers of the period.
+        # A corrected max point changes the scores of every exam of its subject, not only the changed ones
+        if rate_df is not None and self._write_rates(rate_df, "import"):
+            changed_ids = None
+        if changed_ids is None:
+            self.cur.execute(
+                "DELETE FROM um_student_scores WHERE exam_year = %(exam_year)s AND exam_quarter = %(exam_quarter)s",
+                period
+            )
+            self.cur.execute(*queries.refresh_student_scores_query(exam_year, exam_quarter, exams_table))
+        else:
+            # A re-import keeps the published rows it did not change, their scores still hold. The
+            # exams it removed lose theirs
+            self.cur.execute(*queries.delete_removed_scores_query(exam_year, exam_quarter, changed_ids, exams_table))
+            self.cur.execute(*queries.refresh_student_scores_query(exam_year, exam_quarter, exams_table, changed_ids))
+        base_request = BaseRequest(examYear=exam_year, examQuarter=exam_quarter)
+        self.cur.execute(*queries.refresh_dashboard_summary_query(base_request, exams_table))
+        self.cur.execute(*queries.refresh_school_hierarchy_query(exam_year, exam_quarter, exams_table))
+
+        # The swap last: its ACCESS EXCLUSIVE locks are only held for the renames and the commit. ATTACH
+        # skips its validation scan thanks to the period CHECK constraint of the staging table, DETACH
+        # CONCURRENTLY would not fit, it cannot run inside the transaction that keeps the swap atomic
+        for table in staged:
+            staging = staging_name(table, exam_year, exam_quarter)
+            partition = partition_name(table, exam_year, exam_quarter)
+            year_partition = partition_name(table, exam_year)
+            if self._table_exists(partition):
+                self.cur.execute(
+                    sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+                        sql.Identifier(year_partition), sql.Identifier(partition))
+                )
+                self.cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(partition)))
+            self.cur.execute(
+                sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(staging), sql.Identifier(partition))
+            )
+            # Keep the index names of the partition stable over imports
+            self.cur.execute(
+                "SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = to_regclass(%s)", (partition,)
+            )
+            for (index,) in self.cur.fetchall():
+                if index.startswith(staging):
+                    self.cur.execute(
+                        sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                            sql.Identifier(index), sql.Identifier(partition + index[len(staging):]))
+                    )
+            self.cur.execute(
+                sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES IN ({})").format(
+                    sql.Identifier(year_partition), sql.Identifier(partition), sql.Literal(exam_quarter))
+            )
 
-            return results['result']
+        self.cur.execute(*queries.bump_data_version_query(exam_year, exam_quarter))
+        return staged
 
-    def get_last_year_and_quarter(self):
-        with self.conn:
-            query = """
-                SELECT exam_year, exam_quarter
-                FROM um_rate
-                ORDER BY exam_year DESC, exam_quarter DESC
-                LIMIT 1;
+    def _copy_foreign_keys(self, source, target):
+        self.cur.execute(
             """
+                SELECT conname, pg_get_constraintdef(oid)
+                FROM pg_constraint
+                WHERE conrelid = to_regclass(%s) AND contype = 'f'
+            """, (source,)
+        )
+        for name, foreign_key in self.cur.fetchall():
+            self.cur.execute(
+                sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+                    sql.Identifier(target), sql.Identifier(name), sql.SQL(foreign_key))
+            )
 
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query)
-                results = cursor.fetchone()
-
-            return results
-        
-    def get_base_results(self, base_request: BaseRequest):
-        with self.conn:
-            query = """
-                WITH results AS (SELECT *
-                 FROM um_student_exams
-                 WHERE exam_year = %(exam_year)s
-                   AND exam_quarter = %(exam_quarter)s),
-     rates AS (SELECT max_point_over_all, subject
-               FROM um_rate
-               WHERE exam_year = %(exam_year)s
-                 AND exam_quarter = %(exam_quarter)s),
-     all_count AS (SELECT COUNT(*) AS count
-                   FROM results),
-     exam_methods_data AS (SELECT exam_method,
-                                  COUNT(*) AS count,
-                                  ROUND(COUNT(*)::numeric / (SELECT count FROM all_count)::numeric * 100,
-                                        1) AS percentage
-                           FROM results
-                           GROUP BY exam_method),
-     territories_data AS (SELECT territory, um_school.name as school_name, average_point, school_id, region
-                          FROM results
-                                   LEFT JOIN um_school ON school_id = um_school.id),
-     schools_count_by_region AS (SELECT territory, COUNT(DISTINCT school_id) AS school_count
-                                 FROM territories_data
-                                 GROUP BY territory
-                                 ORDER BY COUNT(DISTINCT school_name) DESC),
-     all_school_count AS (SELECT SUM(school_count) AS all_schools_count
-                          FROM schools_count_by_region),
-     avg_by_territory AS (SELECT territory,
-                                 ROUND(AVG(average_point / (SELECT AVG(max_point_over_all) FROM rates) * 100)::numeric,
-                                       1) AS data
-                          FROM territories_data
-                          GROUP BY territory
-                          ORDER BY ROUND(AVG(average_point)::numeric, 1)),
-     avg_by_territory_with_avg_all AS (SELECT 'Barcha hudular' AS territory,
-                                              ROUND(
-                                                      AVG(average_point / (SELECT AVG(max_point_over_all) FROM rates) * 100)::numeric,
-                                                      1
-                                              )  AS data
-                                       FROM territories_data
-                                       UNION ALL
-                                       SELECT *
-                                       FROM avg_by_territory),
-     avg_by_school AS (SELECT territory,
-                              school_name,
-                              region,
-                              ROUND(AVG(average_point / (SELECT AVG(max_point_over_all) FROM rates) * 100)::numeric,
-                                    1) AS data
-                       FROM territories_data
-                       GROUP BY territory, region, school_id, school_name
-                       ORDER BY ROUND(AVG(average_point)::numeric, 1)),
-    teachers_info AS (SELECT *
-                       FROM um_teachers
-                       WHERE year = %(exam_year)s
-                       ORDER BY teachers_count DESC),
-    teachers_schools AS (SELECT json_agg(
-                        json_build_object(
-                            'territory', territory,
-                            'school', school_array
-                        )
-                    ) AS result
-                FROM (
-                    SELECT territory, json_agg(school) AS school_array
-                    FROM um_teachers
-                    WHERE year = %(exam_year)s
-                    GROUP BY territory
-                    ORDER BY AVG(teachers_count) DESC
-                ) subquery),
-    teachers_info_by_territory AS (SELECT territory,
-                                          SUM(teachers_count)                  as teachers_count,
-                                          SUM(women_teachers_count)            as women_teachers_count,
-                                          SUM(men_teachers_count)              as men_teachers_count,
-                                          SUM(special_teachers_count)          as special_teachers_count,
-                                          SUM(first_category_teachers_count)   as first_category_teachers_count,
-                                          SUM(second_category_teachers_count)  as second_category_teachers_count,
-                                          SUM(highest_category_teachers_count) as highest_category_teachers_count,
-                                          ROUND((SUM(women_teachers_count)::NUMERIC / SUM(teachers_count)::NUMERIC *
-                                                 100),
-                                                2)                             as women_teachers_percentage,
-                                          ROUND((SUM(men_teachers_count)::NUMERIC / SUM(teachers_count)::NUMERIC) * 100,
-                                                2)                             as men_teachers_percentage,
-                                          ROUND((SUM(special_teachers_count)::NUMERIC / SUM(teachers_count)::NUMERIC) *
-                                                100,
-                                                2)                             as special_teachers_percentage,
-                                          ROUND((SUM(first_category_teachers_count)::NUMERIC /
-                                                 SUM(teachers_count)::NUMERIC) * 100,
-                                                2)                             as first_category_teachers_percentage,
-                                          ROUND((SUM(second_category_teachers_count)::NUMERIC /
-                                                 SUM(teachers_count)::NUMERIC) * 100,
-                                                2)                             as second_category_teachers_percentage,
-                                          ROUND((SUM(highest_category_teachers_count)::NUMERIC /
-                                                 SUM(teachers_count)::NUMERIC) * 100,
-                                                2)                             as highest_category_teachers_percentage
-                                   FROM um_teachers
-                                   WHERE year = %(exam_year)s
-                                     AND territory != 'Barcha hududlar'
-                                   GROUP BY territory
-                                   UNION ALL
-                                   SELECT territory,
-                                          teachers_count,
-                                          women_teachers_count,
-                                          men_teachers_count,
-                                          special_teachers_count,
-                                          first_category_teachers_count,
-                                          second_category_teachers_count,
-                                          highest_category_teachers_count,
-                                          women_teachers_percentage,
-                                          men_teachers_percentage,
-                                          special_teachers_percentage,
-                                          first_category_teachers_percentage,
-                                          second_category_teachers_percentage,
-                                          highest_category_teachers_percentage
-                                   FROM um_teachers
-                                   WHERE year = %(exam_year)s
-                                     AND territory = 'Barcha hududlar'),
-     all_region_count AS (SELECT COUNT(DISTINCT territory) as count FROM school),
-     all_teachers_count AS (SELECT COALESCE(SUM(teachers_count), 0) as count FROM teachers_info WHERE territory = 'Barcha hududlar')
-SELECT json_build_object(
-               'all_count', (SELECT count FROM all_count),
-               'exam_methods_data', (SELECT json_agg(json_build_object(
-                'exam_method', exam_method,
-                'count', count,
-                'percentage', percentage
-                                                     ))
-                                     FROM exam_methods_data),
-               'territories_data', (SELECT json_agg(json_build_object(
-                'territory', territory,
-                'school_count', school_count
-                                                    ))
-                                    FROM schools_count_by_region),
-               'avg_by_territory', (SELECT json_agg(json_build_object(
-                'territory', territory,
-                'average', data
-                                                    ))
-                                    FROM avg_by_territory_with_avg_all),
-               'avg_by_school', (SELECT json_agg(json_build_object(
-                'territory', territory,
-                'school', school_name,
-                'region', region,
-                'average', data
-                                                 ))
-                                 FROM avg_by_school),
-               'teachers_info', (SELECT json_agg(json_build_object(
-                'territory', territory,
-                'school', school,
-                'teachers_count', teachers_count,
-                'women_teachers_count', women_teachers_count,
-                'women_teachers_percentage', women_teachers_percentage,
-                'men_teachers_count', men_teachers_count,
-                'men_teachers_percentage', men_teachers_percentage,
-                'special_teachers_count', special_teachers_count,
-                'special_teachers_percentage', special_teachers_percentage,
-                'first_category_teachers_count', first_category_teachers_count,
-                'first_category_teachers_percentage', first_category_teachers_percentage,
-                'second_category_teachers_count', second_category_teachers_count,
-                'second_category_teachers_percentage', second_category_teachers_percentage,
-                'highest_category_teachers_count', highest_category_teachers_count,
-                'highest_category_teachers_percentage', highest_category_teachers_percentage
-                                                 ))
-                                 FROM teachers_info),
-               'teachers_info_by_territory', (SELECT json_agg(row_to_json(t)) AS json_object
-                                             FROM teachers_info_by_territory AS t),
-                'teachers_schools', (SELECT result FROM teachers_schools),
-               'all_schools_count', (SELECT all_schools_count FROM all_school_count),
-               'all_regions_count', (SELECT count FROM all_region_count),
-               'all_teachers_count', (SELECT count FROM all_teachers_count)) AS result;
-
-                """
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, {
-                    "exam_year": base_request.exam_year,
-                    "exam_quarter": base_request.exam_quarter,
-                })
-                results = cursor.fetchone()
-            
-        return results['result']
-            
-    def get_school_results(self, school_request: SchoolRequest):
-        # Base query with placeholders for studyClass and territory filters
-        base_query = """
-            WITH rates AS (SELECT max_point_over_all, subject
-               FROM um_rate
-               WHERE exam_quarter = %s
-                 AND exam_year = %s),
-     school_results AS (SELECT um_school.id AS school_id,
-                               um_school.region    AS region,
-                               um_school.name      AS school,
-
-                               ROUND(((average_point -> 'all' ->> '{avg_key}')::numeric /
-                                      (SELECT AVG(max_point_over_all) FROM rates)) * 100,
-                                     1)            AS average,
-                               COALESCE(
-                                       ROUND(
-                                               ((results -> 'all' -> '{result_key}' -> 'math_5&6' ->> 'all_point')::numeric /
-                                                (SELECT max_point_over_all FROM rates WHERE subject = 'math_5&6')) *
-                                               100, 1),
-                                       ROUND(((results -> 'all' -> '{result_key}' -> 'math_7' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all FROM rates WHERE subject = 'math_7')) * 100, 1)
-                               )                   AS math,
-                               COALESCE(
-                                       ROUND(((results -> 'all' -> '{result_key}' -> 'mother_tongue_literature_7' ->>
-                                               'all_point')::numeric /
-                                              (SELECT max_point_over_all
-                                               FROM rates
-                                               WHERE subject = 'mother_tongue_literature_7')) * 100, 1),
-                                       ROUND(((results -> 'all' -> '{result_key}' ->
-                                               'mother_tongue_literature_8&10&11' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all
-                                               FROM rates
-                                               WHERE subject = 'mother_tongue_literature_8&10&11')) * 100, 1)
-                               )                   AS mother_tongue_literature,
-                               ROUND(((results -> 'all' -> '{result_key}' -> 'literature_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'literature_5&6')) * 100,
-                                     1)            AS literature,
-                               ROUND(
-                                       ((results -> 'all' -> '{result_key}' -> 'mother_tongue_5&6' ->> 'all_point')::numeric /
-                                        (SELECT max_point_over_all FROM rates WHERE subject = 'mother_tongue_5&6')) *
-                                       100,
-                                       1)          AS mother_tongue,
-                               ROUND(
-                                       ((results -> 'all' -> '{result_key}' -> 'russian-qaraqalpaq_5&6' ->> 'all_point')::numeric) /
-                                       (SELECT max_point_over_all FROM rates WHERE subject = 'russian-qaraqalpaq_5&6') *
-                                       100,
-                                       1)          AS russian,
-                               ROUND(((results -> 'all' -> '{result_key}' -> 'chemistry_8' ->> 'all_point')::numeric) /
-                                     (SELECT max_point_over_all FROM rates WHERE subject = 'chemistry_8') * 100,
-                                     1)            AS chemistry,
-                               ROUND(((results -> 'all' -> '{result_key}' -> 'biology_7' ->> 'all_point')::numeric) /
-                                     (SELECT max_point_over_all FROM rates WHERE subject = 'biology_7') * 100,
-                                     1)            AS biology,
-                               ROUND(
-                                       ((results -> 'all' -> '{result_key}' -> 'english_9&10&11' ->> 'all_point')::numeric) /
-                                       (SELECT max_point_over_all FROM rates WHERE subject = 'english_9&10&11') * 100,
-                                       1)          AS english,
-                               ROUND(((results -> 'all' -> '{result_key}' -> 'physics_9' ->> 'all_point')::numeric) /
-                                     (SELECT max_point_over_all FROM rates WHERE subject = 'physics_9') * 100,
-                                     1)            AS physics,
-                               ROUND(
-                                       ((results -> 'all' -> '{result_key}' -> 'algebra_8&9&10&11' ->> 'all_point')::numeric) /
-                                       (SELECT max_point_over_all FROM rates WHERE subject = 'algebra_8&9&10&11') * 100,
-                                       1)          AS algebra,
-                               ROUND(
-                                       ((results -> 'all' -> '{result_key}' -> 'geometry_8&9&10&11' ->> 'all_point')::numeric) /
-                                       (SELECT max_point_over_all FROM rates WHERE subject = 'geometry_8&9&10&11') *
-                                       100,
-                                       1)          AS geometry
-                        FROM um_school_results
-                                 LEFT JOIN um_school ON um_school_results.school_id = um_school.id
-                        WHERE exam_quarter = %s
-                          AND exam_year = %s
-                          {territory_filter}
-                        ORDER BY um_school.territory),
-                        """
-        if school_request.subject:
-            limited_query = f"""
-                    limited_school_results AS (
-                        SELECT 
-                            school_id,
-                            region,
-                            school,
-                            {school_request.subject}
-                        FROM school_results
-                        ORDER BY {school_request.subject} DESC NULLS LAST
-                        LIMIT 20 OFFSET ({school_request.page}-1) * 20
-                    ),"""
-        else:
-            limited_query = f"""
-                    limited_school_results AS (
-                        SELECT * FROM school_results
-                        ORDER BY average DESC NULLS LAST
-                        LIMIT 20 OFFSET ({school_request.page}-1) * 20
-                    ),"""
-        
-        result_query = """
-                pages AS (
-                    SELECT CEIL(COUNT(*) / 20.0) FROM school_results
-                )
-SELECT JSON_BUILD_OBJECT('school_results', (SELECT JSON_AGG(limited_school_results) FROM limited_school_results),
-       'pages', (SELECT * FROM pages)) AS result;
+    def _columns(self, table):
+        self.cur.execute(
             """
-        
-        query = base_query + limited_query + result_query
+                SELECT attname
+                FROM pg_attribute
+                WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped
+                ORDER BY attnum
+            """, (table,)
+        )
+        return [column for (column,) in self.cur.fetchall()]
 
-        
-        # Extract the request parameters
-        exam_quarter = school_request.exam_quarter
-        exam_year = school_request.exam_year
-        studyClass = school_request.study_class
-        territory = school_request.territory
-
-        # Determine the appropriate key for results
-        results_key = 'school_avg' if studyClass is None else f"{studyClass}"
-        avg_key = 'overall' if studyClass is None else f"{studyClass}"
-        query = query.format(
-            avg_key=avg_key,
-            result_key=results_key,
-            territory_filter="AND territory = %s" if territory else ""
+    def _unique_keys(self, table):
+        """Column sets of the unique indexes of `table`, partial ones left out"""
+        self.cur.execute(
+            """
+                SELECT ARRAY_AGG(pg_attribute.attname)
+                FROM pg_index
+                JOIN pg_attribute ON pg_attribute.attrelid = pg_index.indrelid AND pg_attribute.attnum = ANY(pg_index.indkey)
+                WHERE pg_index.indrelid = to_regclass(%s) AND pg_index.indisunique AND pg_index.indpred IS NULL
+                GROUP BY pg_index.indexrelid
+            """, (table,)
         )
+        return [set(columns) for (columns,) in self.cur.fetchall()]
+
+    def _is_partitioned(self, table):
+        self.cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+        row = self.cur.fetchone()
+        return bool(row and row[0])
+
+    def _table_exists(self, table):
+        self.cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+        return self.cur.fetchone()[0]
+
+    @pooled
+    def check_indexes(self):
+        """Report workload indexes that are missing, indexes never scanned since the statistics were
+        reset, and big tables read mostly by sequential scans"""
+        usage = self._fetchone(*queries.index_usage_query())
+        return {
+            "missing": [name for name in WORKLOAD_INDEXES if name not in usage['existing']],
+            "unused": usage['unused'],
+            "seq_scanned_tables": usage['seq_scanned'],
+        }
 
-        # Build the parameter list for query execution
-        params = [exam_quarter, exam_year, exam_quarter, exam_year]
-        if territory:
-            params.append(territory)
+    @pooled
+    def bulk_load(self, table, df, chunk_rows=COPY_CHUNK_ROWS, conflict=None):
+        """Load a DataFrame into `table` with COPY through a temporary staging table. Rows that hit
+        a unique constraint are skipped like with ON CONFLICT DO NOTHING, or with `conflict` (the
+        columns of a unique index) updated in place, only when their row_hash changed if the frame
+        has one. The CSV is streamed in batches of `chunk_rows` so memory stays flat for any file size."""
+        started = time.perf_counter()
+        staging = f"{table}_staging"
+        columns = sql.SQL(", ").join(sql.Identifier(column) for column in df.columns)
+        copy = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+            sql.Identifier(staging), columns).as_string(self.cur)
+
+        if conflict:
+            # ON CONFLICT (columns) needs a unique index on exactly those columns, fail before loading anything
+            if set(conflict) not in self._unique_keys(table):
+                raise ValueError(f"{table} has no unique index on ({', '.join(conflict)}) to upsert on")
+            keys = sql.SQL(", ").join(sql.Identifier(column) for column in conflict)
+            # DISTINCT ON: an upsert may not touch the same row twice
+            select = sql.SQL("SELECT DISTINCT ON ({}) {} FROM {}").format(keys, columns, sql.Identifier(staging))
+            merge = sql.SQL("ON CONFLICT ({}) DO UPDATE SET {}").format(keys, sql.SQL(", ").join(
+                sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column))
+                for column in df.columns if column not in conflict))
+            if "row_hash" in df.columns:
+                merge += sql.SQL(" WHERE {}.row_hash IS DISTINCT FROM EXCLUDED.row_hash").format(sql.Identifier(table))
+        else:
+            select = sql.SQL("SELECT {} FROM {}").format(columns, sql.Identifier(staging))
+            merge = sql.SQL("ON CONFLICT DO NOTHING")
 
-        # with connection.cursor(cursor_factory=RealDictCursor) as cursor:
-        # Execute query with cursor
         with self.conn:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, params)
-                results = cursor.fetchone()
+            self.cur.execute(
+                sql.SQL("CREATE TEMPORARY TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP").format(
+                    sql.Identifier(staging), sql.Identifier(table))
+            )
+            for start in range(0, len(df), chunk_rows):
+                buffer = io.StringIO()
+                # NaN / None are written as empty fields, which COPY reads as NULL
+                df.iloc[start:start + chunk_rows].to_csv(buffer, header=False, index=False)
+                buffer.seek(0)
+                self.cur.copy_expert(copy, buffer)
+            self.cur.execute(
+                sql.SQL("INSERT INTO {} ({}) {} {}").format(sql.Identifier(table), columns, select, merge)
+            )
+            written = self.cur.rowcount
+
+        elapsed = time.perf_counter() - started
+        return {
+            "table": table,
+            "rows": len(df),
+            "written": written,
+            "seconds": round(elapsed, 3),
+            "rows_per_sec": round(len(df) / elapsed) if elapsed else None,
+        }
 
-        return results['result']
+    def _write_rates(self, rate_df, changed_by):
+        """Store the um_rate rows of an imported sheet: a new subject is inserted, a rate the sheet
+        corrects becomes a new version like with update_rate (the replaced one kept in um_rate_history).
+        Returns the subjects whose max point changed, their scores need a full refresh."""
+        aliases = {name: field.alias for name, field in RateUpdate.model_fields.items()}
+        max_point_changed = []
+        for row in rate_df.to_dict('records'):
+            rate = RateUpdate(**{aliases[column]: value for column, value in row.items()})
+            self.cur.execute(*queries.insert_rate_query(rate))
+            if self.cur.rowcount:
+                continue
+            self.cur.execute(*queries.update_rate_query(rate, changed_by))
+            changed = self.cur.fetchone()
+            if changed is not None and changed[1]:
+                max_point_changed.append(rate.subject)
+        return max_point_changed
+
+    @pooled
+    def get_exam_hashes(self, exam_year, exam_quarter):
+        """(id, row_hash, school_id) of every student exam of one period, to diff a re-import against"""
+        self.cur.execute(*queries.exam_hashes_query(exam_year, exam_quarter))
+        return self.cur.fetchall()
+
+    @pooled
+    def delete_exams(self, exam_year, exam_quarter, ids, exams_table="um_student_exams"):
+        """Delete the student exams `ids` of one period, e.g. rows a re-imported sheet no longer has"""
+        with self.conn:
+            self.cur.execute(*queries.delete_exams_query(exam_year, exam_quarter, ids, exams_table))
+            return self.cur.rowcount
+
+    @pooled
+    def rebuild_school_results(self, exam_year, exam_quarter, school_ids=None, exams_table="um_student_exams",
+                               results_table="um_school_results"):
+        """Recompute um_school_results of one period, or of some of its schools, inside the database
+        from the student exams, e.g. after correcting exams in place. Returns the rows written."""
+        with self.conn:
+            self.cur.execute(*queries.rebuild_school_results_query(exam_year, exam_quarter, school_ids,
+                                                                   exams_table, results_table))
+            return self.cur.rowcount
+
+    @pooled
+    def analyze_period(self, exam_year, exam_quarter, targets=None):
+        """Refresh the planner statistics of what an import of one period wrote, so the first
+        reports on it are not planned with the statistics of empty partitions. `targets` are the
+        tables the period was loaded into (see create_period_staging), its partitions by default"""
+        if targets is None:
+            targets = {table: partition_name(table, exam_year, exam_quarter) for table in PARTITIONED_TABLES}
+        tables = list(targets.values())
+        tables += ["um_student_scores", "um_school", "um_rate"]
+        with self.conn:
+            for table in tables:
+                self.cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+        return tables
 
-    def get_students_results(self, students_request: StudentRequest):
+    @pooled
+    def refresh_student_scores(self, exam_year, exam_quarter):
+        """Recompute the normalized scores of one period, run after importing it or changing its um_rate rows"""
         with self.conn:
-            base_query = """
-                WITH rates AS (SELECT max_point_over_all, subject
-               FROM um_rate
-               WHERE exam_quarter = %s
-                 AND exam_year = %s),
-     student_results AS (SELECT
-                             um_school.region,
-                             um_school.name,
-                                CONCAT(um_student_exams.surname, '. ', LEFT(um_student_exams.name, 1), '. ',
-                                       LEFT(um_student_exams.patronymic, 1),
-                                       '.')                 as full_name,
-                                CONCAT(studystream, '-sinf') as study_class,
-                                ROUND(average_point::numeric / (SELECT AVG(max_point_over_all) FROM rates) * 100,
-                                      1)                       average,
-
-                                COALESCE(
-                                        ROUND((results -> 'math_5&6' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all FROM rates WHERE subject = 'math_5&6') *
-                                              100, 1),
-                                        ROUND((results -> 'math_7' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all FROM rates WHERE subject = 'math_7') *
-                                              100, 1)
-                                )                              math,
-                                COALESCE(
-                                        ROUND((results -> 'mother_tongue_literature_7' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all
-                                               FROM rates
-                                               WHERE subject = 'mother_tongue_literature_7&6') *
-                                              100, 1),
-                                        ROUND((results -> 'mother_tongue_literature_8&10&11' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all
-                                               FROM rates
-                                               WHERE subject = 'mother_tongue_literature_8&10&11') *
-                                              100, 1)
-                                )                              mother_tongue_literature,
-                                ROUND((results -> 'literature_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'literature_5&6') * 100,
-                                      1)                       literature,
-                                ROUND((results -> 'mother_tongue_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'mother_tongue_5&6') * 100,
-                                      1)                       mother_tongue,
-                                ROUND((results -> 'russian-qaraqalpaq_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'russian-qaraqalpaq_5&6') *
-                                      100,
-                                      1)                       russian,
-                                ROUND((results -> 'chemistry_8' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'chemistry_8') * 100,
-                                      1)                       chemistry,
-                                ROUND((results -> 'biology_7' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'biology_7') * 100,
-                                      1)                       biology,
-                                ROUND((results -> 'english_9&10&11' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'english_9&10&11') * 100,
-                                      1)                       english,
-                                ROUND((results -> 'physics_9' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'physics_9') * 100,
-                                      1)                       physics,
-                                ROUND((results -> 'algebra_8&9&10&11' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'algebra_8&9&10&11') * 100,
-                                      1)                       algebra,
-                                ROUND((results -> 'geometry_8&9&10&11' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'geometry_8&9&10&11') * 100,
-                                      1)                       geometry
-                         FROM um_student_exams
-                                  LEFT JOIN um_school ON um_student_exams.school_id = um_school.id
-                WHERE exam_quarter = %s
-                    AND exam_year = %s
-                    AND (%s IS NULL OR um_school.territory = %s)
-                    AND (%s IS NULL OR um_school.region = %s)
-                    AND (%s IS NULL OR um_school.name = %s)
-                    AND (%s IS NULL OR studyclass = %s)),"""
-            
-            limited_query = f"""
-                limited_school_results AS (SELECT *
-                                FROM student_results
-                                ORDER BY { students_request.subject if students_request.subject  else 'average'} DESC NULLS LAST
-                                LIMIT 20 OFFSET ({students_request.page} - 1) * 20),
-                                """
-            
-            if students_request.subject:
-                result_query = f"""
-                    pages AS (SELECT CEIL(COUNT(*) / 20.0)
-                            FROM student_results)
-                SELECT JSON_BUILD_OBJECT('results', JSON_AGG(
-                        JSON_BUILD_OBJECT(
-                                'region', region,
-                                'school', name,
-                                'full_name', full_name,
-                                'class', study_class,
-                                '{students_request.subject}', {students_request.subject}
-                                
-                        )
-                                                    ),
-                    'total_pages', (SELECT * FROM pages)
-                    ) AS result
-                FROM limited_school_results ;
-                                """
-            else:
-                result_query = f"""
-                    pages AS (SELECT CEIL(COUNT(*) / 20.0)
-                            FROM student_results)
-                SELECT JSON_BUILD_OBJECT('results', JSON_AGG(
-                        JSON_BUILD_OBJECT(
-                                'region', region,
-                                'school', name,
-                                'full_name', full_name,
-                                'class', study_class,
-                                'average', average,
-                                'math', math,
-                                'mother_tongue_literature', mother_tongue_literature,
-                                'literature', literature,
-                                'mother_tongue', mother_tongue,
-                                'russian', russian,
-                                'algebra', algebra,
-                                'geometry', geometry,
-                                'physics', physics,
-                                'chemistry', chemistry,
-                                'biology', biology,
-                                'english', english
-                        )
-                                                    ),
-                    'total_pages', (SELECT * FROM pages)
-                    ) AS result
-                FROM limited_school_results ;
-                                """
-            
-            # print(students_request)
-            
-            params = [
-                students_request.exam_quarter,
-                students_request.exam_year,
-                students_request.exam_quarter,
-                students_request.exam_year,
-                students_request.territory, students_request.territory,
-                students_request.region, students_request.region,
-                students_request.school, students_request.school,
-                students_request.study_class, students_request.study_class,
-            ]
-
-            query = base_query + limited_query + result_query
-
-            # Execute the query
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, params)
-                results = cursor.fetchone()
+            self.cur.execute(*queries.refresh_student_scores_query(exam_year, exam_quarter))
+            return self.cur.rowcount
 
-            return results['result']
-    
-    def get_results(self, params: ResultRequest):
+    @pooled
+    def refresh_missing_student_scores(self):
+        """Backfill um_student_scores for periods imported before it existed"""
+        with self.conn:
+            self.cur.execute(
+                """
+                    SELECT DISTINCT exam_year, exam_quarter
+                    FROM um_rate
+                    WHERE NOT EXISTS (SELECT 1
+                                      FROM um_student_scores
+                                      WHERE um_student_scores.exam_year = um_rate.exam_year
+                                        AND um_student_scores.exam_quarter = um_rate.exam_quarter)
+                """
+            )
+            periods = self.cur.fetchall()
 
-        # Base query setup for required fields
-        base_query = f"""
-            WITH rates AS (
-                SELECT max_point_over_all, subject
-                FROM um_rate
-                WHERE exam_year = %(exam_year)s
-                AND exam_quarter = %(exam_quarter)s
-            ),
-            results AS (
-                SELECT um_school.territory,
-                    um_school.region,
-                    um_school.id as school_id,
-                    um_school.name,
-                    um_student_exams.student_id,
-                    CONCAT(um_student_exams.surname, '. ', LEFT(um_student_exams.name, 1), '. ',
-                            LEFT(um_student_exams.patronymic, 1), '.') AS full_name,
-                    studystream,
-                    exam_method,
-                    ROUND(average_point::numeric / (SELECT AVG(max_point_over_all) FROM rates) * 100,
-                                      1)                        average,
-
-                                COALESCE(
-                                        ROUND((results -> 'math_5&6' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all FROM rates WHERE subject = 'math_5&6') *
-                                              100, 1),
-                                        ROUND((results -> 'math_7' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all FROM rates WHERE subject = 'math_7') *
-                                              100, 1)
-                                )                               math,
-                                COALESCE(
-                                        ROUND((results -> 'mother_tongue_literature_7' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all
-                                               FROM rates
-                                               WHERE subject = 'mother_tongue_literature_7&6') *
-                                              100, 1),
-                                        ROUND((results -> 'mother_tongue_literature_8&10&11' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all
-                                               FROM rates
-                                               WHERE subject = 'mother_tongue_literature_8&10&11') *
-                                              100, 1)
-                                )                               mother_tongue_literature,
-                                ROUND((results -> 'literature_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'literature_5&6') * 100,
-                                      1)                        literature,
-                                ROUND((results -> 'mother_tongue_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'mother_tongue_5&6') * 100,
-                                      1)                        mother_tongue,
-                                ROUND((results -> 'russian-qaraqalpaq_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'russian-qaraqalpaq_5&6') *
-                                      100,
-                                      1)                        russian,
-                                ROUND((results -> 'chemistry_8' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'chemistry_8') * 100,
-                                      1)                        chemistry,
-                                ROUND((results -> 'biology_7' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'biology_7') * 100,
-                                      1)                        biology,
-                                ROUND((results -> 'english_9&10&11' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'english_9&10&11') * 100,
-                                      1)                        english,
-                                ROUND((results -> 'physics_9' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'physics_9') * 100,
-                                      1)                        physics,
-                                ROUND((results -> 'algebra_8&9&10&11' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'algebra_8&9&10&11') * 100,
-                                      1)                        algebra,
-                                ROUND((results -> 'geometry_8&9&10&11' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'geometry_8&9&10&11') * 100,
-                                      1)                        geometry
-                FROM um_student_exams
-                LEFT JOIN um_school ON um_student_exams.school_id = um_school.id
-                WHERE exam_quarter = %(exam_quarter)s
-                AND exam_year = %(exam_year)s
-            ),
-        """
+        for exam_year, exam_quarter in periods:
+            self.refresh_student_scores(exam_year, exam_quarter)
+        return periods
 
-        # Define avg_column
-        avg_column = f"AVG({params.subject})" if params.subject else "AVG(average)"
-        
-        # `avg_by_territory` CTE with fallback conditions
-        avg_by_territory_query = f"""
-            avg_by_territory AS (
-                SELECT territory, ROUND({avg_column}::numeric, 1) AS data
-                FROM results
-                WHERE {'exam_method = %(exam_method)s' if params.exam_method else '1=1'}
-                AND {'studystream = %(study_class)s' if params.study_class else '1=1'}
-                GROUP BY territory
-                HAVING {avg_column} IS NOT NULL
-                ORDER BY {avg_column}
-            ), 
-        """
+    @pooled
+    def refresh_dashboard_summary(self, exam_year, exam_quarter):
+        """Rebuild the materialized /home payload of one period"""
+        base_request = BaseRequest(examYear=exam_year, examQuarter=exam_quarter)
+        results = self._fetchone(*queries.refresh_dashboard_summary_query(base_request))
+        return results['result']
 
-        # Define subject avg fields
-        avg_fields = f"ROUND(AVG({params.subject})::numeric, 1) AS {params.subject}_avg" if params.subject else """
-            ROUND(AVG(average)::numeric, 1)   AS _avg,
-            ROUND(AVG(math)::numeric, 1)                     AS math_avg,
-            ROUND(AVG(mother_tongue)::numeric, 1)            AS mother_tongue_avg,
-            ROUND(AVG(literature)::numeric, 1)               AS literature_avg,
-            ROUND(AVG(mother_tongue_literature)::numeric, 1) AS mother_tongue_literature_avg,
-            ROUND(AVG(russian)::numeric, 1)                  AS russian_avg,
-            ROUND(AVG(algebra)::numeric, 1)                  AS algebra_avg,
-            ROUND(AVG(geometry)::numeric, 1)                 AS geometry_avg,
-            ROUND(AVG(physics)::numeric, 1)                  AS physics_avg,
-            ROUND(AVG(biology)::numeric, 1)                  AS biology_avg,
-            ROUND(AVG(chemistry)::numeric, 1)                AS chemistry_avg,
-            ROUND(AVG(english)::numeric, 1)                  AS english_avg
-        """
-        
-        # `subject_results` CTE with fallback grouping
-        subject_results_query = f"""
-            subject_results AS (
-                SELECT {avg_fields},
-                    {'territory as key' if not params.territory else 'name as key' }
-                FROM results
-                WHERE {'exam_method = %(exam_method)s' if params.exam_method else '1=1'}
-                AND {'studystream = %(study_class)s' if params.study_class else '1=1'}
-                AND {'territory = %(territory)s' if params.territory else '1=1'}
-                AND {'region = %(region)s' if params.region else '1=1'}
-                GROUP BY {'territory' if not params.territory else 'school_id, name'}
-                {'HAVING AVG('+ params.subject + ') IS NOT NULL' if params.subject else ''}
-            ),
-        """
+    @pooled
+    def refresh_school_hierarchy(self, exam_year, exam_quarter):
+        """Rebuild the territory -> region -> school tree of one period, run after importing it"""
+        with self.conn:
+            self.cur.execute(*queries.refresh_school_hierarchy_query(exam_year, exam_quarter))
 
-        subject_avg_column = f"ROUND(AVG({params.subject})::numeric, 1) AS avg" if params.subject else "ROUND(AVG(average)::numeric, 1) AS avg"
-
-        study_class_results_query = f"""
-            study_class_results AS (
-                SELECT {subject_avg_column},
-                    studystream as studyclass
-                FROM results
-                WHERE {'exam_method = %(exam_method)s' if params.exam_method else '1=1'}
-                AND {'territory = %(territory)s' if params.territory else '1=1'}
-                AND {'region = %(region)s' if params.region else '1=1'}
-                AND {'name = %(school)s' if params.school else '1=1'}
-                GROUP BY studystream
-                {'HAVING AVG('+ params.subject + ') IS NOT NULL' if params.subject else ''}
-                ORDER BY studystream::int
-            ),
-        """
+    @pooled
+    def bump_data_version(self, exam_year, exam_quarter):
+        """Mark a period as changed so cached metadata and reports are reloaded, run at the end of every import"""
+        with self.conn:
+            self.cur.execute(*queries.bump_data_version_query(exam_year, exam_quarter))
+        self._invalidate_caches(exam_year, exam_quarter)
+
+    @pooled
+    def update_rate(self, rate: RateUpdate, changed_by=None):
+        """Store a corrected um_rate row as a new version and recompute only what depends on it, in one
+        transaction. Only max_point_over_all feeds derived data: the scores of the period in the columns
+        of that subject plus the average, and the /home summary. um_school_results keeps raw points
+        (normalized when read), so for it and the other reports only the cached pages are dropped.
+        Returns what was touched, None when the rate does not exist."""
+        touched = {
+            "exam_year": rate.exam_year,
+            "exam_quarter": rate.exam_quarter,
+            "subject": rate.subject,
+            "changed": sorted(rate.changes()),
+            "version": None,
+            "student_scores": 0,
+            "dashboard_summary": False,
+            "cached_reports": 0,
+        }
+        with self.conn:
+            self.cur.execute(*queries.update_rate_query(rate, changed_by))
+            row = self.cur.fetchone()
+            if row is None:
+                self.cur.execute(
+                    "SELECT version FROM um_rate WHERE exam_year = %s AND exam_quarter = %s AND subject = %s",
+                    (rate.exam_year, rate.exam_quarter, rate.subject)
+                )
+                current = self.cur.fetchone()
+                if current is None:
+                    return None
+                # Nothing actually changed
+                touched.update(version=current[0], changed=[])
+                return touched
+
+            touched["version"], max_point_changed = row
+            if not max_point_changed:
+                return touched
+
+            self.cur.execute(*queries.rescore_subject_query(rate.exam_year, rate.exam_quarter, rate.subject))
+            touched["student_scores"] = self.cur.rowcount
+            base_request = BaseRequest(examYear=rate.exam_year, examQuarter=rate.exam_quarter)
+            self.cur.execute(*queries.refresh_dashboard_summary_query(base_request))
+            touched["dashboard_summary"] = True
+            self.cur.execute(*queries.bump_data_version_query(rate.exam_year, rate.exam_quarter))
+
+        touched["cached_reports"] = self._invalidate_caches(rate.exam_year, rate.exam_quarter)
+        return touched
+
+    @pooled
+    def get_rates(self, exam_year, exam_quarter):
+        """Current rates of one period with their version history"""
+        return self._fetchone(*queries.rates_query(exam_year, exam_quarter))['result'] or []
+
+    @pooled
+    def refresh_dashboard_summaries(self, exam_year=None):
+        """Rebuild the /home payload of every period (of one exam year if given), e.g. after a teachers import"""
+        with self.conn:
+            self.cur.execute(
+                """
+                    SELECT DISTINCT exam_year, exam_quarter
+                    FROM um_rate
+                    WHERE %(exam_year)s IS NULL OR exam_year = %(exam_year)s
+                """, {"exam_year": exam_year}
+            )
+            periods = self.cur.fetchall()
 
-        # `some_subject_result` CTE
-        filter_conditions = " AND ".join(
-            f"{db_column} = %({model_field})s"
-            for model_field, db_column in {
-                "exam_method": "exam_method",
-                "study_class": "studystream",
-                "territory": "territory",
-                "region": "region",
-                "school": "name"
-            }.items() if getattr(params, model_field) is not None
-        )
-        some_subject_result_query = f"""
-            some_subject_result AS (
-                SELECT ROUND(AVG(average)::numeric, 1)   AS _avg,
-                    ROUND(AVG(math)::numeric, 1)                     AS math_avg,
-                    ROUND(AVG(mother_tongue)::numeric, 1)            AS mother_tongue_avg,
-                    ROUND(AVG(literature)::numeric, 1)               AS literature_avg,
-                    ROUND(AVG(mother_tongue_literature)::numeric, 1) AS mother_tongue_literature_avg,
-                    ROUND(AVG(russian)::numeric, 1)                  AS russian_avg,
-                    ROUND(AVG(algebra)::numeric, 1)                  AS algebra_avg,
-                    ROUND(AVG(geometry)::numeric, 1)                 AS geometry_avg,
-                    ROUND(AVG(physics)::numeric, 1)                  AS physics_avg,
-                    ROUND(AVG(biology)::numeric, 1)                  AS biology_avg,
-                    ROUND(AVG(chemistry)::numeric, 1)                AS chemistry_avg,
-                    ROUND(AVG(english)::numeric, 1)                  AS english_avg
-                FROM results
-                WHERE {filter_conditions or '1=1'}
-            ),
-        """
+        for period_year, period_quarter in periods:
+            self.refresh_dashboard_summary(period_year, period_quarter)
+        return periods
 
-        # Mapping for filter conditions in `students_filter`
-        column_map = {
-            "study_class": "studystream",
-            "territory": "territory",
-            "region": "region",
-            "school": "name"  # `school` in model maps to `name` in the database
-        }
+    @pooled
+    def insert_admins(self):
+        admin_hashed_password = bcrypt.hashpw(ADMIN_CREDENTIALS[1].encode('utf-8'), bcrypt.gensalt(rounds=10)).decode('utf-8')
+        superadmin_hashed_password = bcrypt.hashpw(SUPERADMIN_CREDENTIALS[1].encode('utf-8'), bcrypt.gensalt(rounds=10)).decode('utf-8')
 
-        # Generate `students_filter` conditions
-        students_filter_conditions = " AND ".join(
-            f"{db_column} = %({model_field})s"
-            for model_field, db_column in column_map.items()
-            if getattr(params, model_field) is not None
-        )
-        subject_condition = f"{params.subject} IS NOT NULL" if params.subject else "1=1"
-
-        # `students_filter` and `exam_method_results` CTE
-        students_filter_query = f"""
-            students_filter AS (
-                SELECT student_id, average, exam_method
-                FROM results
-                WHERE {students_filter_conditions or '1=1'} AND {subject_condition}
-            ),
-            exam_method_results AS (
-                SELECT exam_method,
-                    (SELECT COUNT(*) FROM students_filter) students_count,
-                    COUNT(*) as count,
-                    ROUND((COUNT(*)::numeric / (SELECT COUNT(*) FROM students_filter)::numeric) * 100, 1) AS percentage,
-                    ROUND(AVG(average::numeric), 1) AS result
-                FROM students_filter
-                GROUP BY exam_method
-            ),
-        """
+        with self.conn:
+            self.cur.execute(
+                """
+                    INSERT INTO um_users(username, password, role)
+                    VALUES (%s, %s, %s), (%s, %s, %s)
+                    ON CONFLICT(username) DO NOTHING;
+                """, (ADMIN_CREDENTIALS[0], admin_hashed_password, ADMIN_ROLE, 
+                      SUPERADMIN_CREDENTIALS[0], superadmin_hashed_password, SUPERADMIN_ROLE)
+            )
+            self.conn.commit()
 
-        # `students_results` CTE with dynamic group column
-        students_results_query = f"""
-            students_results AS (
-                SELECT  region as region,
-                        school_id as school_id,
-                        {params.school and 'full_name' or 'name'},
-                        ROUND(AVG(average)::numeric, 1)                  AS average,
-                        ROUND(AVG(math)::numeric, 1)                     AS math,
-                        ROUND(AVG(mother_tongue)::numeric, 1)            AS mother_tongue,
-                        ROUND(AVG(literature)::numeric, 1)               AS literature,
-                        ROUND(AVG(mother_tongue_literature)::numeric, 1) AS mother_tongue_literature,
-                        ROUND(AVG(russian)::numeric, 1)                  AS russian,
-                        ROUND(AVG(algebra)::numeric, 1)                  AS algebra,
-                        ROUND(AVG(geometry)::numeric, 1)                 AS geometry,
-                        ROUND(AVG(physics)::numeric, 1)                  AS physics,
-                        ROUND(AVG(biology)::numeric, 1)                  AS biology,
-                        ROUND(AVG(chemistry)::numeric, 1)                AS chemistry,
-                        ROUND(AVG(english)::numeric, 1)                  AS english
-                FROM results
-                WHERE {filter_conditions or '1=1'}
-                GROUP BY {params.school and 'region, school_id, student_id, full_name' or 'region, school_id, name'}
-            ),
-            limited_student_results AS (SELECT *
-                                FROM students_results
-                                LIMIT 20 OFFSET ({params.page} - 1) * 20),
-     pages AS (SELECT CEIL(COUNT(*) / 20.0)
-               FROM students_results)
-        """
+    @pooled
+    def get_admin(self, user: UserLoginBody) -> User:
+        row = self._fetchone(*queries.admin_query(user))
+        return user_from_row(row, user)
 
-        # Final query
-        query = base_query + avg_by_territory_query + subject_results_query + study_class_results_query + some_subject_result_query + students_filter_query + students_results_query + """
-            SELECT json_build_object(
-                'avg_by_territory', (SELECT json_agg(avg_by_territory) FROM avg_by_territory),
-                'subject_results', (SELECT json_agg(subject_results) FROM subject_results),
-                'study_class_results', (SELECT json_agg(study_class_results) FROM study_class_results),
-                'some_subject_result', (SELECT json_agg(some_subject_result) FROM some_subject_result),
-                'students_results', (SELECT json_agg(limited_student_results) FROM limited_student_results),
-                'exam_method_results', (SELECT json_agg(exam_method_results) FROM exam_method_results),
-                'total_pages', (SELECT * FROM pages)
-            ) AS results;
-        """
+    @pooled
+    def get_schools_by_req(self, data: SchoolListRequest):
+        trees = self.get_school_hierarchies(data.exam_year, data.quarters)
+        return hierarchy.merge_lists([hierarchy.school_names(tree, data.territory, data.region)
+                                      for tree in trees.values()], data.mode)
+    
+    @pooled
+    def get_regions_by_territory(self, region_list: RegionListRequest):
+        trees = self.get_school_hierarchies(region_list.exam_year, region_list.quarters)
+        return hierarchy.merge_lists([hierarchy.regions_of(tree, region_list.territory)
+                                      for tree in trees.values()], region_list.mode)
+
+    @pooled
+    def get_school_hierarchy(self, exam_year, exam_quarter):
+        """Territory -> region -> schools of one period, held in memory between imports (treat as read-only)"""
+        trees = self.get_school_hierarchies(exam_year, [exam_quarter])
+        return trees[exam_quarter]
+
+    @pooled
+    def get_school_hierarchies(self, exam_year, exam_quarters=None):
+        """Hierarchies of several quarters (every quarter of the year if None), the ones not in memory are loaded in one query.
+        A quarter that was never imported gets an empty tree, nothing is written or cached for it"""
+        available = (self.get_available_periods() or {}).get(exam_year, [])
+        if exam_quarters is None:
+            exam_quarters = available
+
+        versions = self._data_versions()
+        trees = {quarter: metadata_cache.get(('school_hierarchy', exam_year, quarter), copied=False)
+                 for quarter in exam_quarters}
+        missing = [quarter for quarter, tree in trees.items() if tree is None]
+        if missing:
+            payloads = self._fetchone(*queries.school_hierarchies_query(exam_year, missing))['result'] or {}
+            for quarter in missing:
+                if quarter not in payloads and quarter in available:
+                    # Period imported before the hierarchy existed, build it now
+                    row = self._fetchone(*queries.refresh_school_hierarchy_query(exam_year, quarter))
+                    payloads[quarter] = row['result']
+                trees[quarter] = hierarchy.index_hierarchy(payloads.get(quarter))
+                if quarter in payloads:
+                    metadata_cache.set(('school_hierarchy', exam_year, quarter), trees[quarter], versions, copied=False)
+        return trees
+    
+    @pooled
+    def get_available_periods(self):
+        results = self._cached_fetchone('available_periods_query', *queries.available_periods_query())
+        return results['result']
+        
+    @pooled
+    def get_available_paired_periods(self):
+        results = self._cached_fetchone('available_paired_periods_query', *queries.available_paired_periods_query())
+        return results['result']
 
-        # Execute the query
-        with self.conn:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, {
-                    "exam_year": params.exam_year,
-                    "exam_quarter": params.exam_quarter,
-                    "territory": params.territory,
-                    "school": params.school,
-                    "exam_method": params.exam_method,
-                    "study_class": params.study_class,
-                    "subject": params.subject,
-                    "region" : params.region,
-                })
-                result = cursor.fetchone()
+    @pooled
+    def get_last_year_and_quarter(self):
+        return self._cached_fetchone('last_year_and_quarter_query', *queries.last_year_and_quarter_query())
+        
+    @pooled
+    def get_base_results(self, base_request: BaseRequest):
+        results = self._fetchone(*queries.dashboard_summary_query(base_request))
+        if results is None:
+            # Period imported before the summary existed, materialize it now
+            results = self._fetchone(*queries.refresh_dashboard_summary_query(base_request))
+        return results['result']
             
-        return result['results']
+    @pooled
+    def get_school_results(self, school_request: SchoolRequest):
+        return self._fetch_page('schools', school_request, queries.school_results_query, pagination.RANKING_KEY, 'result', 'pages')
 
+    @pooled
+    def get_students_results(self, students_request: StudentRequest):
+        return self._fetch_page('students', students_request, queries.students_results_query, pagination.RANKING_KEY, 'result', 'total_pages')
+    
+    @pooled
+    def get_results(self, params: ResultRequest):
+        return self._fetch_page('results', params, queries.results_query, pagination.RESULTS_KEY, 'results', 'total_pages')
+
+    @pooled
     def get_results_table(self, params: ResultRequest):
         # Base query setup for required fields
         base_query = f"""
-            WITH rates AS (
-                SELECT max_point_over_all, subject
-                FROM um_rate
-                WHERE exam_year = %(exam_year)s
-                AND exam_quarter = %(exam_quarter)s
-            ),
-            results AS (
+            WITH results AS (
                 SELECT um_school.territory,
                     um_student_exams.name,
                     CONCAT(um_student_exams.surname, '. ', LEFT(um_student_exams.name, 1), '. ',
                             LEFT(um_student_exams.patronymic, 1), '.') AS full_name,
                     studystream,
                     exam_method,
-                    ROUND(average_point::numeric / (SELECT AVG(max_point_over_all) FROM rates) * 100,
-                                      1)                        average,
-
-                                COALESCE(
-                                        ROUND((results -> 'math_5&6' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all FROM rates WHERE subject = 'math_5&6') *
-                                              100, 1),
-                                        ROUND((results -> 'math_7' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all FROM rates WHERE subject = 'math_7') *
-                                              100, 1)
-                                )                               math,
-                                COALESCE(
-                                        ROUND((results -> 'mother_tongue_literature_7' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all
-                                               FROM rates
-                                               WHERE subject = 'mother_tongue_literature_7&6') *
-                                              100, 1),
-                                        ROUND((results -> 'mother_tongue_literature_8&10&11' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all
-                                               FROM rates
-                                               WHERE subject = 'mother_tongue_literature_8&10&11') *
-                                              100, 1)
-                                )                               mother_tongue_literature,
-                                ROUND((results -> 'literature_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'literature_5&6') * 100,
-                                      1)                        literature,
-                                ROUND((results -> 'mother_tongue_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'mother_tongue_5&6') * 100,
-                                      1)                        mother_tongue,
-                                ROUND((results -> 'russian-qaraqalpaq_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'russian-qaraqalpaq_5&6') *
-                                      100,
-                                      1)                        russian,
-                                ROUND((results -> 'chemistry_8' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'chemistry_8') * 100,
-                                      1)                        chemistry,
-                                ROUND((results -> 'biology_7' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'biology_7') * 100,
-                                      1)                        biology,
-                                ROUND((results -> 'english_9&10&11' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'english_9&10&11') * 100,
-                                      1)                        english,
-                                ROUND((results -> 'physics_9' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'physics_9') * 100,
-                                      1)                        physics,
-                                ROUND((results -> 'algebra_8&9&10&11' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'algebra_8&9&10&11') * 100,
-                                      1)                        algebra,
-                                ROUND((results -> 'geometry_8&9&10&11' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'geometry_8&9&10&11') * 100,
-                                      1)                        geometry
+                    um_student_scores.average,
+                    um_student_scores.math,
+                    um_student_scores.mother_tongue_literature,
+                    um_student_scores.literature,
+                    um_student_scores.mother_tongue,
+                    um_student_scores.russian,
+                    um_student_scores.chemistry,
+                    um_student_scores.biology,
+                    um_student_scores.english,
+                    um_student_scores.physics,
+                    um_student_scores.algebra,
+                    um_student_scores.geometry
                 FROM um_student_exams
                 LEFT JOIN um_school ON um_student_exams.school_id = um_school.id
-                WHERE exam_quarter = %(exam_quarter)s
-                AND exam_year = %(exam_year)s
+                JOIN um_student_scores ON um_student_scores.id = um_student_exams.id
+                                      AND um_student_scores.exam_year = um_student_exams.exam_year
+                                      AND um_student_scores.exam_quarter = um_student_exams.exam_quarter
+                WHERE um_student_exams.exam_quarter = %(exam_quarter)s
+                AND um_student_exams.exam_year = %(exam_year)s
             ),
             students_results AS (SELECT name,
                                  ROUND(AVG(average)::numeric, 1)                  AS average,
@@ -1118,252 +1050,94 @@ SELECT JSON_BUILD_OBJECT('school_results', (SELECT JSON_AGG(limited_school_resul
                FROM students_results)
         """
 
-    def get_compare_results(self, params: ResultRequest):
-        # Base query setup for required fields
-        base_query = f"""
-            WITH rates AS (
-                SELECT max_point_over_all, subject
-                FROM um_rate
-                WHERE exam_year = %(exam_year)s
-                AND exam_quarter = %(exam_quarter)s
-            ),
-            results AS (
-                SELECT um_school.territory,
-                    um_school.region,
-                    um_school.id as school_id,
-                    um_school.name,
-                    um_student_exams.student_id,
-                    CONCAT(um_student_exams.surname, '. ', LEFT(um_student_exams.name, 1), '. ',
-                            LEFT(um_student_exams.patronymic, 1), '.') AS full_name,
-                    studystream,
-                    exam_method,
-                    ROUND(average_point::numeric / (SELECT AVG(max_point_over_all) FROM rates) * 100,
-                                      1)                        average,
-
-                                COALESCE(
-                                        ROUND((results -> 'math_5&6' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all FROM rates WHERE subject = 'math_5&6') *
-                                              100, 1),
-                                        ROUND((results -> 'math_7' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all FROM rates WHERE subject = 'math_7') *
-                                              100, 1)
-                                )                               math,
-                                COALESCE(
-                                        ROUND((results -> 'mother_tongue_literature_7' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all
-                                               FROM rates
-                                               WHERE subject = 'mother_tongue_literature_7&6') *
-                                              100, 1),
-                                        ROUND((results -> 'mother_tongue_literature_8&10&11' ->> 'all_point')::numeric /
-                                              (SELECT max_point_over_all
-                                               FROM rates
-                                               WHERE subject = 'mother_tongue_literature_8&10&11') *
-                                              100, 1)
-                                )                               mother_tongue_literature,
-                                ROUND((results -> 'literature_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'literature_5&6') * 100,
-                                      1)                        literature,
-                                ROUND((results -> 'mother_tongue_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'mother_tongue_5&6') * 100,
-                                      1)                        mother_tongue,
-                                ROUND((results -> 'russian-qaraqalpaq_5&6' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'russian-qaraqalpaq_5&6') *
-                                      100,
-                                      1)                        russian,
-                                ROUND((results -> 'chemistry_8' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'chemistry_8') * 100,
-                                      1)                        chemistry,
-                                ROUND((results -> 'biology_7' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'biology_7') * 100,
-                                      1)                        biology,
-                                ROUND((results -> 'english_9&10&11' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'english_9&10&11') * 100,
-                                      1)                        english,
-                                ROUND((results -> 'physics_9' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'physics_9') * 100,
-                                      1)                        physics,
-                                ROUND((results -> 'algebra_8&9&10&11' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'algebra_8&9&10&11') * 100,
-                                      1)                        algebra,
-                                ROUND((results -> 'geometry_8&9&10&11' ->> 'all_point')::numeric /
-                                      (SELECT max_point_over_all FROM rates WHERE subject = 'geometry_8&9&10&11') * 100,
-                                      1)                        geometry
-                FROM um_student_exams
-                LEFT JOIN um_school ON um_student_exams.school_id = um_school.id
-                WHERE exam_quarter = %(exam_quarter)s
-                AND exam_year = %(exam_year)s
-            ),
-        """
-
-        # Define avg_column
-        avg_column = f"AVG({params.subject})" if params.subject else "AVG(average)"
-        
-        # `avg_by_territory` CTE with fallback conditions
-        avg_by_territory_query = f"""
-            avg_by_territory AS (
-                SELECT {'territory as key' if not params.territory else 'name as key' }, 
-                    ROUND({avg_column}::numeric, 1) AS data
-                FROM results
-                WHERE {'exam_method = %(exam_method)s' if params.exam_method else '1=1'}
-                AND {'studystream = %(study_class)s' if params.study_class else '1=1'}
-                AND {'territory = %(territory)s' if params.territory else '1=1'}
-                AND {'region = %(region)s' if params.region else '1=1'}
-                GROUP BY {'territory' if not params.territory else 'school_id, name'}
-                HAVING {avg_column} IS NOT NULL
-                ORDER BY {avg_column}
-            ),
-        """
-
-        # Define subject avg fields
-        avg_fields = f"ROUND(AVG({params.subject})::numeric, 1) AS {params.subject}_avg" if params.subject else """
-            ROUND(AVG(average)::numeric, 1)   AS _avg,
-            ROUND(AVG(math)::numeric, 1)                     AS math_avg,
-            ROUND(AVG(mother_tongue)::numeric, 1)            AS mother_tongue_avg,
-            ROUND(AVG(literature)::numeric, 1)               AS literature_avg,
-            ROUND(AVG(mother_tongue_literature)::numeric, 1) AS mother_tongue_literature_avg,
-            ROUND(AVG(russian)::numeric, 1)                  AS russian_avg,
-            ROUND(AVG(algebra)::numeric, 1)                  AS algebra_avg,
-            ROUND(AVG(geometry)::numeric, 1)                 AS geometry_avg,
-            ROUND(AVG(physics)::numeric, 1)                  AS physics_avg,
-            ROUND(AVG(biology)::numeric, 1)                  AS biology_avg,
-            ROUND(AVG(chemistry)::numeric, 1)                AS chemistry_avg,
-            ROUND(AVG(english)::numeric, 1)                  AS english_avg
-        """
-        
-        # `subject_results` CTE with fallback grouping
-        subject_results_query = f"""
-            subject_results AS (
-                SELECT {avg_fields}
-                FROM results
-                WHERE {'exam_method = %(exam_method)s' if params.exam_method else '1=1'}
-                AND {'studystream = %(study_class)s' if params.study_class else '1=1'}
-                AND {'territory = %(territory)s' if params.territory else '1=1'}
-                AND {'region = %(region)s' if params.region else '1=1'}
-                AND {'name = %(school)s' if params.school else '1=1'}
-            ),
-        """
-
-        subject_avg_column = f"ROUND(AVG({params.subject})::numeric, 1) AS avg" if params.subject else "ROUND(AVG(average)::numeric, 1) AS avg"
-
-        study_class_results_query = f"""
-            study_class_results AS (
-                SELECT {subject_avg_column},
-                    studystream as studyclass
-                FROM results
-                WHERE {'exam_method = %(exam_method)s' if params.exam_method else '1=1'}
-                AND {'territory = %(territory)s' if params.territory else '1=1'}
-                AND {'region = %(region)s' if params.region else '1=1'}
-                AND {'name = %(school)s' if params.school else '1=1'}
-                GROUP BY studystream
-                {'HAVING AVG('+ params.subject + ') IS NOT NULL' if params.subject else ''}
-                ORDER BY studystream::int
-            ),
-        """
-
-        column_map = {
-            "study_class": "studystream",
-            "territory": "territory",
-            "region": "region",
-            "school": "name"  # `school` in model maps to `name` in the database
-        }
+    @pooled
+    def get_compare_results(self, params: CompareRequest, exam_quarters):
+        result = self._fetchone(*queries.compare_results_query(params, exam_quarters))
+        return result['results']
 
-        students_filter_conditions = " AND ".join(
-            f"{db_column} = %({model_field})s"
-            for model_field, db_column in column_map.items()
-            if getattr(params, model_field) is not None
-        )
-        subject_condition = f"{params.subject} IS NOT NULL" if params.subject else "1=1"
-
-        # `students_filter` and `exam_method_results` CTE
-        students_filter_query = f"""
-            students_filter AS (
-                SELECT student_id, average, exam_method
-                FROM results
-                WHERE {students_filter_conditions or '1=1'} AND {subject_condition}
-            ),
-            exam_method_results AS (
-                SELECT exam_method,
-                    (SELECT COUNT(*) FROM students_filter) students_count,
-                    COUNT(*) as count,
-                    ROUND((COUNT(*)::numeric / (SELECT COUNT(*) FROM students_filter)::numeric) * 100, 1) AS percentage,
-                    ROUND(AVG(average::numeric), 1) AS result
-                FROM students_filter
-                GROUP BY exam_method
-            ),
-        """
+    @pooled
+    def get_available_territories_classes(self):
+        result = self._cached_fetchone('available_territories_classes_query', *queries.available_territories_classes_query())
+        return result['result']
+
+    @pooled
+    def create_import_job(self, kind, filename, exam_year, exam_quarter=None):
+        row = self._fetchone(*queries.create_import_job_query(kind, filename, exam_year, exam_quarter))
+        return row['id']
+
+    @pooled
+    def get_import_job(self, job_id):
+        row = self._fetchone(*queries.import_job_query(job_id))
+        return row['result'] if row else None
+
+    def claim_import_job(self):
+        """Take the oldest queued job, or a running one whose worker is gone, None when there is none.
+        The job stays locked by a session advisory lock until release_import_job, so the PgConn has to
+        be bound to a connection kept for the whole job"""
+        if self.conn is None:
+            raise RuntimeError("claim_import_job needs a PgConn bound to the connection of the job")
 
-        # `some_subject_result` CTE
-        filter_conditions = " AND ".join(
-            f"{db_column} = %({model_field})s"
-            for model_field, db_column in {
-                "exam_method": "exam_method",
-                "study_class": "studystream",
-                "territory": "territory",
-                "region": "region",
-                "school": "name"
-            }.items() if getattr(params, model_field) is not None
-        )
-        some_subject_result_query = f"""
-            some_subject_result AS (
-                SELECT ROUND(AVG(average)::numeric, 1)   AS _avg,
-                    ROUND(AVG(math)::numeric, 1)                     AS math_avg,
-                    ROUND(AVG(mother_tongue)::numeric, 1)            AS mother_tongue_avg,
-                    ROUND(AVG(literature)::numeric, 1)               AS literature_avg,
-                    ROUND(AVG(mother_tongue_literature)::numeric, 1) AS mother_tongue_literature_avg,
-                    ROUND(AVG(russian)::numeric, 1)                  AS russian_avg,
-                    ROUND(AVG(algebra)::numeric, 1)                  AS algebra_avg,
-                    ROUND(AVG(geometry)::numeric, 1)                 AS geometry_avg,
-                    ROUND(AVG(physics)::numeric, 1)                  AS physics_avg,
-                    ROUND(AVG(biology)::numeric, 1)                  AS biology_avg,
-                    ROUND(AVG(chemistry)::numeric, 1)                AS chemistry_avg,
-                    ROUND(AVG(english)::numeric, 1)                  AS english_avg
-                FROM results
-                WHERE {filter_conditions or '1=1'}
-            )
-        """
+        with self.conn:
+            self.cur.execute(*queries.claimable_import_jobs_query())
+            job_ids = [job_id for (job_id,) in self.cur.fetchall()]
+        for job_id in job_ids:
+            if not self._fetchone(*queries.lock_import_job_query(job_id))['locked']:
+                continue
+            job = self._fetchone(*queries.claim_import_job_query(job_id))
+            if job is not None:
+                return job
+            self.release_import_job(job_id)
+        return None
 
-        # Final query
-        query = base_query + avg_by_territory_query + subject_results_query + study_class_results_query + students_filter_query + some_subject_result_query + """
-            SELECT json_build_object(
-                'avg_by_territory', (SELECT json_agg(avg_by_territory) FROM avg_by_territory),
-                'subject_results', (SELECT json_agg(subject_results) FROM subject_results),
-                'study_class_results', (SELECT json_agg(study_class_results) FROM study_class_results),
-                'some_subject_result', (SELECT json_agg(some_subject_result) FROM some_subject_result),
-                'exam_method_results', (SELECT json_agg(exam_method_results) FROM exam_method_results)
-            ) AS results;
-        """
+    def release_import_job(self, job_id):
+        self._fetchone(*queries.unlock_import_job_query(job_id))
 
-        # Execute the query
+    @pooled
+    def update_import_job(self, job_id, **progress):
         with self.conn:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, {
-                    "exam_year": params.exam_year,
-                    "exam_quarter": params.exam_quarter,
-                    "territory": params.territory,
-                    "school": params.school,
-                    "exam_method": params.exam_method,
-                    "study_class": params.study_class,
-                    "region": params.region,
-                    "subject": params.subject
-                })
-                result = cursor.fetchone()
-            
-        return result['results']
-
-    def get_available_territories_classes(self):
-        query = """
-            WITH all_territories AS (SELECT DISTINCT territory as territories
-                                    FROM um_school),
-                all_classes AS (SELECT DISTINCT CAST(studystream as INT) as classes
-                                FROM um_student_exams
-                                ORDER BY CAST(studystream as INT)) 
-            SELECT JSON_BUILD_OBJECT('all_territories', (SELECT JSON_AGG(territories) FROM all_territories),
-                'all_classes', (SELECT JSON_AGG(classes) FROM all_classes)) AS result;
-            """     
+            self.cur.execute(*queries.update_import_job_query(job_id, **progress))
+
+    @staticmethod
+    def _invalidate_caches(exam_year, exam_quarter):
+        # Other processes notice the bumped um_data_version, this one drops its entries right away
+        metadata_cache.invalidate()
+        pagination.page_counts.clear()
+        return result_cache.invalidate_period(exam_year, exam_quarter)
+
+    def _data_versions(self):
+        # um_data_version stamps, re-read at most every METADATA_CHECK_INTERVAL seconds
+        if metadata_cache.needs_check():
+            metadata_cache.update_versions(self._fetchone(*queries.data_versions_query())['versions'])
+        return metadata_cache.versions
+
+    def _fetch_page(self, kind, request, build_query, key_types, result_field, pages_field):
+        # Reports only change with an import, see db.result_cache
+        versions = self._data_versions()
+        cache_key = result_cache.result_key(kind, request, versions)
+        page = result_cache.get(cache_key)
+        if page is None:
+            query, key, total_pages = pagination.paged_query(kind, request, build_query, key_types, versions)
+            row = self._fetchone(*query)
+            page = pagination.finish_page(row[result_field], key, total_pages, pages_field)
+            result_cache.put(cache_key, page)
+        return page
+
+    def _cached_fetchone(self, name, query, params=None):
+        # Metadata only changes with an import, see db.metadata
+        versions = self._data_versions()
+        row = metadata_cache.get(name)
+        if row is None:
+            row = self._fetchone(query, params)
+            metadata_cache.set(name, row, versions)
+        return row
+
+    def _fetchone(self, query, params=None):
         with self.conn:
             with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query)
-                result = cursor.fetchone()
-
-
-        return result['result']
\ No newline at end of file
+                started = time.perf_counter()
+                cursor.execute(query, params)
+                row = cursor.fetchone()
+                if instrumentation.observe_query(query, row, cursor.rowcount, time.perf_counter() - started):
+                    cursor.execute(instrumentation.explain_query(query), params)
+                    instrumentation.attach_explain(cursor.fetchone()['QUERY PLAN'])
+                return row
@@ -0,0 +1,43 @@
+""" This module serves the territory -> region -> school lookups from the per-period hierarchy"""
+
+
+def index_hierarchy(payload):
+    """Turn the stored [{territory, regions: [{region, schools}]}] payload into nested dicts, keeping the order"""
+    return {
+        territory['territory']: {region['region']: region['schools'] for region in territory['regions']}
+        for territory in payload or []
+    }
+
+
+def regions_of(tree, territory):
+    regions = tree.get(territory)
+    return list(regions) if regions else None
+
+
+def school_names(tree, territory, region):
+    schools = tree.get(territory, {}).get(region)
+    # Different schools may share a name, the lists only show names
+    return list(dict.fromkeys(school['name'] for school in schools)) if schools else None
+
+
+def subtree(tree, territory=None, region=None):
+    if territory is None:
+        return tree
+    regions = tree.get(territory, {})
+    if region is None:
+        return {territory: regions}
+    return {territory: {region: regions[region]} if region in regions else {}}
+
+
+def merge_lists(lists, mode):
+    """Combine per-quarter lists, quarters without data are ignored: every value seen (union) or
+    only the values all of them share (intersection)"""
+    lists = [values for values in lists if values]
+    if not lists:
+        return None
+    if mode == "intersection":
+        common = set(lists[0]).intersection(*lists[1:])
+        merged = [value for value in lists[0] if value in common]
+    else:
+        merged = sorted(set().union(*lists))
+    return merged or None
@@ -0,0 +1,232 @@
+""" This module times the PgConn / AsyncPgConn query methods and keeps a slow-query log and per-method histograms"""
+
+import asyncio
+import bisect
+import inspect
+import json
+import logging
+import re
+import threading
+import time
+from contextvars import ContextVar
+from functools import wraps
+from itertools import islice
+
+import pandas as pd
+from pydantic import BaseModel
+
+from config.config import SLOW_QUERY_MS, QUERY_EXPLAIN_THRESHOLD_MS, QUERY_EXPLAIN_INTERVAL
+
+slow_query_logger = logging.getLogger("db.slow_queries")
+
+# Upper bounds (ms) of the histogram buckets, the last bucket catches everything slower
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_READ_ONLY = re.compile(r"^\s*(WITH|SELECT)\b", re.IGNORECASE)
+_WRITES = re.compile(r"\b(INSERT|UPDATE|DELETE|TRUNCATE)\b", re.IGNORECASE)
+
+# Bounds of a logged parameter: items of a list or tuple, items shown of a set, characters of a text
+MAX_PARAM_ITEMS = 20
+MAX_SET_ITEMS = 5
+MAX_PARAM_CHARS = 200
+
+_current_call = ContextVar("current_query_call", default=None)
+
+
+class QueryCall:
+    """What one instrumented method call did, filled in by the _fetchone of the connection class.
+    A method calling another instrumented one (e.g. get_school_hierarchies calling
+    get_available_periods) counts the queries of the inner call in its own totals as well"""
+    def __init__(self, method, params, parent=None):
+        self.method = method
+        self.params = params
+        self.parent = parent
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.rows = 0
+        self.bytes = 0
+        self.explain = None
+
+
+class QueryStats:
+    """Per-method wall time histograms plus row and byte totals"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods = {}
+        self._last_explain = {}
+
+    def record(self, call, elapsed_ms):
+        with self._lock:
+            stats = self._methods.get(call.method)
+            if stats is None:
+                stats = self._methods[call.method] = {
+                    "count": 0,
+                    "slow": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "rows": 0,
+                    "bytes": 0,
+                    "buckets": [0] * (len(BUCKETS_MS) + 1),
+                }
+            stats["count"] += 1
+            stats["slow"] += elapsed_ms >= SLOW_QUERY_MS
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            stats["rows"] += call.rows
+            stats["bytes"] += call.bytes
+            stats["buckets"][bisect.bisect_left(BUCKETS_MS, elapsed_ms)] += 1
+
+    def should_explain(self, method):
+        # ANALYZE runs the query a second time, so capture at most one plan per method and interval
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_explain.get(method)
+            if last is not None and now - last < QUERY_EXPLAIN_INTERVAL:
+                return False
+            self._last_explain[method] = now
+            return True
+
+    def snapshot(self):
+        labels = [f"<={bound}ms" for bound in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}ms"]
+        with self._lock:
+            methods = {name: dict(stats) for name, stats in self._methods.items()}
+        for stats in methods.values():
+            stats["avg_ms"] = round(stats["total_ms"] / stats["count"], 3)
+            stats["total_ms"] = round(stats["total_ms"], 3)
+            stats["max_ms"] = round(stats["max_ms"], 3)
+            stats["buckets"] = dict(zip(labels, stats["buckets"]))
+        return methods
+
+    def reset(self):
+        with self._lock:
+            self._methods.clear()
+            self._last_explain.clear()
+
+
+query_stats = QueryStats()
+
+
+def _truncate(text):
+    return text if len(text) <= MAX_PARAM_CHARS else text[:MAX_PARAM_CHARS] + f"... ({len(text)} chars)"
+
+
+def normalize_params(args, kwargs):
+    """JSON-friendly view of the call arguments for the log, request models without their unset
+    filters and without passwords. Long lists and texts are cut, sets show their size and first
+    items and data frames only their size, so bulk calls (changed ids, loaded rows) stay one line"""
+    def normalize(value):
+        if isinstance(value, BaseModel):
+            value = value.model_dump(exclude_none=True)
+        if isinstance(value, dict):
+            return {key: "***" if "password" in str(key) else normalize(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            items = [normalize(item) for item in value[:MAX_PARAM_ITEMS]]
+            if len(value) > MAX_PARAM_ITEMS:
+                items.append(f"... ({len(value) - MAX_PARAM_ITEMS} more)")
+            return items
+        if isinstance(value, (set, frozenset)):
+            return {"size": len(value), "first": [normalize(item) for item in islice(value, MAX_SET_ITEMS)]}
+        if isinstance(value, pd.DataFrame):
+            return f"<DataFrame rows={len(value)}>"
+        if isinstance(value, str):
+            return _truncate(value)
+        if value is None or isinstance(value, (int, float, bool)):
+            return value
+        return _truncate(repr(value))
+
+    params = [normalize(arg) for arg in args]
+    if kwargs:
+        params.append(normalize(kwargs))
+    return params
+
+
+def _finish(call, failed):
+    elapsed_ms = (time.perf_counter() - call.started) * 1000
+    query_stats.record(call, elapsed_ms)
+
+    if elapsed_ms >= SLOW_QUERY_MS or call.explain is not None:
+        slow_query_logger.warning(json.dumps({
+            "method": call.method,
+            "params": call.params,
+            "elapsed_ms": round(elapsed_ms, 3),
+            "queries": call.queries,
+            "rows": call.rows,
+            "bytes": call.bytes,
+            "failed": failed,
+            "explain": call.explain,
+        }, default=str, ensure_ascii=False))
+
+
+def instrumented(method):
+    """Time every call of `method` and collect what its queries returned"""
+    name = method.__qualname__
+
+    if asyncio.iscoroutinefunction(method):
+        @wraps(method)
+        async def async_wrapper(self, *args, **kwargs):
+            call = QueryCall(name, normalize_params(args, kwargs), _current_call.get())
+            token = _current_call.set(call)
+            failed = True
+            try:
+                result = await method(self, *args, **kwargs)
+                failed = False
+                return result
+            finally:
+                _current_call.reset(token)
+                _finish(call, failed)
+        return async_wrapper
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        call = QueryCall(name, normalize_params(args, kwargs), _current_call.get())
+        token = _current_call.set(call)
+        failed = True
+        try:
+            result = method(self, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            _current_call.reset(token)
+            _finish(call, failed)
+    return wrapper
+
+
+def instrument_methods(cls):
+    """Class decorator applying `instrumented` to every public method. Async generators (streamed
+    exports) are left alone, a call only creates the generator so there is nothing to time"""
+    for name, attr in list(vars(cls).items()):
+        if not name.startswith("_") and callable(attr) and not inspect.isasyncgenfunction(attr):
+            setattr(cls, name, instrumented(attr))
+    return cls
+
+
+def observe_query(query, row, rowcount, elapsed):
+    """Account one executed query to the current call, returns True when its plan should be captured"""
+    call = _current_call.get()
+    if call is None:
+        return False
+
+    size = len(json.dumps(row, default=str)) if row is not None else 0
+    outer = call
+    while outer is not None:
+        outer.queries += 1
+        outer.rows += max(rowcount, 0)
+        outer.bytes += size
+        outer = outer.parent
+
+    if QUERY_EXPLAIN_THRESHOLD_MS is None or elapsed * 1000 < QUERY_EXPLAIN_THRESHOLD_MS:
+        return False
+    # EXPLAIN ANALYZE executes the statement, never do it for anything that writes
+    if not _READ_ONLY.match(query) or _WRITES.search(query):
+        return False
+    return query_stats.should_explain(call.method)
+
+
+def explain_query(query):
+    return "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query
+
+
+def attach_explain(plan):
+    call = _current_call.get()
+    if call is not None:
+        call.explain = plan
@@ -0,0 +1,56 @@
+""" This module caches the lookups behind the page filters (periods, territories, classes) between imports"""
+
+import copy
+import threading
+import time
+
+from config.config import METADATA_CHECK_INTERVAL
+
+
+class MetadataCache:
+    """Process-wide cache of metadata rows, tagged with the um_data_version stamps they were read under.
+
+    The stamps are re-read at most every `check_interval` seconds; once an import bumps one of them
+    every entry is dropped and reloaded on next use.
+    """
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._versions = None
+        self._checked_at = None
+
+    @property
+    def versions(self):
+        return self._versions
+
+    def needs_check(self):
+        return self._checked_at is None or time.monotonic() - self._checked_at >= self.check_interval
+
+    def update_versions(self, versions):
+        with self._lock:
+            self._checked_at = time.monotonic()
+            if versions != self._versions:
+                self._versions = versions
+                self._entries.clear()
+
+    def get(self, name, copied=True):
+        with self._lock:
+            value = self._entries.get(name)
+        # Handlers are free to modify what they get back, unless the caller only reads it
+        return copy.deepcopy(value) if copied else value
+
+    def set(self, name, value, versions, copied=True):
+        with self._lock:
+            # Skip rows read while an import bumped the versions
+            if versions == self._versions:
+                self._entries[name] = copy.deepcopy(value) if copied else value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions = None
+            self._checked_at = None
+
+
+metadata_cache = MetadataCache(METADATA_CHECK_INTERVAL)
@@ -0,0 +1,90 @@
+""" This module holds the helpers for cursor (keyset) pagination of the ranking queries"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+
+from config.config import PAGE_COUNT_CACHE_SIZE, PAGE_COUNT_TTL, SECRET_KEY
+from utils.cache import LRUCache
+
+PAGE_SIZE = 20
+
+# Total page count per filter set, so only the first page of a ranking pays for COUNT(*)
+page_counts = LRUCache(maxsize=PAGE_COUNT_CACHE_SIZE, ttl=PAGE_COUNT_TTL)
+
+# Cursors are signed so a client cannot hand the seek filter a row key of its own. Without a SECRET_KEY
+# the key is per process: a cursor of another worker falls back to OFFSET paging
+CURSOR_KEY = SECRET_KEY.encode("utf-8") if SECRET_KEY else os.urandom(32)
+
+# Types of the row key parts, a JSON number for the score and the id text
+NUMBER = (int, float)
+RANKING_KEY = (NUMBER, str)
+RESULTS_KEY = (str,)
+
+
+def page_count_key(kind, request, versions):
+    """Cache key of a ranking: the request filters without the page position plus the um_data_version
+    of its period, so a re-import in another process makes the old page counts unreachable"""
+    version = (versions or {}).get(f"{request.exam_year}-{request.exam_quarter}")
+    filters = request.model_dump(exclude={"page", "cursor"})
+    return (kind, version, tuple(sorted(filters.items())))
+
+
+def _signature(row_key, key):
+    message = json.dumps([row_key, repr(key)]).encode("utf-8")
+    return hmac.new(CURSOR_KEY, message, hashlib.sha256).hexdigest()[:32]
+
+
+def encode_cursor(row_key, key):
+    """Opaque cursor pointing after `row_key` (the sort key of the last row of a page)"""
+    raw = json.dumps({"k": row_key, "s": _signature(row_key, key)}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def _has_types(row_key, key_types):
+    return (isinstance(row_key, list) and len(row_key) == len(key_types) and
+            all(isinstance(value, types) and not isinstance(value, bool)
+                for value, types in zip(row_key, key_types)))
+
+
+def decode_cursor(cursor, key, key_types):
+    """Return the row key stored in `cursor`, or None when the cursor is missing, malformed, not
+    signed by this server, issued for other filters or holds parts of other types than `key_types`,
+    in which case the query falls back to OFFSET paging"""
+    if not cursor:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        row_key, signature = payload["k"], payload["s"]
+    except (ValueError, TypeError, KeyError):
+        return None
+
+    if not isinstance(signature, str) or not _has_types(row_key, key_types):
+        return None
+    if not hmac.compare_digest(signature, _signature(row_key, key)):
+        return None
+    return row_key
+
+
+def finish_page(result, key, total_pages, pages_field):
+    """Fill in the (cached) page count and turn the last row key into the next page cursor"""
+    if total_pages is None:
+        total_pages = result.get(pages_field)
+        if total_pages is not None:
+            page_counts.set(key, total_pages)
+    result[pages_field] = total_pages
+
+    row_key = result.get('next_cursor')
+    result['next_cursor'] = encode_cursor(row_key, key) if row_key else None
+    return result
+
+
+def paged_query(kind, request, build_query, key_types, versions):
+    """Build a ranking query that seeks past the request cursor and skips the COUNT(*) when the
+    page count of its filters is cached. Returns ((query, params), cache key, cached page count)"""
+    key = page_count_key(kind, request, versions)
+    total_pages = page_counts.get(key)
+    after = decode_cursor(request.cursor, key, key_types)
+    return build_query(request, total_pages is None, after), key, total_pages
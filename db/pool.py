@@ -0,0 +1,150 @@
+""" This module holds the process-wide PostgreSQL connection pool used by PgConn"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+from config.config import (POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT,
+                           DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTH_CHECK_INTERVAL)
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out within the pool timeout"""
+
+
+class PgPool:
+    """Thread-safe connection pool with checkout timeouts, health checks and usage stats"""
+    def __init__(self, minconn, maxconn, timeout, health_check_interval, **conn_kwargs):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._pool = ThreadedConnectionPool(minconn, maxconn, **conn_kwargs)
+        # psycopg2's pool raises immediately when exhausted, the semaphore makes callers wait instead
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._stats = {
+            "checkouts": 0,
+            "checkins": 0,
+            "timeouts": 0,
+            "failed_health_checks": 0,
+            "in_use": 0,
+            "max_in_use": 0,
+            "total_wait_ms": 0.0,
+        }
+
+    def getconn(self, timeout=None):
+        """Borrow a healthy connection, waiting at most `timeout` seconds for a free slot"""
+        timeout = self.timeout if timeout is None else timeout
+        started = time.perf_counter()
+
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolTimeout(f"No database connection available after {timeout} seconds")
+
+        try:
+            conn = self._pool.getconn()
+            if not self._is_healthy(conn):
+                with self._lock:
+                    self._stats["failed_health_checks"] += 1
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+            self._stats["max_in_use"] = max(self._stats["max_in_use"], self._stats["in_use"])
+            self._stats["total_wait_ms"] += (time.perf_counter() - started) * 1000
+        return conn
+
+    def putconn(self, conn):
+        """Return a connection to the pool, discarding it if it is broken"""
+        close = bool(conn.closed)
+        if not close:
+            try:
+                # Never hand out a connection with a half-finished transaction
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        with self._lock:
+            self._last_used[id(conn)] = time.monotonic()
+            self._stats["checkins"] += 1
+            self._stats["in_use"] -= 1
+
+        self._pool.putconn(conn, close=close)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["max_size"] = self.maxconn
+        stats["idle"] = len(self._pool._pool)
+        stats["avg_wait_ms"] = round(stats["total_wait_ms"] / stats["checkouts"], 3) if stats["checkouts"] else 0.0
+        return stats
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        # Only ping connections that have been idle long enough to have been dropped by the server
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = PgPool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTH_CHECK_INTERVAL,
+                               database=POSTGRES_DB, user=POSTGRES_USER, password=POSTGRES_PASSWORD,
+                               host=POSTGRES_HOST, port=POSTGRES_PORT)
+                logger.info("Created database pool (min=%s, max=%s)", DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE)
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
@@ -0,0 +1,1566 @@
+""" This module builds the SQL (and its parameters) shared by the sync and async database layers"""
+
+from models.models import SchoolRequest, StudentRequest, ResultRequest, BaseRequest, UserLoginBody, CompareRequest, RateUpdate
+from utils.const import ADMIN_ROLE, SUPERADMIN_ROLE, score_subjects, point_types
+from db.pagination import PAGE_SIZE
+
+
+def admin_query(user: UserLoginBody):
+    query = """
+        SELECT id, username, password, created_at, last_login, role
+        FROM um_users
+        WHERE username = %s AND role IN (%s, %s)
+    """
+    return query, (user.username, SUPERADMIN_ROLE, ADMIN_ROLE)
+
+
+def school_hierarchies_query(exam_year, exam_quarters):
+    query = """
+        SELECT JSON_OBJECT_AGG(exam_quarter, payload) AS result
+        FROM um_school_hierarchy
+        WHERE exam_year = %(exam_year)s
+          AND exam_quarter = ANY(%(exam_quarters)s);
+    """
+    return query, {
+        "exam_year": exam_year,
+        "exam_quarters": list(exam_quarters),
+    }
+
+
+def refresh_school_hierarchy_query(exam_year, exam_quarter, exams_table="um_student_exams"):
+    """Rebuild the territory -> region -> schools tree of the schools that took part in one period,
+    read from `exams_table` like refresh_student_scores_query"""
+    query = f"""
+        WITH schools AS (SELECT DISTINCT um_school.territory, um_school.region, um_school.id, um_school.name
+                         FROM {exams_table} AS um_student_exams
+                                  JOIN um_school ON um_student_exams.school_id = um_school.id
+                         WHERE um_student_exams.exam_year = %(exam_year)s
+                           AND um_student_exams.exam_quarter = %(exam_quarter)s),
+             regions AS (SELECT territory,
+                                region,
+                                JSON_AGG(JSON_BUILD_OBJECT('id', id, 'name', name) ORDER BY name, id) AS schools
+                         FROM schools
+                         GROUP BY territory, region),
+             territories AS (SELECT territory,
+                                    JSON_AGG(JSON_BUILD_OBJECT('region', region, 'schools', schools)
+                                             ORDER BY region) AS regions
+                             FROM regions
+                             GROUP BY territory)
+        INSERT INTO um_school_hierarchy (exam_year, exam_quarter, payload, refreshed_at)
+        SELECT %(exam_year)s,
+               %(exam_quarter)s,
+               COALESCE(JSON_AGG(JSON_BUILD_OBJECT('territory', territory, 'regions', regions) ORDER BY territory),
+                        '[]'),
+               CURRENT_TIMESTAMP
+        FROM territories
+        ON CONFLICT (exam_year, exam_quarter) DO UPDATE SET
+            payload = EXCLUDED.payload,
+            refreshed_at = EXCLUDED.refreshed_at
+        RETURNING payload AS result;
+    """
+    return query, {
+        "exam_year": exam_year,
+        "exam_quarter": exam_quarter,
+    }
+
+
+def available_periods_query():
+    query = """
+        WITH periods AS (
+            SELECT DISTINCT exam_year, exam_quarter
+            FROM um_rate
+        ),
+        grouped_periods AS (
+            SELECT exam_year, JSON_AGG(exam_quarter ORDER BY exam_quarter) AS quarters
+            FROM periods
+            GROUP BY exam_year
+            ORDER BY exam_year DESC
+        )
+        SELECT JSON_OBJECT_AGG(exam_year, quarters) AS result
+        FROM grouped_periods;
+    """
+    return query, None
+
+
+def available_paired_periods_query():
+    query = """
+        WITH periods AS (
+            SELECT DISTINCT exam_year, exam_quarter
+            FROM um_rate
+        ),
+        grouped_periods AS (
+            SELECT exam_year, JSON_AGG(exam_quarter ORDER BY exam_quarter) AS quarters
+            FROM periods
+            GROUP BY exam_year
+            HAVING COUNT(exam_quarter) > 1
+            ORDER BY exam_year DESC
+        )
+        SELECT JSON_OBJECT_AGG(exam_year, quarters) AS result
+        FROM grouped_periods;
+    """
+    return query, None
+
+
+def last_year_and_quarter_query():
+    query = """
+        SELECT exam_year, exam_quarter
+        FROM um_rate
+        ORDER BY exam_year DESC, exam_quarter DESC
+        LIMIT 1;
+    """
+    return query, None
+
+
+def base_results_query(base_request: BaseRequest, exams_table="um_student_exams"):
+    query = f"""
+        WITH results AS (SELECT *
+         FROM {exams_table}
+         WHERE exam_year = %(exam_year)s
+           AND exam_quarter = %(exam_quarter)s),
+rates AS (SELECT max_point_over_all, subject
+       FROM um_rate
+       WHERE exam_year = %(exam_year)s
+         AND exam_quarter = %(exam_quarter)s),
+all_count AS (SELECT COUNT(*) AS count
+           FROM results),
+exam_methods_data AS (SELECT exam_method,
+                          COUNT(*) AS count,
+                          ROUND(COUNT(*)::numeric / (SELECT count FROM all_count)::numeric * 100,
+                                1) AS percentage
+                   FROM results
+                   GROUP BY exam_method),
+territories_data AS (SELECT territory, um_school.name as school_name, average_point, school_id, region
+                  FROM results
+                           LEFT JOIN um_school ON school_id = um_school.id),
+schools_count_by_region AS (SELECT territory, COUNT(DISTINCT school_id) AS school_count
+                         FROM territories_data
+                         GROUP BY territory
+                         ORDER BY COUNT(DISTINCT school_name) DESC),
+all_school_count AS (SELECT SUM(school_count) AS all_schools_count
+                  FROM schools_count_by_region),
+avg_by_territory AS (SELECT territory,
+                         ROUND(AVG(average_point / (SELECT AVG(max_point_over_all) FROM rates) * 100)::numeric,
+                               1) AS data
+                  FROM territories_data
+                  GROUP BY territory
+                  ORDER BY ROUND(AVG(average_point)::numeric, 1)),
+avg_by_territory_with_avg_all AS (SELECT 'Barcha hudular' AS territory,
+                                      ROUND(
+                                              AVG(average_point / (SELECT AVG(max_point_over_all) FROM rates) * 100)::numeric,
+                                              1
+                                      )  AS data
+                               FROM territories_data
+                               UNION ALL
+                               SELECT *
+                               FROM avg_by_territory),
+avg_by_school AS (SELECT territory,
+                      school_name,
+                      region,
+                      ROUND(AVG(average_point / (SELECT AVG(max_point_over_all) FROM rates) * 100)::numeric,
+                            1) AS data
+               FROM territories_data
+               GROUP BY territory, region, school_id, school_name
+               ORDER BY ROUND(AVG(average_point)::numeric, 1)),
+teachers_info AS (SELECT *
+               FROM um_teachers
+               WHERE year = %(exam_year)s
+               ORDER BY teachers_count DESC),
+teachers_schools AS (SELECT json_agg(
+                json_build_object(
+                    'territory', territory,
+                    'school', school_array
+                )
+            ) AS result
+        FROM (
+            SELECT territory, json_agg(school) AS school_array
+            FROM um_teachers
+            WHERE year = %(exam_year)s
+            GROUP BY territory
+            ORDER BY AVG(teachers_count) DESC
+        ) subquery),
+teachers_info_by_territory AS (SELECT territory,
+                                  SUM(teachers_count)                  as teachers_count,
+                                  SUM(women_teachers_count)            as women_teachers_count,
+                                  SUM(men_teachers_count)              as men_teachers_count,
+                                  SUM(special_teachers_count)          as special_teachers_count,
+                                  SUM(first_category_teachers_count)   as first_category_teachers_count,
+                                  SUM(second_category_teachers_count)  as second_category_teachers_count,
+                                  SUM(highest_category_teachers_count) as highest_category_teachers_count,
+                                  ROUND((SUM(women_teachers_count)::NUMERIC / SUM(teachers_count)::NUMERIC *
+                                         100),
+                                        2)                             as women_teachers_percentage,
+                                  ROUND((SUM(men_teachers_count)::NUMERIC / SUM(teachers_count)::NUMERIC) * 100,
+                                        2)                             as men_teachers_percentage,
+                                  ROUND((SUM(special_teachers_count)::NUMERIC / SUM(teachers_count)::NUMERIC) *
+                                        100,
+                                        2)                             as special_teachers_percentage,
+                                  ROUND((SUM(first_category_teachers_count)::NUMERIC /
+                                         SUM(teachers_count)::NUMERIC) * 100,
+                                        2)                             as first_category_teachers_percentage,
+                                  ROUND((SUM(second_category_teachers_count)::NUMERIC /
+                                         SUM(teachers_count)::NUMERIC) * 100,
+                                        2)                             as second_category_teachers_percentage,
+                                  ROUND((SUM(highest_category_teachers_count)::NUMERIC /
+                                         SUM(teachers_count)::NUMERIC) * 100,
+                                        2)                             as highest_category_teachers_percentage
+                           FROM um_teachers
+                           WHERE year = %(exam_year)s
+                             AND territory != 'Barcha hududlar'
+                           GROUP BY territory
+                           UNION ALL
+                           SELECT territory,
+                                  teachers_count,
+                                  women_teachers_count,
+                                  men_teachers_count,
+                                  special_teachers_count,
+                                  first_category_teachers_count,
+                                  second_category_teachers_count,
+                                  highest_category_teachers_count,
+                                  women_teachers_percentage,
+                                  men_teachers_percentage,
+                                  special_teachers_percentage,
+                                  first_category_teachers_percentage,
+                                  second_category_teachers_percentage,
+                                  highest_category_teachers_percentage
+                           FROM um_teachers
+                           WHERE year = %(exam_year)s
+                             AND territory = 'Barcha hududlar'),
+all_region_count AS (SELECT COUNT(DISTINCT territory) as count FROM um_school),
+all_teachers_count AS (SELECT COALESCE(SUM(teachers_count), 0) as count FROM teachers_info WHERE territory = 'Barcha hududlar')
+SELECT json_build_object(
+       'all_count', (SELECT count FROM all_count),
+       'exam_methods_data', (SELECT json_agg(json_build_object(
+        'exam_method', exam_method,
+        'count', count,
+        'percentage', percentage
+                                             ))
+                             FROM exam_methods_data),
+       'territories_data', (SELECT json_agg(json_build_object(
+        'territory', territory,
+        'school_count', school_count
+                                            ))
+                            FROM schools_count_by_region),
+       'avg_by_territory', (SELECT json_agg(json_build_object(
+        'territory', territory,
+        'average', data
+                                            ))
+                            FROM avg_by_territory_with_avg_all),
+       'avg_by_school', (SELECT json_agg(json_build_object(
+        'territory', territory,
+        'school', school_name,
+        'region', region,
+        'average', data
+                                         ))
+                         FROM avg_by_school),
+       'teachers_info', (SELECT json_agg(json_build_object(
+        'territory', territory,
+        'school', school,
+        'teachers_count', teachers_count,
+        'women_teachers_count', women_teachers_count,
+        'women_teachers_percentage', women_teachers_percentage,
+        'men_teachers_count', men_teachers_count,
+        'men_teachers_percentage', men_teachers_percentage,
+        'special_teachers_count', special_teachers_count,
+        'special_teachers_percentage', special_teachers_percentage,
+        'first_category_teachers_count', first_category_teachers_count,
+        'first_category_teachers_percentage', first_category_teachers_percentage,
+        'second_category_teachers_count', second_category_teachers_count,
+        'second_category_teachers_percentage', second_category_teachers_percentage,
+        'highest_category_teachers_count', highest_category_teachers_count,
+        'highest_category_teachers_percentage', highest_category_teachers_percentage
+                                         ))
+                         FROM teachers_info),
+       'teachers_info_by_territory', (SELECT json_agg(row_to_json(t)) AS json_object
+                                     FROM teachers_info_by_territory AS t),
+        'teachers_schools', (SELECT result FROM teachers_schools),
+       'all_schools_count', (SELECT all_schools_count FROM all_school_count),
+       'all_regions_count', (SELECT count FROM all_region_count),
+       'all_teachers_count', (SELECT count FROM all_teachers_count)) AS result
+        """
+    return query, {
+        "exam_year": base_request.exam_year,
+        "exam_quarter": base_request.exam_quarter,
+    }
+
+
+def dashboard_summary_query(base_request: BaseRequest):
+    query = """
+        SELECT payload AS result
+        FROM um_dashboard_summary
+        WHERE exam_year = %(exam_year)s
+          AND exam_quarter = %(exam_quarter)s;
+    """
+    return query, {
+        "exam_year": base_request.exam_year,
+        "exam_quarter": base_request.exam_quarter,
+    }
+
+
+def refresh_dashboard_summary_query(base_request: BaseRequest, exams_table="um_student_exams"):
+    """Recompute the /home payload of one period and store it in um_dashboard_summary, read from
+    `exams_table` like refresh_student_scores_query"""
+    base_query, params = base_results_query(base_request, exams_table)
+    query = f"""
+        INSERT INTO um_dashboard_summary (exam_year, exam_quarter, payload, refreshed_at)
+        SELECT %(exam_year)s, %(exam_quarter)s, summary.result, CURRENT_TIMESTAMP
+        FROM ({base_query}) AS summary
+        ON CONFLICT (exam_year, exam_quarter) DO UPDATE SET
+            payload = EXCLUDED.payload,
+            refreshed_at = EXCLUDED.refreshed_at
+        RETURNING payload AS result;
+    """
+    return query, params
+
+
+def data_versions_query():
+    query = """
+        SELECT COALESCE(JSON_OBJECT_AGG(exam_year || '-' || exam_quarter, version), '{}') AS versions
+        FROM um_data_version;
+    """
+    return query, None
+
+
+def bump_data_version_query(exam_year, exam_quarter):
+    query = """
+        INSERT INTO um_data_version (exam_year, exam_quarter)
+        VALUES (%(exam_year)s, %(exam_quarter)s)
+        ON CONFLICT (exam_year, exam_quarter) DO UPDATE SET
+            version = um_data_version.version + 1,
+            updated_at = CURRENT_TIMESTAMP;
+    """
+    return query, {
+        "exam_year": exam_year,
+        "exam_quarter": exam_quarter,
+    }
+
+
+def _pages_cte(source, count_pages):
+    # The page count is cached per filter set, skip the COUNT(*) when it is already known
+    if not count_pages:
+        return ""
+    return f""",
+        pages AS (SELECT CEIL(COUNT(*) / {PAGE_SIZE}.0) FROM {source})"""
+
+
+def _pages_value(count_pages):
+    return "(SELECT * FROM pages)" if count_pages else "NULL"
+
+
+def _next_cursor(source, key_columns, descending=True):
+    # Sort key of the last row of a full page, the next page seeks past it instead of using OFFSET
+    keys = ", ".join(key_columns)
+    last_first = ", ".join(f"{column} {'ASC' if descending else 'DESC'}" for column in key_columns)
+    return f"""CASE WHEN (SELECT COUNT(*) FROM {source}) = {PAGE_SIZE}
+                THEN (SELECT JSON_BUILD_ARRAY({keys}) FROM {source} ORDER BY {last_first} LIMIT 1) END"""
+
+
+def _school_results_base(school_request: SchoolRequest):
+    """`rates` and `school_results` CTEs of the school ranking (ending with a comma) and their parameters"""
+    # Base query with placeholders for studyClass and territory filters
+    base_query = """
+        WITH rates AS (SELECT max_point_over_all, subject
+           FROM um_rate
+           WHERE exam_quarter = %s
+             AND exam_year = %s),
+ school_results AS (SELECT um_school.id AS school_id,
+                           um_school.region    AS region,
+                           um_school.name      AS school,
+
+                           ROUND(((average_point -> 'all' ->> '{avg_key}')::numeric /
+                                  (SELECT AVG(max_point_over_all) FROM rates)) * 100,
+                                 1)            AS average,
+                           COALESCE(
+                                   ROUND(
+                                           ((results -> 'all' -> '{result_key}' -> 'math_5&6' ->> 'all_point')::numeric /
+                                            (SELECT max_point_over_all FROM rates WHERE subject = 'math_5&6')) *
+                                           100, 1),
+                                   ROUND(((results -> 'all' -> '{result_key}' -> 'math_7' ->> 'all_point')::numeric /
+                                          (SELECT max_point_over_all FROM rates WHERE subject = 'math_7')) * 100, 1)
+                           )                   AS math,
+                           COALESCE(
+                                   ROUND(((results -> 'all' -> '{result_key}' -> 'mother_tongue_literature_7' ->>
+                                           'all_point')::numeric /
+                                          (SELECT max_point_over_all
+                                           FROM rates
+                                           WHERE subject = 'mother_tongue_literature_7')) * 100, 1),
+                                   ROUND(((results -> 'all' -> '{result_key}' ->
+                                           'mother_tongue_literature_8&10&11' ->> 'all_point')::numeric /
+                                          (SELECT max_point_over_all
+                                           FROM rates
+                                           WHERE subject = 'mother_tongue_literature_8&10&11')) * 100, 1)
+                           )                   AS mother_tongue_literature,
+                           ROUND(((results -> 'all' -> '{result_key}' -> 'literature_5&6' ->> 'all_point')::numeric /
+                                  (SELECT max_point_over_all FROM rates WHERE subject = 'literature_5&6')) * 100,
+                                 1)            AS literature,
+                           ROUND(
+                                   ((results -> 'all' -> '{result_key}' -> 'mother_tongue_5&6' ->> 'all_point')::numeric /
+                                    (SELECT max_point_over_all FROM rates WHERE subject = 'mother_tongue_5&6')) *
+                                   100,
+                                   1)          AS mother_tongue,
+                           ROUND(
+                                   ((results -> 'all' -> '{result_key}' -> 'russian-qaraqalpaq_5&6' ->> 'all_point')::numeric) /
+                                   (SELECT max_point_over_all FROM rates WHERE subject = 'russian-qaraqalpaq_5&6') *
+                                   100,
+                                   1)          AS russian,
+                           ROUND(((results -> 'all' -> '{result_key}' -> 'chemistry_8' ->> 'all_point')::numeric) /
+                                 (SELECT max_point_over_all FROM rates WHERE subject = 'chemistry_8') * 100,
+                                 1)            AS chemistry,
+                           ROUND(((results -> 'all' -> '{result_key}' -> 'biology_7' ->> 'all_point')::numeric) /
+                                 (SELECT max_point_over_all FROM rates WHERE subject = 'biology_7') * 100,
+                                 1)            AS biology,
+                           ROUND(
+                                   ((results -> 'all' -> '{result_key}' -> 'english_9&10&11' ->> 'all_point')::numeric) /
+                                   (SELECT max_point_over_all FROM rates WHERE subject = 'english_9&10&11') * 100,
+                                   1)          AS english,
+                           ROUND(((results -> 'all' -> '{result_key}' -> 'physics_9' ->> 'all_point')::numeric) /
+                                 (SELECT max_point_over_all FROM rates WHERE subject = 'physics_9') * 100,
+                                 1)            AS physics,
+                           ROUND(
+                                   ((results -> 'all' -> '{result_key}' -> 'algebra_8&9&10&11' ->> 'all_point')::numeric) /
+                                   (SELECT max_point_over_all FROM rates WHERE subject = 'algebra_8&9&10&11') * 100,
+                                   1)          AS algebra,
+                           ROUND(
+                                   ((results -> 'all' -> '{result_key}' -> 'geometry_8&9&10&11' ->> 'all_point')::numeric) /
+                                   (SELECT max_point_over_all FROM rates WHERE subject = 'geometry_8&9&10&11') *
+                                   100,
+                                   1)          AS geometry
+                    FROM um_school_results
+                             LEFT JOIN um_school ON um_school_results.school_id = um_school.id
+                    WHERE exam_quarter = %s
+                      AND exam_year = %s
+                      {territory_filter}
+                    ORDER BY um_school.territory),
+                    """
+
+    # Extract the request parameters
+    exam_quarter = school_request.exam_quarter
+    exam_year = school_request.exam_year
+    studyClass = school_request.study_class
+    territory = school_request.territory
+
+    # Determine the appropriate key for results
+    results_key = 'school_avg' if studyClass is None else f"{studyClass}"
+    avg_key = 'overall' if studyClass is None else f"{studyClass}"
+    base_query = base_query.format(
+        avg_key=avg_key,
+        result_key=results_key,
+        territory_filter="AND territory = %s" if territory else ""
+    )
+
+    # Build the parameter list for query execution
+    params = [exam_quarter, exam_year, exam_quarter, exam_year]
+    if territory:
+        params.append(territory)
+
+    return base_query, params
+
+
+def school_results_query(school_request: SchoolRequest, count_pages=True, after=None):
+    base_query, params = _school_results_base(school_request)
+    sort_column = f"COALESCE({school_request.subject or 'average'}, -1)"
+    seek_filter = f"WHERE ({sort_column}, school_id) < (%s, %s)" if after else ""
+    offset = "" if after else f"OFFSET ({school_request.page}-1) * {PAGE_SIZE}"
+
+    if school_request.subject:
+        limited_query = f"""
+                limited_school_results AS (
+                    SELECT 
+                        school_id,
+                        region,
+                        school,
+                        {school_request.subject}
+                    FROM school_results
+                    {seek_filter}
+                    ORDER BY {sort_column} DESC, school_id DESC
+                    LIMIT {PAGE_SIZE} {offset}
+                )"""
+    else:
+        limited_query = f"""
+                limited_school_results AS (
+                    SELECT * FROM school_results
+                    {seek_filter}
+                    ORDER BY {sort_column} DESC, school_id DESC
+                    LIMIT {PAGE_SIZE} {offset}
+                )"""
+    
+    result_query = _pages_cte("school_results", count_pages) + f"""
+SELECT JSON_BUILD_OBJECT('school_results', (SELECT JSON_AGG(limited_school_results) FROM limited_school_results),
+   'pages', {_pages_value(count_pages)},
+   'next_cursor', {_next_cursor("limited_school_results", [sort_column, "school_id"])}) AS result;
+        """
+    
+    query = base_query + limited_query + result_query
+    if after:
+        params.extend(after)
+
+    return query, params
+
+
+def school_results_export_query(school_request: SchoolRequest):
+    """Every row of the school ranking in page order, read by the streaming export"""
+    base_query, params = _school_results_base(school_request)
+    sort_column = f"COALESCE({school_request.subject or 'average'}, -1)"
+    columns = f"school_id, region, school, {school_request.subject}" if school_request.subject else "*"
+    query = base_query.rstrip().rstrip(",") + f"""
+        SELECT {columns}
+        FROM school_results
+        ORDER BY {sort_column} DESC, school_id DESC;
+    """
+    return query, params
+
+
+def _student_results_base(students_request: StudentRequest):
+    """`student_results` CTE of the student ranking (ending with a comma) and its parameters"""
+    base_query = """
+        WITH student_results AS (SELECT
+                     um_student_exams.id AS exam_id,
+                     um_school.region,
+                     um_school.name,
+                        CONCAT(um_student_exams.surname, '. ', LEFT(um_student_exams.name, 1), '. ',
+                               LEFT(um_student_exams.patronymic, 1),
+                               '.')                 as full_name,
+                        CONCAT(studystream, '-sinf') as study_class,
+                        um_student_scores.average,
+                        um_student_scores.math,
+                        um_student_scores.mother_tongue_literature,
+                        um_student_scores.literature,
+                        um_student_scores.mother_tongue,
+                        um_student_scores.russian,
+                        um_student_scores.chemistry,
+                        um_student_scores.biology,
+                        um_student_scores.english,
+                        um_student_scores.physics,
+                        um_student_scores.algebra,
+                        um_student_scores.geometry
+                 FROM um_student_exams
+                          LEFT JOIN um_school ON um_student_exams.school_id = um_school.id
+                          JOIN um_student_scores ON um_student_scores.id = um_student_exams.id
+                                                AND um_student_scores.exam_year = um_student_exams.exam_year
+                                                AND um_student_scores.exam_quarter = um_student_exams.exam_quarter
+        WHERE um_student_exams.exam_quarter = %s
+            AND um_student_exams.exam_year = %s
+            AND (%s IS NULL OR um_school.territory = %s)
+            AND (%s IS NULL OR um_school.region = %s)
+            AND (%s IS NULL OR um_school.name = %s)
+            AND (%s IS NULL OR studyclass = %s)),"""
+    params = [
+        students_request.exam_quarter,
+        students_request.exam_year,
+        students_request.territory, students_request.territory,
+        students_request.region, students_request.region,
+        students_request.school, students_request.school,
+        students_request.study_class, students_request.study_class,
+    ]
+    return base_query, params
+
+
+def students_results_query(students_request: StudentRequest, count_pages=True, after=None):
+    base_query, params = _student_results_base(students_request)
+    sort_column = f"COALESCE({students_request.subject or 'average'}, -1)"
+    limited_query = f"""
+        limited_school_results AS (SELECT *
+                        FROM student_results
+                        {f"WHERE ({sort_column}, exam_id) < (%s, %s)" if after else ""}
+                        ORDER BY {sort_column} DESC, exam_id DESC
+                        LIMIT {PAGE_SIZE} {"" if after else f"OFFSET ({students_request.page} - 1) * {PAGE_SIZE}"})"""
+    pages_cte = _pages_cte("student_results", count_pages)
+    page_fields = f"""'total_pages', {_pages_value(count_pages)},
+            'next_cursor', {_next_cursor("limited_school_results", [sort_column, "exam_id"])}"""
+    
+    if students_request.subject:
+        result_query = pages_cte + f"""
+        SELECT JSON_BUILD_OBJECT('results', JSON_AGG(
+                JSON_BUILD_OBJECT(
+                        'region', region,
+                        'school', name,
+                        'full_name', full_name,
+                        'class', study_class,
+                        '{students_request.subject}', {students_request.subject}
+                        
+                )
+                                            ),
+            {page_fields}
+            ) AS result
+        FROM limited_school_results ;
+                        """
+    else:
+        result_query = pages_cte + f"""
+        SELECT JSON_BUILD_OBJECT('results', JSON_AGG(
+                JSON_BUILD_OBJECT(
+                        'region', region,
+                        'school', name,
+                        'full_name', full_name,
+                        'class', study_class,
+                        'average', average,
+                        'math', math,
+                        'mother_tongue_literature', mother_tongue_literature,
+                        'literature', literature,
+                        'mother_tongue', mother_tongue,
+                        'russian', russian,
+                        'algebra', algebra,
+                        'geometry', geometry,
+                        'physics', physics,
+                        'chemistry', chemistry,
+                        'biology', biology,
+                        'english', english
+                )
+                                            ),
+            {page_fields}
+            ) AS result
+        FROM limited_school_results ;
+                        """
+    
+    # print(students_request)
+    
+    if after:
+        params.extend(after)
+
+    query = base_query + limited_query + result_query
+
+    return query, params
+
+
+def students_results_export_query(students_request: StudentRequest):
+    """Every row of the student ranking in page order, read by the streaming export"""
+    base_query, params = _student_results_base(students_request)
+    sort_column = f"COALESCE({students_request.subject or 'average'}, -1)"
+    scores = students_request.subject or """average, math, mother_tongue_literature, literature, mother_tongue, russian,
+               algebra, geometry, physics, chemistry, biology, english"""
+    query = base_query.rstrip().rstrip(",") + f"""
+        SELECT region, name AS school, full_name, study_class AS class,
+               {scores}
+        FROM student_results
+        ORDER BY {sort_column} DESC, exam_id DESC;
+    """
+    return query, params
+
+
+def _results_base_query():
+    """`results` CTE (ending with a comma): the student scores of one period with their school"""
+    return """
+        WITH results AS (
+            SELECT um_school.territory,
+                um_school.region,
+                um_school.id as school_id,
+                um_school.name,
+                um_student_exams.student_id,
+                CONCAT(um_student_exams.surname, '. ', LEFT(um_student_exams.name, 1), '. ',
+                        LEFT(um_student_exams.patronymic, 1), '.') AS full_name,
+                studystream,
+                exam_method,
+                um_student_scores.average,
+                um_student_scores.math,
+                um_student_scores.mother_tongue_literature,
+                um_student_scores.literature,
+                um_student_scores.mother_tongue,
+                um_student_scores.russian,
+                um_student_scores.chemistry,
+                um_student_scores.biology,
+                um_student_scores.english,
+                um_student_scores.physics,
+                um_student_scores.algebra,
+                um_student_scores.geometry
+            FROM um_student_exams
+            LEFT JOIN um_school ON um_student_exams.school_id = um_school.id
+            JOIN um_student_scores ON um_student_scores.id = um_student_exams.id
+                                  AND um_student_scores.exam_year = um_student_exams.exam_year
+                                  AND um_student_scores.exam_quarter = um_student_exams.exam_quarter
+            WHERE um_student_exams.exam_quarter = %(exam_quarter)s
+            AND um_student_exams.exam_year = %(exam_year)s
+        ),
+    """
+
+
+def _results_filter_conditions(params: ResultRequest):
+    return " AND ".join(
+        f"{db_column} = %({model_field})s"
+        for model_field, db_column in {
+            "exam_method": "exam_method",
+            "study_class": "studystream",
+            "territory": "territory",
+            "region": "region",
+            "school": "name"
+        }.items() if getattr(params, model_field) is not None
+    )
+
+
+def _grouped_results_cte(params: ResultRequest, filter_conditions):
+    """`students_results`: the results table, one row per school, or per student when a school is selected"""
+    return f"""
+        students_results AS (
+            SELECT  {params.school and 'student_id' or 'school_id'} AS page_key,
+                    region as region,
+                    school_id as school_id,
+                    {params.school and 'full_name' or 'name'},
+                    ROUND(AVG(average)::numeric, 1)                  AS average,
+                    ROUND(AVG(math)::numeric, 1)                     AS math,
+                    ROUND(AVG(mother_tongue)::numeric, 1)            AS mother_tongue,
+                    ROUND(AVG(literature)::numeric, 1)               AS literature,
+                    ROUND(AVG(mother_tongue_literature)::numeric, 1) AS mother_tongue_literature,
+                    ROUND(AVG(russian)::numeric, 1)                  AS russian,
+                    ROUND(AVG(algebra)::numeric, 1)                  AS algebra,
+                    ROUND(AVG(geometry)::numeric, 1)                 AS geometry,
+                    ROUND(AVG(physics)::numeric, 1)                  AS physics,
+                    ROUND(AVG(biology)::numeric, 1)                  AS biology,
+                    ROUND(AVG(chemistry)::numeric, 1)                AS chemistry,
+                    ROUND(AVG(english)::numeric, 1)                  AS english
+            FROM results
+            WHERE {filter_conditions or '1=1'}
+            GROUP BY {params.school and 'region, school_id, student_id, full_name' or 'region, school_id, name'}
+        )"""
+
+
+def _results_table_columns(params: ResultRequest):
+    # The page key only drives the paging, keep it out of the rendered table
+    return ", ".join([
+        "region", "school_id", params.school and "full_name" or "name",
+        "average", "math", "mother_tongue", "literature", "mother_tongue_literature", "russian",
+        "algebra", "geometry", "physics", "biology", "chemistry", "english",
+    ])
+
+
+def _results_params(params: ResultRequest, after=None):
+    return {
+        "exam_year": params.exam_year,
+        "exam_quarter": params.exam_quarter,
+        "territory": params.territory,
+        "school": params.school,
+        "exam_method": params.exam_method,
+        "study_class": params.study_class,
+        "subject": params.subject,
+        "region" : params.region,
+        "after_key": after[0] if after else None,
+    }
+
+
+def results_query(params: ResultRequest, count_pages=True, after=None):
+    # Base query setup for required fields
+    base_query = _results_base_query()
+
+    # Define avg_column
+    avg_column = f"AVG({params.subject})" if params.subject else "AVG(average)"
+    
+    # `avg_by_territory` CTE with fallback conditions
+    avg_by_territory_query = f"""
+        avg_by_territory AS (
+            SELECT territory, ROUND({avg_column}::numeric, 1) AS data
+            FROM results
+            WHERE {'exam_method = %(exam_method)s' if params.exam_method else '1=1'}
+            AND {'studystream = %(study_class)s' if params.study_class else '1=1'}
+            GROUP BY territory
+            HAVING {avg_column} IS NOT NULL
+            ORDER BY {avg_column}
+        ), 
+    """
+
+    # Define subject avg fields
+    avg_fields = f"ROUND(AVG({params.subject})::numeric, 1) AS {params.subject}_avg" if params.subject else """
+        ROUND(AVG(average)::numeric, 1)   AS _avg,
+        ROUND(AVG(math)::numeric, 1)                     AS math_avg,
+        ROUND(AVG(mother_tongue)::numeric, 1)            AS mother_tongue_avg,
+        ROUND(AVG(literature)::numeric, 1)               AS literature_avg,
+        ROUND(AVG(mother_tongue_literature)::numeric, 1) AS mother_tongue_literature_avg,
+        ROUND(AVG(russian)::numeric, 1)                  AS russian_avg,
+        ROUND(AVG(algebra)::numeric, 1)                  AS algebra_avg,
+        ROUND(AVG(geometry)::numeric, 1)                 AS geometry_avg,
+        ROUND(AVG(physics)::numeric, 1)                  AS physics_avg,
+        ROUND(AVG(biology)::numeric, 1)                  AS biology_avg,
+        ROUND(AVG(chemistry)::numeric, 1)                AS chemistry_avg,
+        ROUND(AVG(english)::numeric, 1)                  AS english_avg
+    """
+    
+    # `subject_results` CTE with fallback grouping
+    subject_results_query = f"""
+        subject_results AS (
+            SELECT {avg_fields},
+                {'territory as key' if not params.territory else 'name as key' }
+            FROM results
+            WHERE {'exam_method = %(exam_method)s' if params.exam_method else '1=1'}
+            AND {'studystream = %(study_class)s' if params.study_class else '1=1'}
+            AND {'territory = %(territory)s' if params.territory else '1=1'}
+            AND {'region = %(region)s' if params.region else '1=1'}
+            GROUP BY {'territory' if not params.territory else 'school_id, name'}
+            {'HAVING AVG('+ params.subject + ') IS NOT NULL' if params.subject else ''}
+        ),
+    """
+
+    subject_avg_column = f"ROUND(AVG({params.subject})::numeric, 1) AS avg" if params.subject else "ROUND(AVG(average)::numeric, 1) AS avg"
+
+    study_class_results_query = f"""
+        study_class_results AS (
+            SELECT {subject_avg_column},
+                studystream as studyclass
+            FROM results
+            WHERE {'exam_method = %(exam_method)s' if params.exam_method else '1=1'}
+            AND {'territory = %(territory)s' if params.territory else '1=1'}
+            AND {'region = %(region)s' if params.region else '1=1'}
+            AND {'name = %(school)s' if params.school else '1=1'}
+            GROUP BY studystream
+            {'HAVING AVG('+ params.subject + ') IS NOT NULL' if params.subject else ''}
+            ORDER BY studystream::int
+        ),
+    """
+
+    # `some_subject_result` CTE
+    filter_conditions = _results_filter_conditions(params)
+    some_subject_result_query = f"""
+        some_subject_result AS (
+            SELECT ROUND(AVG(average)::numeric, 1)   AS _avg,
+                ROUND(AVG(math)::numeric, 1)                     AS math_avg,
+                ROUND(AVG(mother_tongue)::numeric, 1)            AS mother_tongue_avg,
+                ROUND(AVG(literature)::numeric, 1)               AS literature_avg,
+                ROUND(AVG(mother_tongue_literature)::numeric, 1) AS mother_tongue_literature_avg,
+                ROUND(AVG(russian)::numeric, 1)                  AS russian_avg,
+                ROUND(AVG(algebra)::numeric, 1)                  AS algebra_avg,
+                ROUND(AVG(geometry)::numeric, 1)                 AS geometry_avg,
+                ROUND(AVG(physics)::numeric, 1)                  AS physics_avg,
+                ROUND(AVG(biology)::numeric, 1)                  AS biology_avg,
+                ROUND(AVG(chemistry)::numeric, 1)                AS chemistry_avg,
+                ROUND(AVG(english)::numeric, 1)                  AS english_avg
+            FROM results
+            WHERE {filter_conditions or '1=1'}
+        ),
+    """
+
+    # Mapping for filter conditions in `students_filter`
+    column_map = {
+        "study_class": "studystream",
+        "territory": "territory",
+        "region": "region",
+        "school": "name"  # `school` in model maps to `name` in the database
+    }
+
+    # Generate `students_filter` conditions
+    students_filter_conditions = " AND ".join(
+        f"{db_column} = %({model_field})s"
+        for model_field, db_column in column_map.items()
+        if getattr(params, model_field) is not None
+    )
+    subject_condition = f"{params.subject} IS NOT NULL" if params.subject else "1=1"
+
+    # `students_filter` and `exam_method_results` CTE
+    students_filter_query = f"""
+        students_filter AS (
+            SELECT student_id, average, exam_method
+            FROM results
+            WHERE {students_filter_conditions or '1=1'} AND {subject_condition}
+        ),
+        exam_method_results AS (
+            SELECT exam_method,
+                (SELECT COUNT(*) FROM students_filter) students_count,
+                COUNT(*) as count,
+                ROUND((COUNT(*)::numeric / (SELECT COUNT(*) FROM students_filter)::numeric) * 100, 1) AS percentage,
+                ROUND(AVG(average::numeric), 1) AS result
+            FROM students_filter
+            GROUP BY exam_method
+        ),
+    """
+
+    # `students_results` CTE with dynamic group column
+    students_results_query = _grouped_results_cte(params, filter_conditions) + f""",
+        limited_student_results AS (SELECT *
+                            FROM students_results
+                            {'WHERE page_key > %(after_key)s' if after else ''}
+                            ORDER BY page_key
+                            LIMIT {PAGE_SIZE} {'' if after else f'OFFSET ({params.page} - 1) * {PAGE_SIZE}'})""" + _pages_cte("students_results", count_pages) + """
+    """
+
+    table_columns = _results_table_columns(params)
+
+    # Final query
+    query = base_query + avg_by_territory_query + subject_results_query + study_class_results_query + some_subject_result_query + students_filter_query + students_results_query + f"""
+        SELECT json_build_object(
+            'avg_by_territory', (SELECT json_agg(avg_by_territory) FROM avg_by_territory),
+            'subject_results', (SELECT json_agg(subject_results) FROM subject_results),
+            'study_class_results', (SELECT json_agg(study_class_results) FROM study_class_results),
+            'some_subject_result', (SELECT json_agg(some_subject_result) FROM some_subject_result),
+            'students_results', (SELECT json_agg(page_rows)
+                                 FROM (SELECT {table_columns} FROM limited_student_results ORDER BY page_key) page_rows),
+            'exam_method_results', (SELECT json_agg(exam_method_results) FROM exam_method_results),
+            'total_pages', {_pages_value(count_pages)},
+            'next_cursor', {_next_cursor("limited_student_results", ["page_key"], descending=False)}
+        ) AS results;
+    """
+
+    return query, _results_params(params, after)
+
+
+def results_export_query(params: ResultRequest):
+    """Every row of the results table in page order, read by the streaming export"""
+    query = _results_base_query() + _grouped_results_cte(params, _results_filter_conditions(params)) + f"""
+        SELECT {_results_table_columns(params)}
+        FROM students_results
+        ORDER BY page_key;
+    """
+    return query, _results_params(params)
+
+
+EXPORT_QUERIES = {
+    "schools": school_results_export_query,
+    "students": students_results_export_query,
+    "results": results_export_query,
+}
+
+
+def _per_quarter(cte, columns, order_by=None):
+    # Rows of one quarter without the exam_quarter column, in the shape the single-quarter report had
+    return f"""(SELECT json_agg(t) FROM (SELECT {', '.join(columns)} FROM {cte}
+                       WHERE {cte}.exam_quarter = quarters.exam_quarter
+                       {f'ORDER BY {order_by}' if order_by else ''}) t)"""
+
+
+def compare_results_query(params: CompareRequest, exam_quarters):
+    """Compare results of several quarters of one year in a single pass, the result is keyed by quarter"""
+    # Base query setup for required fields
+    base_query = f"""
+        WITH results AS (
+            SELECT um_student_exams.exam_quarter,
+                um_school.territory,
+                um_school.region,
+                um_school.id as school_id,
+                um_school.name,
+                um_student_exams.student_id,
+                studystream,
+                exam_method,
+                um_student_scores.average,
+                um_student_scores.math,
+                um_student_scores.mother_tongue_literature,
+                um_student_scores.literature,
+                um_student_scores.mother_tongue,
+                um_student_scores.russian,
+                um_student_scores.chemistry,
+                um_student_scores.biology,
+                um_student_scores.english,
+                um_student_scores.physics,
+                um_student_scores.algebra,
+                um_student_scores.geometry
+            FROM um_student_exams
+            LEFT JOIN um_school ON um_student_exams.school_id = um_school.id
+            JOIN um_student_scores ON um_student_scores.id = um_student_exams.id
+                                  AND um_student_scores.exam_year = um_student_exams.exam_year
+                                  AND um_student_scores.exam_quarter = um_student_exams.exam_quarter
+            WHERE um_student_exams.exam_quarter = ANY(%(exam_quarters)s)
+            AND um_student_exams.exam_year = %(exam_year)s
+        ),
+        quarters AS (
+            SELECT DISTINCT UNNEST(%(exam_quarters)s::text[]) AS exam_quarter
+        ),
+    """
+
+    # Define avg_column
+    avg_column = f"AVG({params.subject})" if params.subject else "AVG(average)"
+    
+    # `avg_by_territory` CTE with fallback conditions
+    avg_by_territory_query = f"""
+        avg_by_territory AS (
+            SELECT exam_quarter,
+                {'territory as key' if not params.territory else 'name as key' }, 
+                ROUND({avg_column}::numeric, 1) AS data
+            FROM results
+            WHERE {'exam_method = %(exam_method)s' if params.exam_method else '1=1'}
+            AND {'studystream = %(study_class)s' if params.study_class else '1=1'}
+            AND {'territory = %(territory)s' if params.territory else '1=1'}
+            AND {'region = %(region)s' if params.region else '1=1'}
+            GROUP BY exam_quarter, {'territory' if not params.territory else 'school_id, name'}
+            HAVING {avg_column} IS NOT NULL
+        ),
+    """
+
+    # Define subject avg fields
+    subject_avg_columns = [f"{params.subject}_avg"] if params.subject else [
+        "_avg", "math_avg", "mother_tongue_avg", "literature_avg", "mother_tongue_literature_avg", "russian_avg",
+        "algebra_avg", "geometry_avg", "physics_avg", "biology_avg", "chemistry_avg", "english_avg",
+    ]
+    avg_fields = f"ROUND(AVG({params.subject})::numeric, 1) AS {params.subject}_avg" if params.subject else """
+        ROUND(AVG(average)::numeric, 1)   AS _avg,
+        ROUND(AVG(math)::numeric, 1)                     AS math_avg,
+        ROUND(AVG(mother_tongue)::numeric, 1)            AS mother_tongue_avg,
+        ROUND(AVG(literature)::numeric, 1)               AS literature_avg,
+        ROUND(AVG(mother_tongue_literature)::numeric, 1) AS mother_tongue_literature_avg,
+        ROUND(AVG(russian)::numeric, 1)                  AS russian_avg,
+        ROUND(AVG(algebra)::numeric, 1)                  AS algebra_avg,
+        ROUND(AVG(geometry)::numeric, 1)                 AS geometry_avg,
+        ROUND(AVG(physics)::numeric, 1)                  AS physics_avg,
+        ROUND(AVG(biology)::numeric, 1)                  AS biology_avg,
+        ROUND(AVG(chemistry)::numeric, 1)                AS chemistry_avg,
+        ROUND(AVG(english)::numeric, 1)                  AS english_avg
+    """
+    
+    # `subject_results` CTE with fallback grouping, like the single-quarter report a quarter
+    # without results has a row of nulls
+    subject_results_query = f"""
+        subject_results AS (
+            SELECT quarters.exam_quarter, {avg_fields}
+            FROM quarters
+            LEFT JOIN results ON results.exam_quarter = quarters.exam_quarter
+            AND {'exam_method = %(exam_method)s' if params.exam_method else '1=1'}
+            AND {'studystream = %(study_class)s' if params.study_class else '1=1'}
+            AND {'territory = %(territory)s' if params.territory else '1=1'}
+            AND {'region = %(region)s' if params.region else '1=1'}
+            AND {'name = %(school)s' if params.school else '1=1'}
+            GROUP BY quarters.exam_quarter
+        ),
+    """
+
+    subject_avg_column = f"ROUND(AVG({params.subject})::numeric, 1) AS avg" if params.subject else "ROUND(AVG(average)::numeric, 1) AS avg"
+
+    study_class_results_query = f"""
+        study_class_results AS (
+            SELECT exam_quarter,
+                {subject_avg_column},
+                studystream as studyclass
+            FROM results
+            WHERE {'exam_method = %(exam_method)s' if params.exam_method else '1=1'}
+            AND {'territory = %(territory)s' if params.territory else '1=1'}
+            AND {'region = %(region)s' if params.region else '1=1'}
+            AND {'name = %(school)s' if params.school else '1=1'}
+            GROUP BY exam_quarter, studystream
+            {'HAVING AVG('+ params.subject + ') IS NOT NULL' if params.subject else ''}
+        ),
+    """
+
+    column_map = {
+        "study_class": "studystream",
+        "territory": "territory",
+        "region": "region",
+        "school": "name"  # `school` in model maps to `name` in the database
+    }
+
+    students_filter_conditions = " AND ".join(
+        f"{db_column} = %({model_field})s"
+        for model_field, db_column in column_map.items()
+        if getattr(params, model_field) is not None
+    )
+    subject_condition = f"{params.subject} IS NOT NULL" if params.subject else "1=1"
+
+    # `students_filter` and `exam_method_results` CTE, the totals are per quarter
+    students_filter_query = f"""
+        students_filter AS (
+            SELECT exam_quarter, student_id, average, exam_method
+            FROM results
+            WHERE {students_filter_conditions or '1=1'} AND {subject_condition}
+        ),
+        exam_method_results AS (
+            SELECT exam_quarter,
+                exam_method,
+                (SUM(COUNT(*)) OVER (PARTITION BY exam_quarter))::bigint students_count,
+                COUNT(*) as count,
+                ROUND((COUNT(*)::numeric / SUM(COUNT(*)) OVER (PARTITION BY exam_quarter)) * 100, 1) AS percentage,
+                ROUND(AVG(average::numeric), 1) AS result
+            FROM students_filter
+            GROUP BY exam_quarter, exam_method
+        ),
+    """
+
+    # `some_subject_result` CTE
+    filter_conditions = " AND ".join(
+        f"{db_column} = %({model_field})s"
+        for model_field, db_column in {
+            "exam_method": "exam_method",
+            "study_class": "studystream",
+            "territory": "territory",
+            "region": "region",
+            "school": "name"
+        }.items() if getattr(params, model_field) is not None
+    )
+    some_subject_result_query = f"""
+        some_subject_result AS (
+            SELECT quarters.exam_quarter,
+                ROUND(AVG(average)::numeric, 1)   AS _avg,
+                ROUND(AVG(math)::numeric, 1)                     AS math_avg,
+                ROUND(AVG(mother_tongue)::numeric, 1)            AS mother_tongue_avg,
+                ROUND(AVG(literature)::numeric, 1)               AS literature_avg,
+                ROUND(AVG(mother_tongue_literature)::numeric, 1) AS mother_tongue_literature_avg,
+                ROUND(AVG(russian)::numeric, 1)                  AS russian_avg,
+                ROUND(AVG(algebra)::numeric, 1)                  AS algebra_avg,
+                ROUND(AVG(geometry)::numeric, 1)                 AS geometry_avg,
+                ROUND(AVG(physics)::numeric, 1)                  AS physics_avg,
+                ROUND(AVG(biology)::numeric, 1)                  AS biology_avg,
+                ROUND(AVG(chemistry)::numeric, 1)                AS chemistry_avg,
+                ROUND(AVG(english)::numeric, 1)                  AS english_avg
+            FROM quarters
+            LEFT JOIN results ON results.exam_quarter = quarters.exam_quarter
+            AND {filter_conditions or '1=1'}
+            GROUP BY quarters.exam_quarter
+        )
+    """
+
+    some_subject_columns = [
+        "_avg", "math_avg", "mother_tongue_avg", "literature_avg", "mother_tongue_literature_avg", "russian_avg",
+        "algebra_avg", "geometry_avg", "physics_avg", "biology_avg", "chemistry_avg", "english_avg",
+    ]
+
+    # Final query
+    query = base_query + avg_by_territory_query + subject_results_query + study_class_results_query + students_filter_query + some_subject_result_query + f"""
+        SELECT COALESCE(json_object_agg(quarters.exam_quarter, json_build_object(
+            'avg_by_territory', {_per_quarter('avg_by_territory', ['key', 'data'], 'data')},
+            'subject_results', {_per_quarter('subject_results', subject_avg_columns)},
+            'study_class_results', {_per_quarter('study_class_results', ['avg', 'studyclass'], 'studyclass::int')},
+            'some_subject_result', {_per_quarter('some_subject_result', some_subject_columns)},
+            'exam_method_results', {_per_quarter('exam_method_results', ['exam_method', 'students_count', 'count', 'percentage', 'result'])}
+        )), '{{}}') AS results
+        FROM quarters;
+    """
+
+    return query, {
+        "exam_year": params.exam_year,
+        "exam_quarters": list(exam_quarters),
+        "territory": params.territory,
+        "school": params.school,
+        "exam_method": params.exam_method,
+        "study_class": params.study_class,
+        "region": params.region,
+        "subject": params.subject
+    }
+
+
+def available_territories_classes_query():
+    query = """
+        WITH all_territories AS (SELECT DISTINCT territory as territories
+                                FROM um_school),
+            all_classes AS (SELECT DISTINCT CAST(studystream as INT) as classes
+                            FROM um_student_exams
+                            ORDER BY CAST(studystream as INT)) 
+        SELECT JSON_BUILD_OBJECT('all_territories', (SELECT JSON_AGG(territories) FROM all_territories),
+            'all_classes', (SELECT JSON_AGG(classes) FROM all_classes)) AS result;
+        """     
+    return query, None
+
+
+def index_usage_query():
+    query = """
+        SELECT
+            (SELECT COALESCE(JSON_AGG(indexname), '[]')
+             FROM pg_indexes
+             WHERE schemaname = current_schema()) AS existing,
+            (SELECT COALESCE(JSON_AGG(JSON_BUILD_OBJECT(
+                        'index', stats.indexrelname,
+                        'table', stats.relname,
+                        'size', pg_size_pretty(pg_relation_size(stats.indexrelid))
+                    )), '[]')
+             FROM pg_stat_user_indexes stats
+                      JOIN pg_index ON pg_index.indexrelid = stats.indexrelid
+             WHERE stats.idx_scan = 0
+               AND NOT pg_index.indisunique
+               AND NOT pg_index.indisprimary
+               AND stats.relname LIKE 'um\\_%') AS unused,
+            (SELECT COALESCE(JSON_AGG(JSON_BUILD_OBJECT(
+                        'table', relname,
+                        'seq_scan', seq_scan,
+                        'idx_scan', idx_scan,
+                        'rows', n_live_tup
+                    )), '[]')
+             FROM pg_stat_user_tables
+             WHERE relname LIKE 'um\\_%'
+               AND seq_scan > COALESCE(idx_scan, 0)
+               AND n_live_tup > 10000) AS seq_scanned;
+    """
+    return query, None
+
+
+def _score_rates_cte():
+    """`rates` CTE of one period: the mean max_point_over_all of its subjects and the one of every subject"""
+    rate_subjects = [subject for subjects in score_subjects.values() for subject in subjects]
+    rate_columns = ",\n                              ".join(
+        f"""MAX(max_point_over_all) FILTER (WHERE subject = '{subject}') AS "{subject}\""""
+        for subject in rate_subjects
+    )
+    return f"""rates AS (SELECT AVG(max_point_over_all) AS overall,
+                              {rate_columns}
+                       FROM um_rate
+                       WHERE exam_year = %(exam_year)s
+                         AND exam_quarter = %(exam_quarter)s)"""
+
+
+def _score_column(column):
+    """Percentage of the max point of one um_student_scores column, from whichever of its subjects the exam has"""
+    return "COALESCE({})".format(
+        ", ".join(f"""ROUND((results -> '{subject}' ->> 'all_point')::numeric / rates."{subject}" * 100, 1)"""
+                  for subject in score_subjects[column]))
+
+
+def refresh_student_scores_query(exam_year, exam_quarter, exams_table="um_student_exams", ids=None):
+    """Upsert the normalized percentage columns of um_student_scores for one period, or only for the
+    exams `ids` of it, read from `exams_table` (the staging table of an import about to be published,
+    see PgConn.publish_period)"""
+    score_columns = ",\n               ".join(f"{_score_column(column)} AS {column}" for column in score_subjects)
+    ids_filter = "AND um_student_exams.id = ANY(%(ids)s)" if ids is not None else ""
+
+    query = f"""
+        WITH {_score_rates_cte()}
+        INSERT INTO um_student_scores (id, exam_year, exam_quarter, average, {", ".join(score_subjects)})
+        SELECT um_student_exams.id,
+               exam_year,
+               exam_quarter,
+               ROUND(average_point::numeric / rates.overall * 100, 1) AS average,
+               {score_columns}
+        FROM {exams_table} AS um_student_exams
+                 CROSS JOIN rates
+        WHERE exam_year = %(exam_year)s
+          AND exam_quarter = %(exam_quarter)s
+          {ids_filter}
+        ON CONFLICT (id, exam_year, exam_quarter) DO UPDATE SET
+            average = EXCLUDED.average,
+            {", ".join(f"{column} = EXCLUDED.{column}" for column in score_subjects)};
+    """
+    return query, {"exam_year": exam_year, "exam_quarter": exam_quarter, "ids": list(ids) if ids is not None else None}
+
+
+def rescore_subject_query(exam_year, exam_quarter, subject):
+    """Update the um_student_scores of one period after the max point of `subject` changed: the
+    columns fed by that subject, and the average, which divides by the mean max point of all of them"""
+    columns = [column for column, subjects in score_subjects.items() if subject in subjects]
+    assignments = ",\n            ".join(
+        ["average = ROUND(um_student_exams.average_point::numeric / rates.overall * 100, 1)"]
+        + [f"{column} = {_score_column(column)}" for column in columns])
+
+    query = f"""
+        WITH {_score_rates_cte()}
+        UPDATE um_student_scores
+        SET {assignments}
+        FROM um_student_exams
+                 CROSS JOIN rates
+        WHERE um_student_scores.id = um_student_exams.id
+          AND um_student_scores.exam_year = um_student_exams.exam_year
+          AND um_student_scores.exam_quarter = um_student_exams.exam_quarter
+          AND um_student_scores.exam_year = %(exam_year)s
+          AND um_student_scores.exam_quarter = %(exam_quarter)s
+          AND um_student_exams.exam_year = %(exam_year)s
+          AND um_student_exams.exam_quarter = %(exam_quarter)s;
+    """
+    return query, {"exam_year": exam_year, "exam_quarter": exam_quarter}
+
+
+def update_rate_query(rate: RateUpdate, changed_by=None):
+    """Apply the changes of `rate` as a new version of its um_rate row, the replaced version is kept
+    in um_rate_history. Returns nothing when the row does not exist or nothing actually changed."""
+    changes = rate.changes()
+    columns = ", ".join(changes)
+    values = ", ".join(f"%({column})s" for column in changes)
+    query = f"""
+        WITH previous AS (SELECT *
+                          FROM um_rate
+                          WHERE exam_year = %(exam_year)s
+                            AND exam_quarter = %(exam_quarter)s
+                            AND subject = %(subject)s
+                              FOR UPDATE),
+             changed AS (SELECT *
+                         FROM previous
+                         WHERE ROW({columns}) IS DISTINCT FROM ROW({values})),
+             history AS (INSERT INTO um_rate_history (exam_year, exam_quarter, subject, version, rate, replaced_by)
+                         SELECT exam_year, exam_quarter, subject, version, TO_JSONB(changed) - 'id', %(changed_by)s
+                         FROM changed)
+        UPDATE um_rate
+        SET {", ".join(f"{column} = %({column})s" for column in changes)},
+            version = um_rate.version + 1,
+            updated_at = CURRENT_TIMESTAMP
+        FROM changed
+        WHERE um_rate.id = changed.id
+        RETURNING um_rate.version,
+                  um_rate.max_point_over_all IS DISTINCT FROM changed.max_point_over_all AS max_point_changed;
+    """
+    return query, {
+        **changes,
+        "exam_year": rate.exam_year,
+        "exam_quarter": rate.exam_quarter,
+        "subject": rate.subject,
+        "changed_by": changed_by,
+    }
+
+
+def rates_query(exam_year, exam_quarter):
+    query = """
+        SELECT JSON_AGG(JSON_BUILD_OBJECT(
+                   'subject', um_rate.subject,
+                   'version', um_rate.version,
+                   'updated_at', um_rate.updated_at,
+                   'rate', TO_JSONB(um_rate) - 'id',
+                   'history', COALESCE((SELECT JSON_AGG(JSON_BUILD_OBJECT(
+                                                   'version', version,
+                                                   'rate', rate,
+                                                   'replaced_by', replaced_by,
+                                                   'replaced_at', replaced_at) ORDER BY version DESC)
+                                        FROM um_rate_history
+                                        WHERE um_rate_history.exam_year = um_rate.exam_year
+                                          AND um_rate_history.exam_quarter = um_rate.exam_quarter
+                                          AND um_rate_history.subject = um_rate.subject), '[]'))
+                   ORDER BY um_rate.subject) AS result
+        FROM um_rate
+        WHERE exam_year = %(exam_year)s
+          AND exam_quarter = %(exam_quarter)s;
+    """
+    return query, {"exam_year": exam_year, "exam_quarter": exam_quarter}
+
+
+def insert_rate_query(rate: RateUpdate):
+    """Insert `rate` unless its period already has a row for the subject"""
+    columns = {"exam_year": rate.exam_year, "exam_quarter": rate.exam_quarter, "subject": rate.subject, **rate.changes()}
+    query = f"""
+        INSERT INTO um_rate ({", ".join(columns)})
+        VALUES ({", ".join(f"%({column})s" for column in columns)})
+        ON CONFLICT (exam_year, exam_quarter, subject) DO NOTHING;
+    """
+    return query, columns
+
+
+def exam_hashes_query(exam_year, exam_quarter):
+    query = """
+        SELECT id, row_hash, school_id
+        FROM um_student_exams
+        WHERE exam_year = %(exam_year)s
+          AND exam_quarter = %(exam_quarter)s;
+    """
+    return query, {
+        "exam_year": exam_year,
+        "exam_quarter": exam_quarter,
+    }
+
+
+def delete_exams_query(exam_year, exam_quarter, ids, exams_table="um_student_exams"):
+    query = f"""
+        DELETE FROM {exams_table}
+        WHERE exam_year = %(exam_year)s
+          AND exam_quarter = %(exam_quarter)s
+          AND id = ANY(%(ids)s);
+    """
+    return query, {"exam_year": exam_year, "exam_quarter": exam_quarter, "ids": list(ids)}
+
+
+def delete_removed_scores_query(exam_year, exam_quarter, ids, exams_table="um_student_exams"):
+    """Delete the um_student_scores of the exams `ids` that are no longer in `exams_table`"""
+    query = f"""
+        DELETE FROM um_student_scores
+        WHERE exam_year = %(exam_year)s
+          AND exam_quarter = %(exam_quarter)s
+          AND id = ANY(%(ids)s)
+          AND NOT EXISTS (SELECT 1
+                          FROM {exams_table} AS um_student_exams
+                          WHERE um_student_exams.id = um_student_scores.id
+                            AND um_student_exams.exam_year = %(exam_year)s
+                            AND um_student_exams.exam_quarter = %(exam_quarter)s);
+    """
+    return query, {"exam_year": exam_year, "exam_quarter": exam_quarter, "ids": list(ids)}
+
+
+def rebuild_school_results_query(exam_year, exam_quarter, school_ids=None, exams_table="um_student_exams",
+                                  results_table="um_school_results"):
+    """Recompute um_school_results of one period (of some of its schools if `school_ids` is given)
+    from the student exams, the same results / average_point documents the importer computes with
+    utils.clearly_insert_excel.school_results_frame. Schools left without exams lose their row."""
+    def points(decimals):
+        return ", ".join(
+            f"'{point_type}', ROUND(AVG(point) FILTER (WHERE point_type = '{point_type}'), {decimals})::FLOAT8"
+            for point_type in point_types)
+
+    query = f"""
+        WITH exams AS (SELECT school_id, exam_method, studystream, results
+                       FROM {exams_table}
+                       WHERE exam_year = %(exam_year)s
+                         AND exam_quarter = %(exam_quarter)s
+                         AND (%(school_ids)s::TEXT[] IS NULL OR school_id = ANY(%(school_ids)s))),
+             -- Every class is listed under 'all', even one without any subject results
+             class_keys AS (SELECT DISTINCT school_id, studystream FROM exams),
+             points AS (SELECT exams.school_id,
+                               exams.exam_method,
+                               exams.studystream,
+                               subject.key                   AS subject,
+                               point.key                     AS point_type,
+                               point.value::TEXT::NUMERIC    AS point
+                        FROM exams
+                                 CROSS JOIN LATERAL JSONB_EACH(exams.results) AS subject
+                                 CROSS JOIN LATERAL JSONB_EACH(subject.value) AS point
+                        WHERE JSONB_TYPEOF(subject.value) = 'object'
+                          AND JSONB_TYPEOF(point.value) = 'number'
+                          AND point.key IN ({", ".join(f"'{point_type}'" for point_type in point_types)})),
+             -- 'all' covers every exam, the per method results only the online and offline ones
+             method_points AS (SELECT school_id, exam_method, studystream, subject, point_type, point
+                               FROM points
+                               WHERE exam_method IN ('on', 'off')
+                               UNION ALL
+                               SELECT school_id, 'all', studystream, subject, point_type, point
+                               FROM points),
+             class_subjects AS (SELECT school_id,
+                                       exam_method,
+                                       studystream,
+                                       subject,
+                                       JSONB_BUILD_OBJECT({points(2)}) AS points,
+                                       ROUND(AVG(point) FILTER (WHERE point_type = 'all_point'), 2) AS all_point
+                                FROM method_points
+                                GROUP BY school_id, exam_method, studystream, subject),
+             school_subjects AS (SELECT school_id,
+                                        exam_method,
+                                        subject,
+                                        JSONB_BUILD_OBJECT({points(5)}) AS points,
+                                        ROUND(AVG(point) FILTER (WHERE point_type = 'all_point'), 5) AS all_point
+                                 FROM method_points
+                                 GROUP BY school_id, exam_method, subject),
+             -- Average point of a class: mean all_point of its subjects, rounded for 'on' / 'off' but not for 'all'
+             classes AS (SELECT school_id,
+                                exam_method,
+                                studystream,
+                                JSONB_OBJECT_AGG(subject, points) AS subjects,
+                                CASE
+                                    WHEN exam_method = 'all' THEN AVG(all_point)
+                                    ELSE ROUND(AVG(all_point), 2) END AS average
+                         FROM class_subjects
+                         GROUP BY school_id, exam_method, studystream),
+             listed_classes AS (SELECT school_id, exam_method, studystream, subjects, average
+                                FROM classes
+                                WHERE exam_method <> 'all'
+                                UNION ALL
+                                SELECT class_keys.school_id,
+                                       'all',
+                                       class_keys.studystream,
+                                       COALESCE(classes.subjects, '{{}}'),
+                                       classes.average
+                                FROM class_keys
+                                         LEFT JOIN classes ON classes.school_id = class_keys.school_id
+                                    AND classes.studystream = class_keys.studystream
+                                    AND classes.exam_method = 'all'),
+             methods AS (SELECT school_id,
+                                exam_method,
+                                JSONB_OBJECT_AGG(studystream, subjects) AS results,
+                                JSONB_OBJECT_AGG(studystream, average::FLOAT8) AS averages,
+                                ROUND(AVG(average), 2) AS overall
+                         FROM listed_classes
+                         GROUP BY school_id, exam_method),
+             school_avgs AS (SELECT school_id,
+                                    exam_method,
+                                    JSONB_OBJECT_AGG(subject, points) AS school_avg,
+                                    ROUND(AVG(all_point), 5) AS overall
+                             FROM school_subjects
+                             GROUP BY school_id, exam_method),
+             schools AS (SELECT methods.school_id,
+                                JSONB_OBJECT_AGG(methods.exam_method, methods.results || JSONB_BUILD_OBJECT(
+                                    'school_avg', COALESCE(school_avgs.school_avg, '{{}}'))) AS results,
+                                -- Overall 'all' average: mean of the school-wide subject all_points
+                                JSONB_OBJECT_AGG(methods.exam_method, methods.averages || JSONB_BUILD_OBJECT(
+                                    'overall', CASE
+                                                   WHEN methods.exam_method = 'all' THEN school_avgs.overall
+                                                   ELSE methods.overall END::FLOAT8)) AS average_point
+                         FROM methods
+                                  LEFT JOIN school_avgs ON school_avgs.school_id = methods.school_id
+                             AND school_avgs.exam_method = methods.exam_method
+                         GROUP BY methods.school_id),
+             removed AS (DELETE FROM {results_table}
+                         WHERE exam_year = %(exam_year)s
+                           AND exam_quarter = %(exam_quarter)s
+                           AND (%(school_ids)s::TEXT[] IS NULL OR school_id = ANY(%(school_ids)s))
+                           AND school_id NOT IN (SELECT school_id FROM class_keys))
+        INSERT INTO {results_table} (school_id, results, average_point, exam_year, exam_quarter)
+        SELECT school_id,
+               results,
+               -- The importer always reported 'off' with the averages of 'all', keep that output
+               CASE
+                   WHEN average_point ? 'off' THEN JSONB_SET(average_point, '{{off}}', average_point -> 'all')
+                   ELSE average_point END,
+               %(exam_year)s,
+               %(exam_quarter)s
+        FROM schools
+        ON CONFLICT (school_id, exam_year, exam_quarter) DO UPDATE SET
+            results = EXCLUDED.results,
+            average_point = EXCLUDED.average_point;
+    """
+    return query, {
+        "exam_year": exam_year,
+        "exam_quarter": exam_quarter,
+        "school_ids": [str(school_id) for school_id in school_ids] if school_ids is not None else None,
+    }
+
+
+def create_import_job_query(kind, filename, exam_year, exam_quarter):
+    query = """
+        INSERT INTO um_import_jobs (kind, filename, exam_year, exam_quarter)
+        VALUES (%(kind)s, %(filename)s, %(exam_year)s, %(exam_quarter)s)
+        RETURNING id;
+    """
+    return query, {
+        "kind": kind,
+        "filename": filename,
+        "exam_year": exam_year,
+        "exam_quarter": exam_quarter,
+    }
+
+
+def import_job_query(job_id):
+    query = """
+        SELECT ROW_TO_JSON(job) AS result
+        FROM (SELECT id, kind, exam_year, exam_quarter, status, stage,
+                     rows_total, rows_parsed, rows_loaded, error, report,
+                     created_at, started_at, finished_at,
+                     EXTRACT(EPOCH FROM COALESCE(finished_at, CURRENT_TIMESTAMP) - started_at) AS elapsed_seconds
+              FROM um_import_jobs
+              WHERE id = %(job_id)s) job;
+    """
+    return query, {"job_id": job_id}
+
+
+def claimable_import_jobs_query():
+    # A running job is only taken over when the advisory lock of its worker is free (lock_import_job_query)
+    query = """
+        SELECT id
+        FROM um_import_jobs
+        WHERE status IN ('queued', 'running')
+        ORDER BY id;
+    """
+    return query, None
+
+
+def lock_import_job_query(job_id):
+    # Session level: held by the worker's connection until the job is done or the worker is gone
+    query = """
+        SELECT pg_try_advisory_lock(hashtext('um_import_jobs'), %(job_id)s) AS locked;
+    """
+    return query, {"job_id": job_id}
+
+
+def unlock_import_job_query(job_id):
+    query = """
+        SELECT pg_advisory_unlock(hashtext('um_import_jobs'), %(job_id)s) AS unlocked;
+    """
+    return query, {"job_id": job_id}
+
+
+def claim_import_job_query(job_id):
+    # Under the job's advisory lock, the status check only skips a job finished in the meantime
+    query = """
+        UPDATE um_import_jobs
+        SET status = 'running',
+            stage = NULL,
+            rows_parsed = 0,
+            rows_loaded = 0,
+            error = NULL,
+            started_at = CURRENT_TIMESTAMP,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = %(job_id)s AND status IN ('queued', 'running')
+        RETURNING id, kind, filename, exam_year, exam_quarter;
+    """
+    return query, {"job_id": job_id}
+
+
+def update_import_job_query(job_id, status=None, stage=None, rows_total=None, rows_parsed=None, rows_loaded=None,
+                            error=None, report=None):
+    # NULL keeps the current value
+    query = """
+        UPDATE um_import_jobs
+        SET status = COALESCE(%(status)s, status),
+            stage = COALESCE(%(stage)s, stage),
+            rows_total = COALESCE(%(rows_total)s, rows_total),
+            rows_parsed = COALESCE(%(rows_parsed)s, rows_parsed),
+            rows_loaded = COALESCE(%(rows_loaded)s, rows_loaded),
+            error = COALESCE(%(error)s, error),
+            report = COALESCE(%(report)s::JSONB, report),
+            updated_at = CURRENT_TIMESTAMP,
+            finished_at = CASE WHEN %(status)s IN ('done', 'failed') THEN CURRENT_TIMESTAMP ELSE finished_at END
+        WHERE id = %(job_id)s;
+    """
+    return query, {
+        "job_id": job_id,
+        "status": status,
+        "stage": stage,
+        "rows_total": rows_total,
+        "rows_parsed": rows_parsed,
+        "rows_loaded": rows_loaded,
+        "error": error,
+        "report": report,
+    }
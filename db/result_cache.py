@@ -0,0 +1,29 @@
+""" This module caches the report queries (results, schools, students) until their period is re-imported"""
+
+import copy
+
+from config.config import RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+from utils.cache import LRUCache
+
+result_cache = LRUCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+
+
+def result_key(kind, request, versions):
+    """Key of a report: the normalized request plus the um_data_version of its period, so a
+    re-import in another process makes the old entries unreachable"""
+    period = (request.exam_year, request.exam_quarter)
+    version = (versions or {}).get(f"{request.exam_year}-{request.exam_quarter}")
+    return (kind, period, version, tuple(sorted(request.model_dump().items())))
+
+
+def get(key):
+    # Handlers clean the rows in place, never hand out the cached object
+    return copy.deepcopy(result_cache.get(key))
+
+
+def put(key, value):
+    result_cache.set(key, copy.deepcopy(value))
+
+
+def invalidate_period(exam_year, exam_quarter):
+    return result_cache.invalidate(lambda key: key[1] == (exam_year, exam_quarter))
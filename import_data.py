@@ -0,0 +1,97 @@
+"""Command line import of exam periods and teachers from Excel files.
+
+    python import_data.py --job chsb_24_25_1.xlsx 2024/2025 1 --job chsb_24_25_2.xlsx 2024/2025 2
+    python import_data.py --teachers teachers_24_25.xlsx 2024/2025
+    python import_data.py --school-results 2024/2025 1 --schools 101 102
+
+Every period is parsed and loaded in its own process, then a per-stage timing and memory report is printed.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from db.db import PgConn
+from db.pool import close_pool
+from utils.clearly_insert_excel import insert_data_to_tables, inserting_teachers
+from utils.import_report import ImportReport
+
+
+def import_period(job):
+    filename, year, quarter = job
+    return insert_data_to_tables(filename=filename, quarter=quarter, year=year)
+
+
+def import_periods(jobs, workers):
+    """Import every (file, year, quarter) job, up to `workers` periods at a time"""
+    if workers <= 1 or len(jobs) <= 1:
+        return [import_period(job) for job in jobs]
+
+    # Spawned, not forked, so no child inherits the connections of the parent's pool
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return list(executor.map(import_period, jobs))
+
+
+def import_teachers(filename, year):
+    report = ImportReport(f"{filename} (teachers {year})")
+    try:
+        with report.stage('teachers'):
+            inserting_teachers(filename=filename, year=year)
+    except Exception as e:
+        return report.finish(error=str(e))
+    return report.finish()
+
+
+def rebuild_school_results(year, quarter, school_ids):
+    """Recompute um_school_results of a period in the database, e.g. after exams were corrected in place"""
+    report = ImportReport(f"school results ({year} Q{quarter})")
+    try:
+        db = PgConn()
+        with report.stage('school aggregation'):
+            print(f"um_school_results: {db.rebuild_school_results(year, quarter, school_ids)} rows")
+        db.bump_data_version(year, quarter)
+    except Exception as e:
+        return report.finish(error=str(e))
+    return report.finish()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import exam results and teachers from Excel files")
+    parser.add_argument("--job", nargs=3, action="append", default=[], metavar=("FILE", "YEAR", "QUARTER"),
+                        help="exam results of one period, may be given several times")
+    parser.add_argument("--teachers", nargs=2, action="append", default=[], metavar=("FILE", "YEAR"),
+                        help="teachers of one year, imported after the periods")
+    parser.add_argument("--school-results", nargs=2, action="append", default=[], metavar=("YEAR", "QUARTER"),
+                        help="recompute um_school_results of one period from its exams, run last")
+    parser.add_argument("--schools", nargs="+", default=None, metavar="SCHOOL_ID",
+                        help="limit --school-results to these schools")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="periods imported in parallel (default: one per job, at most the CPU count)")
+    args = parser.parse_args(argv)
+
+    if not args.job and not args.teachers and not args.school_results:
+        parser.error("nothing to import, give at least one --job, --teachers or --school-results")
+    periods = [(year, quarter) for _, year, quarter in args.job]
+    if len(set(periods)) != len(periods):
+        parser.error("every period may only be imported by one job")
+
+    db = PgConn()
+    db.create_tables()
+    db.create_indexes()
+    close_pool()
+
+    workers = args.workers or min(len(args.job), os.cpu_count() or 1)
+    reports = import_periods([tuple(job) for job in args.job], workers)
+    reports += [import_teachers(filename, year) for filename, year in args.teachers]
+    reports += [rebuild_school_results(year, quarter, args.schools) for year, quarter in args.school_results]
+
+    print()
+    for report in reports:
+        print(report.format())
+    return 1 if any(report.error for report in reports) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
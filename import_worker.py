@@ -0,0 +1,69 @@
+"""Worker process running the import jobs queued through POST /admin/import.
+
+    python import_worker.py
+
+Several workers may run at once, every job is taken by exactly one of them. A worker holds an
+advisory lock on its job for as long as it runs it, a running job is only taken over by another
+worker once that lock is gone with the connection of its worker.
+"""
+
+import json
+import logging
+import time
+
+from config.config import IMPORT_POLL_INTERVAL
+from db.db import PgConn
+from db.pool import get_pool
+from utils.clearly_insert_excel import insert_data_to_tables, inserting_teachers
+from utils.import_report import ImportReport
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+
+def run_job(db, job):
+    """Run one claimed job, its stage and row counts are written to um_import_jobs as it goes"""
+    period = " ".join(str(value) for value in (job['exam_year'], job['exam_quarter']) if value)
+    report = ImportReport(f"{job['filename']} ({job['kind']} {period})",
+                          on_progress=lambda progress: db.update_import_job(job['id'], **progress))
+    if job['kind'] == 'exams':
+        insert_data_to_tables(filename=job['filename'], quarter=job['exam_quarter'], year=job['exam_year'], report=report)
+    else:
+        try:
+            with report.stage('teachers'):
+                inserting_teachers(filename=job['filename'], year=job['exam_year'])
+            report.finish()
+        except Exception as e:
+            report.finish(error=str(e))
+
+    db.update_import_job(job['id'], status='failed' if report.error else 'done', error=report.error,
+                         report=json.dumps(report.as_dict()))
+    return report
+
+
+def main():
+    db = PgConn()
+    logger.info("Import worker started")
+    while True:
+        # The job's advisory lock lives on this connection, it stays checked out until the job is done
+        with get_pool().connection() as conn:
+            lock = PgConn(conn)
+            job = lock.claim_import_job()
+            if job is not None:
+                try:
+                    logger.info("Running import job %s (%s)", job['id'], job['filename'])
+                    report = run_job(db, job)
+                    logger.info("Import job %s finished\n%s", job['id'], report.format())
+                finally:
+                    lock.release_import_job(job['id'])
+
+        if job is None:
+            time.sleep(IMPORT_POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,6 @@ from app import pages
 from db.db import PgConn
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from utils.clearly_insert_excel import insert_data_to_tables, inserting_teachers
 # from models.models import StudentRequest, SchoolRequest, ResultRequest
 
 # Set up logging configuration
@@ -26,8 +25,11 @@ if __name__ == "__main__":
     print("Creating tables")
     db.create_tables()
     db.create_indexes()
+    index_report = db.check_indexes()
+    if any(index_report.values()):
+        logger.warning("Index check: %s", index_report)
+    db.refresh_missing_student_scores()
     db.insert_admins()
-    print("Inserting data")
-    # insert_data_to_tables(filename="chsb_23_24_1.xlsx", quarter="1", year="2024/2025")
-    inserting_teachers(filename="teachers_24_25.xlsx", year="2024/2025")
+    # Imports no longer run at boot: upload through POST /admin/import (run by import_worker.py)
+    # or run import_data.py, e.g. python import_data.py --job chsb_23_24_1.xlsx 2024/2025 1
     uvicorn.run("main:app", host="0.0.0.0", port=3132, reload=True)
@@ -3,7 +3,9 @@
 # from uuid import UUID
 from datetime import datetime
 from pydantic import BaseModel, Field, field_validator
-from typing import Optional
+from typing import List, Literal, Optional
+
+from utils.const import all_subjects
 
 class BaseRequest(BaseModel):
     exam_quarter: str = Field(..., alias="examQuarter")
@@ -27,6 +29,7 @@ class SchoolRequest(BaseModel):
     exam_year: str = Field(..., alias="examYear")
 
     page: Optional[int] = Field(1, alias="page")
+    cursor: Optional[str] = Field(None, alias="cursor")
     territory: Optional[str] = Field(None, alias="territory")  # Make this optional
     region : Optional[str] = Field(None, alias="region")
     subject : Optional[str] = Field(None, alias="subject")
@@ -44,10 +47,17 @@ class SchoolRequest(BaseModel):
             raise ValueError("examYear cannot be null or empty")
         return v
     
-    @field_validator('territory', 'region', 'study_class', 'subject', mode='before')
+    @field_validator('territory', 'region', 'study_class', 'subject', 'cursor', mode='before')
     def convert_empty_string_to_none(cls, v):
         return None if v == "" else v
 
+    # The subject names a score column the report queries interpolate
+    @field_validator('subject')
+    def check_subject(cls, v):
+        if v is not None and v not in all_subjects:
+            raise ValueError("subject is not a known subject")
+        return v
+
 class StudentRequest(BaseModel):
     exam_quarter: str = Field(..., alias="examQuarter")
     exam_year: str = Field(..., alias="examYear")
@@ -58,6 +68,7 @@ class StudentRequest(BaseModel):
     school: Optional[str] = Field(None, alias="school")
     subject : Optional[str] = Field(None, alias="subject")
     page : Optional[int] = Field(1, alias="page")
+    cursor: Optional[str] = Field(None, alias="cursor")
 
     @field_validator('exam_quarter')
     def check_exam_quarter(cls, v):
@@ -71,10 +82,17 @@ class StudentRequest(BaseModel):
             raise ValueError("examYear cannot be null or empty")
         return v
     
-    @field_validator('territory', 'study_class', 'region', 'school', 'subject', mode='before')
+    @field_validator('territory', 'study_class', 'region', 'school', 'subject', 'cursor', mode='before')
     def convert_empty_string_to_none(cls, v):
         return None if v == "" else v
 
+    # The subject names a score column the report queries interpolate
+    @field_validator('subject')
+    def check_subject(cls, v):
+        if v is not None and v not in all_subjects:
+            raise ValueError("subject is not a known subject")
+        return v
+
 class ResultRequest(BaseModel):
     exam_quarter: str = Field(..., alias="examQuarter")
     exam_year: str = Field(..., alias="examYear")
@@ -86,6 +104,7 @@ class ResultRequest(BaseModel):
     exam_method: Optional[str] = Field(None, alias="examMethod")
     subject: Optional[str] = Field(None, alias="subject")
     page : Optional[int] = Field(1, alias="page")
+    cursor: Optional[str] = Field(None, alias="cursor")
     
     
     @field_validator('exam_quarter')
@@ -100,9 +119,16 @@ class ResultRequest(BaseModel):
             raise ValueError("examYear cannot be null or empty")
         return v
     
-    @field_validator('territory', 'study_class', 'school', 'exam_method', 'subject', 'region', mode='before')
+    @field_validator('territory', 'study_class', 'school', 'exam_method', 'subject', 'region', 'cursor', mode='before')
     def convert_empty_string_to_none(cls, v):
         return None if v == "" else v
+
+    # The subject names a score column the report queries interpolate
+    @field_validator('subject')
+    def check_subject(cls, v):
+        if v is not None and v not in all_subjects:
+            raise ValueError("subject is not a known subject")
+        return v
     
 class CompareRequest(BaseModel):
     exam_year: str = Field(..., alias="examYear")
@@ -131,15 +157,25 @@ class CompareRequest(BaseModel):
     def convert_empty_string_to_none(cls, v):
         return None if v == "" else v
 
+    # The subject names a score column the report queries interpolate
+    @field_validator('subject')
+    def check_subject(cls, v):
+        if v is not None and v not in all_subjects:
+            raise ValueError("subject is not a known subject")
+        return v
+
 class SchoolListRequest(BaseModel):
-    exam_quarter: str = Field(..., alias="examQuarter")
+    exam_quarter: Optional[str] = Field(None, alias="examQuarter")
+    # Several quarters answered at once, neither given means every quarter of the exam year
+    exam_quarters: Optional[List[str]] = Field(None, alias="examQuarters")
+    mode: Literal["union", "intersection"] = Field("union", alias="mode")
     exam_year: str = Field(..., alias="examYear")
     territory : str = Field(..., alias="territory")
     region : str = Field(..., alias="region")
 
     @field_validator('exam_quarter')
     def check_exam_quarter(cls, v):
-        if not v or v.strip() == "":
+        if v is not None and v.strip() == "":
             raise ValueError("examQuarter cannot be null or empty")
         return v
     
@@ -160,15 +196,27 @@ class SchoolListRequest(BaseModel):
         if not v or v.strip() == "":
             raise ValueError("region cannot be null or empty")
         return v
+
+    @property
+    def quarters(self):
+        if self.exam_quarters:
+            return list(dict.fromkeys(self.exam_quarters))
+        if self.exam_quarter:
+            return [self.exam_quarter]
+        return None
     
+
 class RegionListRequest(BaseModel):
-    exam_quarter: str = Field(..., alias="examQuarter")
+    exam_quarter: Optional[str] = Field(None, alias="examQuarter")
+    # Several quarters answered at once, neither given means every quarter of the exam year
+    exam_quarters: Optional[List[str]] = Field(None, alias="examQuarters")
+    mode: Literal["union", "intersection"] = Field("union", alias="mode")
     exam_year: str = Field(..., alias="examYear")
     territory : str = Field(..., alias="territory")
     
     @field_validator('exam_quarter')
     def check_exam_quarter(cls, v):
-        if not v or v.strip() == "":
+        if v is not None and v.strip() == "":
             raise ValueError("examQuarter cannot be null or empty")
         return v
     
@@ -183,7 +231,70 @@ class RegionListRequest(BaseModel):
         if not v or v.strip() == "":
             raise ValueError("territory cannot be null or empty")
         return v
+
+    @property
+    def quarters(self):
+        if self.exam_quarters:
+            return list(dict.fromkeys(self.exam_quarters))
+        if self.exam_quarter:
+            return [self.exam_quarter]
+        return None
     
+
+class HierarchyRequest(BaseModel):
+    exam_year: str = Field(..., alias="examYear")
+    exam_quarters: List[str] = Field(..., alias="examQuarters")
+    territory: Optional[str] = Field(None, alias="territory")
+    region: Optional[str] = Field(None, alias="region")
+
+    @field_validator('exam_year')
+    def check_exam_year(cls, v):
+        if not v or v.strip() == "":
+            raise ValueError("examYear cannot be null or empty")
+        return v
+
+    @field_validator('exam_quarters')
+    def check_exam_quarters(cls, v):
+        if not v:
+            raise ValueError("examQuarters cannot be empty")
+        return v
+
+    @field_validator('territory', 'region', mode='before')
+    def convert_empty_string_to_none(cls, v):
+        return None if v == "" else v
+
+class RateUpdate(BaseModel):
+    exam_quarter: str = Field(..., alias="examQuarter")
+    exam_year: str = Field(..., alias="examYear")
+    subject: str = Field(..., alias="subject")
+
+    # Only the given columns of the um_rate row are changed
+    knowing_question_count: Optional[int] = Field(None, alias="knowingQuestionCount")
+    knowing_point_per_question: Optional[int] = Field(None, alias="knowingPointPerQuestion")
+    applying_question_count: Optional[int] = Field(None, alias="applyingQuestionCount")
+    applying_point_per_question: Optional[int] = Field(None, alias="applyingPointPerQuestion")
+    reviewing_question_count: Optional[int] = Field(None, alias="reviewingQuestionCount")
+    reviewing_point_per_question: Optional[int] = Field(None, alias="reviewingPointPerQuestion")
+    all_question_count: Optional[int] = Field(None, alias="allQuestionCount")
+    max_point_over_all: Optional[int] = Field(None, alias="maxPointOverAll")
+
+    @field_validator('exam_quarter', 'exam_year', 'subject')
+    def check_not_empty(cls, v):
+        if not v or v.strip() == "":
+            raise ValueError("examQuarter, examYear and subject cannot be null or empty")
+        return v
+
+    @field_validator('max_point_over_all')
+    def check_max_point(cls, v):
+        # Every normalized score divides by it
+        if v is not None and v <= 0:
+            raise ValueError("maxPointOverAll must be positive")
+        return v
+
+    def changes(self):
+        """The um_rate columns to update and their new values"""
+        return self.model_dump(exclude_none=True, exclude={"exam_quarter", "exam_year", "subject"})
+
 class UserLoginBody(BaseModel):
     username: str = Field(..., alias="username")
     password: str = Field(..., alias="password")
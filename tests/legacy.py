@@ -0,0 +1,211 @@
+""" This module keeps the row by row importer transforms the vectorized ones replaced, the tests compare both outputs"""
+
+import json
+
+import numpy as np
+import pandas as pd
+
+def transform_to_results_column_v2(df, subjects):
+    results_list = []
+
+    for _, row in df.iterrows():
+        subject_results = {}
+        for subject, prefix in subjects.items():
+            try:
+                knowing_data = row[subject]
+                applying_data = row[f'Unnamed: {df.columns.get_loc(subject) + 1}']
+                reviewing_data = row[f'Unnamed: {df.columns.get_loc(subject) + 2}']
+                all_data = row[f'Unnamed: {df.columns.get_loc(subject) + 3}']
+
+                knowing = round(float(knowing_data) if knowing_data != "NaN" and pd.notna(knowing_data) and knowing_data != '' else None, 1)
+                applying = round(float(applying_data) if applying_data != "NaN" and pd.notna(applying_data) and applying_data != '' else None, 1)
+                reviewing = round(float(reviewing_data) if reviewing_data != "NaN" and pd.notna(reviewing_data) and reviewing_data != '' else None, 1)
+                all_point = round(float(all_data) if all_data != "NaN" and pd.notna(all_data) and all_data != '' else None, 1)
+
+                subject_results[prefix] = {
+                    "knowing_point": knowing,
+                    "applying_point": applying,
+                    "reviewing_point": reviewing,
+                    "all_point": all_point
+                }
+            except Exception:
+                continue
+
+        results_list.append(subject_results)
+
+    df['results'] = results_list
+
+    return df
+
+
+def calculate_average_points(results):
+    try:
+        results = results.replace("NaN", "null").replace("'", "\"")
+        result_data = json.loads(results)
+
+        total_points = 0
+        count = 0
+
+        for subject, subject_data in result_data.items():
+            all_point = subject_data.get('all_point')
+            if all_point is not None:
+                total_points += all_point
+                count += 1
+
+        if count > 0:
+            return round(total_points / count, 1)
+        else:
+            return None
+    except Exception:
+        return None
+
+
+def calculate_results_by_school(df):
+    results_list = []
+
+    for school_id, group in df.groupby('school_id'):
+        school_results = {}
+        average_point = {}
+
+        for exam_method in ['on', 'off']:
+            class_averages = {}
+            method_group = group[group['exam_method'] == exam_method]
+
+            if not method_group.empty:
+                exam_method_results = {}
+                subject_totals_schoolwide = {}
+                subject_counts_schoolwide = {}
+
+                for studyclass, class_group in method_group.groupby('studystream'):
+                    subject_totals = {}
+                    subject_counts = {}
+
+                    for _, row in class_group.iterrows():
+                        results = json.loads(row['results'])
+
+                        for subject, data in results.items():
+                            for point_type in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']:
+                                point_value = data.get(point_type)
+                                if point_value is not None:
+                                    if subject not in subject_totals:
+                                        subject_totals[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
+                                        subject_counts[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
+
+                                    subject_totals[subject][point_type] += point_value
+                                    subject_counts[subject][point_type] += 1
+
+                                    if subject not in subject_totals_schoolwide:
+                                        subject_totals_schoolwide[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
+                                        subject_counts_schoolwide[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
+                                    subject_totals_schoolwide[subject][point_type] += point_value
+                                    subject_counts_schoolwide[subject][point_type] += 1
+
+                    studyclass_averages = {
+                        subject: {
+                            point_type: round(subject_totals[subject][point_type] / subject_counts[subject][point_type], 2)
+                            if subject_counts[subject][point_type] > 0 else None
+                            for point_type in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']
+                        } for subject in subject_totals
+                    }
+
+                    studyclass_average_point = round(np.nanmean([
+                        subject_data['all_point']
+                        for subject_data in studyclass_averages.values()
+                        if 'all_point' in subject_data
+                    ]), 2) if studyclass_averages else None
+
+                    if studyclass_averages:
+                        exam_method_results[studyclass] = studyclass_averages
+                    if studyclass_average_point is not None:
+                        class_averages[studyclass] = studyclass_average_point
+
+                overall_average_point = round(np.nanmean(list(class_averages.values())), 2) if class_averages else None
+                if overall_average_point is not None:
+                    class_averages['overall'] = overall_average_point
+
+                school_avg = {
+                    subject: {
+                        point_type: round(subject_totals_schoolwide[subject][point_type] / subject_counts_schoolwide[subject][point_type], 5)
+                        if subject_counts_schoolwide[subject][point_type] > 0 else None
+                        for point_type in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']
+                    } for subject in subject_totals_schoolwide
+                }
+
+                if exam_method_results:
+                    school_results[exam_method] = {**exam_method_results, 'school_avg': school_avg}
+                if class_averages:
+                    average_point[exam_method] = class_averages
+
+        school_results_all = {}
+        subject_totals_schoolwide_all = {}
+        subject_counts_schoolwide_all = {}
+
+        for studyclass, class_group in group.groupby('studystream'):
+            subject_totals = {}
+            subject_counts = {}
+
+            for _, row in class_group.iterrows():
+                results = json.loads(row['results'])
+
+                for subject, data in results.items():
+                    for point_type in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']:
+                        point_value = data.get(point_type)
+                        if point_value is not None:
+                            if subject not in subject_totals:
+                                subject_totals[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
+                                subject_counts[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
+
+                            subject_totals[subject][point_type] += point_value
+                            subject_counts[subject][point_type] += 1
+
+                            if subject not in subject_totals_schoolwide_all:
+                                subject_totals_schoolwide_all[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
+                                subject_counts_schoolwide_all[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
+                            subject_totals_schoolwide_all[subject][point_type] += point_value
+                            subject_counts_schoolwide_all[subject][point_type] += 1
+
+            studyclass_averages = {
+                subject: {
+                    point_type: round(subject_totals[subject][point_type] / subject_counts[subject][point_type], 2)
+                    if subject_counts[subject][point_type] > 0 else None
+                    for point_type in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']
+                } for subject in subject_totals
+            }
+
+            studyclass_average_point = np.nanmean([
+                subject_data['all_point']
+                for subject_data in studyclass_averages.values()
+                if 'all_point' in subject_data
+            ])
+            class_averages[studyclass] = studyclass_average_point
+
+            school_results_all[studyclass] = studyclass_averages
+
+        school_avg_all = {
+            subject: {
+                point_type: round(subject_totals_schoolwide_all[subject][point_type] / subject_counts_schoolwide_all[subject][point_type], 5)
+                if subject_counts_schoolwide_all[subject][point_type] > 0 else None
+                for point_type in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']
+            } for subject in subject_totals_schoolwide_all
+        }
+
+        overall_average_point = round(np.nanmean([
+            subject_data['all_point']
+            for subject_data in school_avg_all.values()
+            if 'all_point' in subject_data
+        ]), 5)
+
+        class_averages['overall'] = overall_average_point
+        school_results_all = {**school_results_all, 'school_avg': school_avg_all}
+        school_results['all'] = school_results_all
+        average_point['all'] = class_averages
+
+        results_list.append({
+            'school_id': school_id,
+            'results': school_results,
+            'average_point': average_point
+        })
+
+    results_df = pd.DataFrame(results_list)
+
+    return results_df
@@ -0,0 +1,111 @@
+import pytest
+
+from db import result_cache
+from models.models import SchoolRequest, StudentRequest
+from utils import cache
+from utils.cache import LRUCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_least_recently_used_entry_is_evicted():
+    lru = LRUCache(maxsize=2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    # Reading "a" makes "b" the oldest entry
+    assert lru.get("a") == 1
+    lru.set("c", 3)
+
+    assert lru.get("b") is None
+    assert lru.get("a") == 1 and lru.get("c") == 3
+    assert lru.stats()["evictions"] == 1
+    assert len(lru) == 2
+
+
+def test_overwritten_entry_is_not_evicted_twice():
+    lru = LRUCache(maxsize=2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.set("a", 10)
+    lru.set("c", 3)
+
+    assert lru.get("a") == 10
+    assert lru.get("b") is None
+    assert lru.stats()["evictions"] == 1
+
+
+def test_entry_expires_after_ttl(clock):
+    lru = LRUCache(maxsize=10, ttl=60)
+    lru.set("a", 1)
+
+    clock[0] += 60
+    assert lru.get("a") == 1
+    clock[0] += 1
+    assert lru.get("a", "missing") == "missing"
+
+    stats = lru.stats()
+    assert stats["expirations"] == 1
+    assert stats["hits"] == 1 and stats["misses"] == 1
+    assert stats["size"] == 0
+
+
+def test_entry_without_ttl_never_expires(clock):
+    lru = LRUCache(maxsize=10)
+    lru.set("a", 1)
+    clock[0] += 10 ** 9
+    assert lru.get("a") == 1
+
+
+def test_invalidate_drops_matching_keys_only():
+    lru = LRUCache(maxsize=10)
+    for key in [("x", 1), ("x", 2), ("y", 1)]:
+        lru.set(key, key)
+
+    assert lru.invalidate(lambda key: key[0] == "x") == 2
+    assert lru.get(("y", 1)) == ("y", 1)
+    assert lru.get(("x", 1)) is None
+    assert lru.stats()["invalidations"] == 2
+
+
+def school_request(quarter, **filters):
+    return SchoolRequest(examYear="2024/2025", examQuarter=quarter, **filters)
+
+
+def test_invalidate_period_keeps_other_periods(monkeypatch):
+    monkeypatch.setattr(result_cache, "result_cache", LRUCache(maxsize=10))
+    versions = {"2024/2025-1": 3, "2024/2025-2": 1}
+    first = result_cache.result_key("schools", school_request("1"), versions)
+    first_students = result_cache.result_key(
+        "students", StudentRequest(examYear="2024/2025", examQuarter="1"), versions)
+    second = result_cache.result_key("schools", school_request("2"), versions)
+    for key in (first, first_students, second):
+        result_cache.put(key, {"result": [key[0]]})
+
+    assert result_cache.invalidate_period("2024/2025", "1") == 2
+    assert result_cache.get(first) is None and result_cache.get(first_students) is None
+    assert result_cache.get(second) == {"result": ["schools"]}
+
+
+def test_new_data_version_misses_old_entries(monkeypatch):
+    monkeypatch.setattr(result_cache, "result_cache", LRUCache(maxsize=10))
+    request = school_request("1", region="Toshkent")
+    result_cache.put(result_cache.result_key("schools", request, {"2024/2025-1": 1}), {"result": []})
+
+    assert result_cache.get(result_cache.result_key("schools", request, {"2024/2025-1": 1})) == {"result": []}
+    assert result_cache.get(result_cache.result_key("schools", request, {"2024/2025-1": 2})) is None
+
+
+def test_cached_value_is_a_copy(monkeypatch):
+    monkeypatch.setattr(result_cache, "result_cache", LRUCache(maxsize=10))
+    key = result_cache.result_key("schools", school_request("1"), {})
+    value = {"result": [{"name": "School 1"}]}
+    result_cache.put(key, value)
+
+    value["result"].clear()
+    result_cache.get(key)["result"][0]["name"] = "changed"
+    assert result_cache.get(key) == {"result": [{"name": "School 1"}]}
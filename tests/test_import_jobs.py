@@ -0,0 +1,81 @@
+import os
+
+import psycopg2
+import pytest
+
+from db.db import PgConn
+
+# The job queries run against a temporary um_import_jobs of each connection, skipped without a database
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+def workers():
+    """Two worker connections, each seeing the same queued job in its own temporary um_import_jobs.
+    The advisory lock of a job is shared by both, like with the real table"""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    conns = [psycopg2.connect(TEST_DATABASE_URL) for _ in range(2)]
+    try:
+        for conn in conns:
+            with conn, conn.cursor() as cur:
+                cur.execute("""
+                    CREATE TEMPORARY TABLE um_import_jobs (
+                        id SERIAL PRIMARY KEY NOT NULL, kind CHARACTER VARYING(50) NOT NULL,
+                        filename CHARACTER VARYING(1024) NOT NULL, exam_year CHARACTER VARYING(255) NOT NULL,
+                        exam_quarter CHARACTER VARYING(255), status CHARACTER VARYING(50) NOT NULL DEFAULT 'queued',
+                        stage CHARACTER VARYING(255), rows_total INTEGER, rows_parsed INTEGER NOT NULL DEFAULT 0,
+                        rows_loaded INTEGER NOT NULL DEFAULT 0, error TEXT, report JSONB,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, started_at TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, finished_at TIMESTAMP)
+                """)
+            PgConn(conn).create_import_job('exams', 'chsb.xlsx', '2024/2025', '1')
+        yield [PgConn(conn) for conn in conns]
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def test_claimed_job_is_running(workers):
+    first, _ = workers
+    job = first.claim_import_job()
+    assert job['kind'] == 'exams' and job['exam_quarter'] == '1'
+    assert first.get_import_job(job['id'])['status'] == 'running'
+    first.release_import_job(job['id'])
+
+
+def test_locked_job_is_not_claimed_twice(workers):
+    first, second = workers
+    job = first.claim_import_job()
+    assert second.claim_import_job() is None
+    first.release_import_job(job['id'])
+
+
+def test_running_job_of_a_gone_worker_is_taken_over(workers):
+    first, second = workers
+    job = first.claim_import_job()
+    first.update_import_job(job['id'], stage='load', rows_parsed=100)
+    second.update_import_job(job['id'], status='running', stage='load', rows_parsed=100)
+    # The worker's session lock goes with it
+    first.release_import_job(job['id'])
+
+    assert second.claim_import_job()['id'] == job['id']
+    taken_over = second.get_import_job(job['id'])
+    assert taken_over['status'] == 'running'
+    assert taken_over['stage'] is None and taken_over['rows_parsed'] == 0
+    second.release_import_job(job['id'])
+
+
+def test_finished_job_is_not_claimed(workers):
+    first, _ = workers
+    job = first.claim_import_job()
+    first.update_import_job(job['id'], status='done')
+    first.release_import_job(job['id'])
+
+    assert first.get_import_job(job['id'])['finished_at'] is not None
+    assert first.claim_import_job() is None
+
+
+def test_claim_needs_a_bound_connection():
+    with pytest.raises(RuntimeError):
+        PgConn().claim_import_job()
@@ -0,0 +1,51 @@
+import pytest
+
+from utils import import_report
+from utils.import_report import ImportReport
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(import_report.time, "perf_counter", lambda: now[0])
+    monkeypatch.setattr(import_report, "_rss_mb", lambda: 100.0)
+    return now
+
+
+def test_stage_time_is_summed_over_the_chunks(clock):
+    report = ImportReport("chsb.xlsx")
+    for seconds in (1.0, 2.5):
+        with report.stage("load"):
+            clock[0] += seconds
+    with report.stage("publish"):
+        clock[0] += 0.5
+
+    stages = report.finish().as_dict()["stages"]
+    assert stages["load"] == {"seconds": 3.5, "calls": 2, "max_rss_mb": 100.0}
+    assert stages["publish"]["calls"] == 1
+    assert report.seconds == 4.0
+
+
+def test_failed_stage_is_timed_and_reported(clock):
+    report = ImportReport("chsb.xlsx")
+    with pytest.raises(ValueError):
+        with report.stage("read"):
+            clock[0] += 1.0
+            raise ValueError("broken sheet")
+
+    report.finish(error="broken sheet")
+    assert report.stages["read"]["seconds"] == 1.0
+    assert "FAILED: broken sheet" in report.format()
+
+
+def test_progress_is_reported_when_it_changes(clock):
+    seen = []
+    report = ImportReport("chsb.xlsx", on_progress=seen.append)
+    with report.stage("read"):
+        report.update_progress(rows_parsed=10)
+        report.update_progress(rows_parsed=10)
+    with report.stage("read"):
+        pass
+
+    assert [progress["stage"] for progress in seen] == ["read", "read"]
+    assert seen[-1]["rows_parsed"] == 10
@@ -0,0 +1,70 @@
+import json
+
+import pandas as pd
+
+from db import instrumentation
+from db.instrumentation import MAX_PARAM_CHARS, MAX_PARAM_ITEMS, MAX_SET_ITEMS, normalize_params
+from models.models import SchoolRequest, UserLoginBody
+
+
+def test_request_models_without_unset_filters():
+    request = SchoolRequest(examYear="2024/2025", examQuarter="1", region="Toshkent")
+    assert normalize_params((request,), {}) == [
+        {"exam_quarter": "1", "exam_year": "2024/2025", "page": 1, "region": "Toshkent"}]
+
+
+def test_passwords_are_redacted():
+    body = UserLoginBody(username="admin", password="secret")
+    params = normalize_params((body,), {"new_password": "secret", "user": {"password": "secret"}})
+    assert "secret" not in json.dumps(params)
+    assert params[0]["username"] == "admin"
+    assert params[1] == {"new_password": "***", "user": {"password": "***"}}
+
+
+def test_long_lists_and_texts_are_cut():
+    params = normalize_params((list(range(1000)), tuple("abc"), "x" * 1000), {})
+
+    assert params[0][:MAX_PARAM_ITEMS] == list(range(MAX_PARAM_ITEMS))
+    assert params[0][MAX_PARAM_ITEMS:] == [f"... ({1000 - MAX_PARAM_ITEMS} more)"]
+    assert params[1] == ["a", "b", "c"]
+    assert params[2] == "x" * MAX_PARAM_CHARS + "... (1000 chars)"
+
+
+def test_sets_show_their_size_and_first_items():
+    params = normalize_params(({str(i) for i in range(500)}, frozenset()), {})
+    assert params[0]["size"] == 500 and len(params[0]["first"]) == MAX_SET_ITEMS
+    assert params[1] == {"size": 0, "first": []}
+
+
+def test_data_frames_and_other_objects():
+    class Blob:
+        def __repr__(self):
+            return "b" * 1000
+
+    params = normalize_params((pd.DataFrame({"id": range(12345)}), Blob()), {})
+    assert params[0] == "<DataFrame rows=12345>"
+    assert len(params[1]) < MAX_PARAM_CHARS + 20
+    json.dumps(params)
+
+
+class Conn:
+    def _run(self, rows):
+        instrumentation.observe_query("SELECT 1", None, rows, 0.0)
+
+    def inner(self):
+        self._run(2)
+
+    def outer(self):
+        self._run(1)
+        self.inner()
+
+
+def test_nested_calls_count_toward_the_outer_call(monkeypatch):
+    recorded = {}
+    monkeypatch.setattr(instrumentation, "_finish", lambda call, failed: recorded.setdefault(call.method, call))
+    conn = instrumentation.instrument_methods(Conn)()
+    conn.outer()
+
+    assert recorded["Conn.inner"].queries == 1 and recorded["Conn.inner"].rows == 2
+    assert recorded["Conn.outer"].queries == 2 and recorded["Conn.outer"].rows == 3
+    assert instrumentation._current_call.get() is None
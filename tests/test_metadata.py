@@ -0,0 +1,79 @@
+import pytest
+
+from db import metadata
+from db.metadata import MetadataCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(metadata.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_versions_are_checked_every_interval(clock):
+    cache = MetadataCache(check_interval=30)
+    assert cache.needs_check()
+
+    cache.update_versions({"2024/2025-1": 1})
+    clock[0] += 29
+    assert not cache.needs_check()
+    clock[0] += 1
+    assert cache.needs_check()
+
+
+def test_new_version_drops_the_entries(clock):
+    cache = MetadataCache(check_interval=30)
+    versions = {"2024/2025-1": 1}
+    cache.update_versions(versions)
+    cache.set(("school_hierarchy", "2024/2025", "1"), {"Toshkent": {}}, versions)
+
+    # The same stamps keep the entries
+    cache.update_versions({"2024/2025-1": 1})
+    assert cache.get(("school_hierarchy", "2024/2025", "1")) == {"Toshkent": {}}
+
+    cache.update_versions({"2024/2025-1": 2})
+    assert cache.get(("school_hierarchy", "2024/2025", "1")) is None
+    assert cache.versions == {"2024/2025-1": 2}
+
+
+def test_new_period_drops_the_entries(clock):
+    cache = MetadataCache(check_interval=30)
+    cache.update_versions({"2024/2025-1": 1})
+    cache.set("available_periods", [["2024/2025", ["1"]]], {"2024/2025-1": 1})
+
+    cache.update_versions({"2024/2025-1": 1, "2024/2025-2": 1})
+    assert cache.get("available_periods") is None
+
+
+def test_rows_read_under_old_versions_are_not_stored(clock):
+    cache = MetadataCache(check_interval=30)
+    cache.update_versions({"2024/2025-1": 2})
+    cache.set("available_periods", [["2024/2025", ["1"]]], {"2024/2025-1": 1})
+    assert cache.get("available_periods") is None
+
+
+def test_invalidate_forces_a_check(clock):
+    cache = MetadataCache(check_interval=30)
+    versions = {"2024/2025-1": 1}
+    cache.update_versions(versions)
+    cache.set("available_periods", [], versions)
+
+    cache.invalidate()
+    assert cache.needs_check()
+    assert cache.versions is None
+    assert cache.get("available_periods") is None
+
+
+def test_entries_are_copied_unless_only_read(clock):
+    cache = MetadataCache(check_interval=30)
+    versions = {"2024/2025-1": 1}
+    cache.update_versions(versions)
+    tree = {"Toshkent": {"Chilonzor": []}}
+    cache.set("tree", tree, versions)
+
+    cache.get("tree")["Toshkent"].clear()
+    assert cache.get("tree") == {"Toshkent": {"Chilonzor": []}}
+    shared = {"Toshkent": {}}
+    cache.set("shared", shared, versions, copied=False)
+    assert cache.get("shared", copied=False) is shared
@@ -0,0 +1,74 @@
+import base64
+import json
+
+from db import pagination
+from db.pagination import RANKING_KEY, RESULTS_KEY, decode_cursor, encode_cursor, page_count_key
+from models.models import SchoolRequest
+
+VERSIONS = {"2024/2025-1": 4}
+
+
+def key(**filters):
+    return page_count_key("schools", SchoolRequest(examYear="2024/2025", examQuarter="1", **filters), VERSIONS)
+
+
+def forge(row_key, signature):
+    return base64.urlsafe_b64encode(json.dumps({"k": row_key, "s": signature}).encode("utf-8")).decode("ascii")
+
+
+def payload(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor))
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor([74.6, "1061"], key()), key(), RANKING_KEY) == [74.6, "1061"]
+    assert decode_cursor(encode_cursor([-1, "7"], key()), key(), RANKING_KEY) == [-1, "7"]
+    assert decode_cursor(encode_cursor(["42"], key()), key(), RESULTS_KEY) == ["42"]
+
+
+def test_page_position_is_not_part_of_the_key():
+    cursor = encode_cursor([74.6, "1061"], key(page=2))
+    assert decode_cursor(cursor, key(page=3, cursor=cursor), RANKING_KEY) == [74.6, "1061"]
+
+
+def test_cursor_of_other_filters_or_version_is_rejected():
+    cursor = encode_cursor([74.6, "1061"], key())
+    assert decode_cursor(cursor, key(region="Toshkent"), RANKING_KEY) is None
+    other_version = page_count_key("schools", SchoolRequest(examYear="2024/2025", examQuarter="1"),
+                                   {"2024/2025-1": 5})
+    assert decode_cursor(cursor, other_version, RANKING_KEY) is None
+
+
+def test_forged_row_key_is_rejected():
+    signature = payload(encode_cursor([74.6, "1061"], key()))["s"]
+    assert decode_cursor(forge([99.9, "1061"], signature), key(), RANKING_KEY) is None
+    assert decode_cursor(forge([74.6, "1061"], "0" * 32), key(), RANKING_KEY) is None
+
+
+def test_cursor_signed_with_another_secret_is_rejected(monkeypatch):
+    cursor = encode_cursor([74.6, "1061"], key())
+    monkeypatch.setattr(pagination, "CURSOR_KEY", b"another secret")
+    assert decode_cursor(cursor, key(), RANKING_KEY) is None
+
+
+def test_row_key_of_wrong_types_is_rejected():
+    # Signed correctly, but a text score would reach the numeric row comparison
+    for row_key in (["x", "1061"], [74.6, 1061], [True, "1061"], [None, "1061"], [74.6], [74.6, "1", "2"], "74.6"):
+        assert decode_cursor(encode_cursor(row_key, key()), key(), RANKING_KEY) is None
+    assert decode_cursor(encode_cursor([42], key()), key(), RESULTS_KEY) is None
+
+
+def test_malformed_cursor_is_rejected():
+    for cursor in (None, "", "not base64!", base64.urlsafe_b64encode(b"[1, 2]").decode("ascii"),
+                   base64.urlsafe_b64encode(b"{}").decode("ascii"), forge([74.6, "1061"], 12)):
+        assert decode_cursor(cursor, key(), RANKING_KEY) is None
+
+
+def test_finish_page_caches_the_count_and_signs_the_next_cursor(monkeypatch):
+    monkeypatch.setattr(pagination, "page_counts", pagination.LRUCache(maxsize=10))
+    result = pagination.finish_page({"pages": 3, "next_cursor": [74.6, "1061"]}, key(), None, "pages")
+
+    assert pagination.page_counts.get(key()) == 3
+    assert decode_cursor(result["next_cursor"], key(), RANKING_KEY) == [74.6, "1061"]
+    last = pagination.finish_page({"pages": None, "next_cursor": None}, key(), 3, "pages")
+    assert last == {"pages": 3, "next_cursor": None}
@@ -0,0 +1,18 @@
+from db.db import PARTITIONED_TABLES, partition_name, staging_name
+
+
+def test_partition_names():
+    assert partition_name("um_student_exams", "2024/2025") == "um_student_exams_2024_2025"
+    assert partition_name("um_student_exams", "2024/2025", "1") == "um_student_exams_2024_2025_q1"
+    assert staging_name("um_school_results", "2024/2025", "1") == "um_school_results_2024_2025_q1_staging"
+
+
+def test_partition_names_are_identifiers():
+    # Anything but letters and digits of a period becomes one underscore
+    assert partition_name("um_student_exams", "2024 / 2025", "1-2") == "um_student_exams_2024_2025_q1_2"
+
+
+def test_partition_names_fit_postgres():
+    # Longer identifiers are truncated by PostgreSQL, two periods would then share a table
+    for table in PARTITIONED_TABLES:
+        assert len(staging_name(table, "2024/2025", "4")) < 64
@@ -0,0 +1,146 @@
+import json
+import math
+import os
+
+import numpy as np
+import psycopg2
+import pytest
+
+from db import queries
+from tests import legacy
+from tests.test_transform import SUBJECTS, sheet
+from utils.clearly_insert_excel import subject_points, results_json, calculate_results_by_school, without_nan
+
+# rebuild_school_results_query runs against temporary tables of this database, skipped without one
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+def exams(seed=11, rows=400, fractional=False):
+    """Exams of a few schools and classes in both exam methods, with left out subjects. The sheets hold
+    whole points, fractional ones make the sums depend on the order they are added in"""
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 1000, size=(rows, 8)) / 100 if fractional else rng.integers(0, 30, size=(rows, 8)).astype(float)
+    values[rng.random(size=values.shape) < 0.1] = np.nan
+    df = sheet(np.column_stack([rng.integers(1, 6, size=rows), values, np.ones((rows, 3))]).tolist())
+    df['school_id'] = df['SchoolId'].astype(int)
+    df['studystream'] = rng.integers(5, 10, size=rows)
+    df['exam_method'] = rng.choice(['on', 'off'], size=rows, p=[0.3, 0.7])
+    # A class without any results: listed under 'all' with a NaN average point
+    df.loc[0, list(SUBJECTS)] = np.nan
+    df.loc[0, 'studystream'] = 11
+    return df
+
+
+def assert_same(actual, expected, tolerance=0.0):
+    """Nested results equal, NaN equal to NaN and the points within `tolerance`"""
+    if isinstance(expected, dict):
+        assert isinstance(actual, dict) and actual.keys() == expected.keys()
+        for key in expected:
+            assert_same(actual[key], expected[key], tolerance)
+    elif isinstance(expected, float) and math.isnan(expected):
+        assert math.isnan(actual)
+    elif expected is None:
+        assert actual is None
+    else:
+        assert math.isclose(actual, expected, rel_tol=1e-12, abs_tol=tolerance), (actual, expected)
+
+
+def by_school(results_df):
+    return {row['school_id']: row for row in results_df.to_dict('records')}
+
+
+def legacy_school_results(df):
+    legacy_df = df[['school_id', 'studystream', 'exam_method']].copy()
+    legacy_df['results'] = legacy.transform_to_results_column_v2(df.copy(), SUBJECTS)['results'].apply(json.dumps)
+    return by_school(legacy.calculate_results_by_school(legacy_df))
+
+
+def school_results(df, workers=1):
+    return by_school(calculate_results_by_school(df, subject_points(df, SUBJECTS), workers=workers))
+
+
+def test_school_results_match_row_by_row_version():
+    for seed in (11, 12, 13):
+        df = exams(seed)
+        expected = legacy_school_results(df)
+        actual = school_results(df)
+
+        assert actual.keys() == expected.keys()
+        for school_id, row in actual.items():
+            assert_same(row['results'], expected[school_id]['results'])
+            assert_same(row['average_point'], expected[school_id]['average_point'])
+
+
+def test_fractional_school_results_match_up_to_the_rounded_digit():
+    # Totals are added per chunk and group, the row by row version added them student after student:
+    # a mean on a half of the last kept digit can round either way
+    df = exams(fractional=True)
+    expected = legacy_school_results(df)
+    for school_id, row in school_results(df).items():
+        assert_same(row['results'], expected[school_id]['results'], tolerance=0.01 + 1e-9)
+        assert_same(row['average_point'], expected[school_id]['average_point'], tolerance=0.01 + 1e-9)
+
+
+def test_off_average_point_is_the_all_one():
+    # The row by row version filled 'all' into the dict it built for 'off'
+    df = exams()
+    for row in school_results(df).values():
+        assert row['average_point']['off'] is row['average_point']['all']
+        assert 'overall' in row['average_point']['off']
+    for row in legacy_school_results(df).values():
+        assert row['average_point']['off'] is row['average_point']['all']
+
+
+def test_class_without_results_has_nan_average():
+    df = exams()
+    school = school_results(df)[df.loc[0, 'school_id']]
+    assert school['results']['all'][11] == {}
+    assert math.isnan(school['average_point']['all'][11])
+
+
+def test_sharded_school_results_match():
+    df = exams()
+    single = school_results(df)
+    for school_id, row in school_results(df, workers=2).items():
+        assert_same(row['results'], single[school_id]['results'])
+        assert_same(row['average_point'], single[school_id]['average_point'])
+
+
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+def test_database_rebuild_matches_importer():
+    # NUMERIC means are rounded half away from zero, the importer's float means like round(): a mean
+    # on a half of the last kept digit can differ by one unit of it
+    df = exams()
+    points = subject_points(df, SUBJECTS)
+    df['results'] = results_json(points, df.index)
+    expected = school_results(df)
+
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TEMPORARY TABLE test_exams (school_id CHARACTER VARYING(255), exam_method CHARACTER VARYING(255),
+                                                   studystream INTEGER, results JSONB,
+                                                   exam_year CHARACTER VARYING(255), exam_quarter CHARACTER VARYING(255))
+            """)
+            cur.execute("""
+                CREATE TEMPORARY TABLE test_results (school_id CHARACTER VARYING(255), results JSONB, average_point JSONB,
+                                                     exam_year CHARACTER VARYING(255), exam_quarter CHARACTER VARYING(255),
+                                                     UNIQUE (school_id, exam_year, exam_quarter))
+            """)
+            cur.executemany(
+                "INSERT INTO test_exams VALUES (%s, %s, %s, %s, '2024/2025', '1')",
+                [(str(row.school_id), row.exam_method, int(row.studystream), row.results) for row in df.itertuples()])
+            cur.execute(*queries.rebuild_school_results_query('2024/2025', '1', exams_table='test_exams',
+                                                              results_table='test_results'))
+            cur.execute("SELECT school_id, results, average_point FROM test_results")
+            rebuilt = {int(school_id): (results, average_point) for school_id, results, average_point in cur.fetchall()}
+    finally:
+        conn.close()
+
+    assert rebuilt.keys() == expected.keys()
+    for school_id, (results, average_point) in rebuilt.items():
+        # As the importer stores them: class keys as text, NaN as null
+        assert_same(results, json.loads(json.dumps(expected[school_id]['results'])), tolerance=0.01 + 1e-9)
+        assert_same(average_point, json.loads(json.dumps(without_nan(expected[school_id]['average_point']))),
+                    tolerance=0.01 + 1e-9)
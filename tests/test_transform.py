@@ -0,0 +1,74 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from tests import legacy
+from utils.clearly_insert_excel import subject_points, results_json, average_points, transform_to_results_column_v2
+
+SUBJECTS = {
+    "Matematika 7 sinf": "math_7",
+    "Biologiya (7-sinf)": "biology_7",
+    # Only two of its point columns follow, the subject is left out
+    "Fizika (9-sinf)": "physics_9",
+}
+
+
+def sheet(rows):
+    columns = ['SchoolId', 'Matematika 7 sinf', 'Unnamed: 2', 'Unnamed: 3', 'Unnamed: 4',
+               'Biologiya (7-sinf)', 'Unnamed: 6', 'Unnamed: 7', 'Unnamed: 8',
+               'Fizika (9-sinf)', 'Unnamed: 10', 'Unnamed: 11']
+    return pd.DataFrame(rows, columns=columns)
+
+
+def fixture():
+    return sheet([
+        [1, 2, 3, 4, 9, 1.5, 2.25, 0.5, 4.25, 1, 1, 1],
+        # Halves the binary value is just under or over
+        [1, 0.15, 1.05, 2.35, 3.55, 0.25, 0.45, 7.65, 8.35, 1, 1, 1],
+        # A missing point leaves the subject out
+        [2, np.nan, 3, 4, 7, '', 1, 1, 2, 1, 1, 1],
+        [2, 'NaN', 3, 4, 7, 1, 1, 1, 3, 1, 1, 1],
+        [2, '4,5', 3, 4, 7, '2', '3.5', '0', '5.5', 1, 1, 1],
+        [3, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, 1, 1, 1],
+        [3, 0, 0, 0, 0, 10, 10, 10, 30, 1, 1, 1],
+    ])
+
+
+def random_fixture(rows=500, seed=7):
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 1000, size=(rows, 8)) / 100
+    values[rng.random(size=values.shape) < 0.05] = np.nan
+    data = np.column_stack([rng.integers(1, 5, size=rows), values, np.ones((rows, 3))])
+    return sheet(data.tolist())
+
+
+def legacy_results(df):
+    results = legacy.transform_to_results_column_v2(df.copy(), SUBJECTS)['results'].apply(json.dumps)
+    return results, results.apply(legacy.calculate_average_points)
+
+
+def test_results_json_matches_row_by_row_transform():
+    for df in (fixture(), random_fixture()):
+        expected, _ = legacy_results(df)
+        points = subject_points(df, SUBJECTS)
+        assert list(points) == ['math_7', 'biology_7']
+        assert results_json(points, df.index).tolist() == expected.tolist()
+
+
+def test_average_points_match_row_by_row_transform():
+    for df in (fixture(), random_fixture()):
+        _, expected = legacy_results(df)
+        averages = average_points(subject_points(df, SUBJECTS), df.index)
+        pd.testing.assert_series_equal(averages, expected.astype(float), check_names=False)
+
+
+def test_transform_adds_results_and_average_point():
+    df = transform_to_results_column_v2(fixture(), SUBJECTS)
+    assert json.loads(df.loc[0, 'results']) == {
+        'math_7': {'knowing_point': 2.0, 'applying_point': 3.0, 'reviewing_point': 4.0, 'all_point': 9.0},
+        'biology_7': {'knowing_point': 1.5, 'applying_point': 2.2, 'reviewing_point': 0.5, 'all_point': 4.2},
+    }
+    assert df.loc[0, 'average_point'] == 6.6
+    assert json.loads(df.loc[5, 'results']) == {}
+    assert np.isnan(df.loc[5, 'average_point'])
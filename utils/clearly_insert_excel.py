@@ -1,11 +1,14 @@
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
 from sqlalchemy.dialects.postgresql import insert
-from config.config import DB_URL
+from config.config import DB_URL, SCHOOL_RESULTS_WORKERS, IMPORT_CHUNK_ROWS
+from db.db import PgConn
+from utils.excel_stream import sheet_rows, sheet_row_count, header_columns, iter_chunks, read_sheet, to_frame
+from utils.import_report import ImportReport
 import hashlib
-import psycopg2
 import json
 
 subjects_umum = {
@@ -27,41 +30,69 @@ subjects_umum = {
 def extract_numbers(text):
     return [float(s.replace(",", ".")) for s in text.split() if s.replace(",", ".").replace(".", "").isdigit()]
 
-def transform_to_results_column_v2(df, subjects):
-    # Create an empty list to store results dictionaries for each row
-    results_list = []
-
-    for _, row in df.iterrows():
-        subject_results = {}  # Dictionary to hold scores for each subject
-        for subject, prefix in subjects.items():
-            # Attempt to retrieve knowing, applying, reviewing, and all points columns
-            try:
-                knowing_data = row[subject]
-                applying_data = row[f'Unnamed: {df.columns.get_loc(subject) + 1}']
-                reviewing_data = row[f'Unnamed: {df.columns.get_loc(subject) + 2}']
-                all_data = row[f'Unnamed: {df.columns.get_loc(subject) + 3}']
-                # Identify the columns for knowing, applying, reviewing, and all points
-
-                knowing = round(float(knowing_data) if knowing_data != "NaN" and pd.notna(knowing_data) and knowing_data != '' else None, 1)
-                applying = round(float(applying_data) if applying_data != "NaN" and pd.notna(applying_data) and applying_data != '' else None, 1)
-                reviewing = round(float(reviewing_data) if reviewing_data != "NaN" and pd.notna(reviewing_data) and reviewing_data != '' else None, 1)
-                all_point = round(float(all_data) if all_data != "NaN" and pd.notna(all_data) and all_data != '' else None, 1)
-
-                # Create dictionary for the subject
-                subject_results[prefix] = {
-                    "knowing_point": knowing,
-                    "applying_point": applying,
-                    "reviewing_point": reviewing,
-                    "all_point": all_point
-                }
-            except Exception as e:
-                continue
-
-        # Add the subject results dictionary to the list for the row
-        results_list.append(subject_results)
-
-    # Add the results column to the dataframe
-    df['results'] = results_list
+def whole_points(value):
+    # um_rate stores integer points and COPY does not cast "1.0", round half up like the INSERT did
+    return int(np.floor(value + 0.5))
+
+POINT_TYPES = ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']
+
+def round_points(values, decimals=1):
+    """values rounded like round(value, decimals). numpy rounds value * 10 ** decimals, which is off when the
+    product lands on a half the value itself is not (0.15 * 10 == 1.5), those few go through round"""
+    values = np.asarray(values, dtype=float)
+    rounded = np.round(values, decimals)
+    scaled = values * 10 ** decimals
+    halves = scaled - np.floor(scaled) == 0.5
+    rounded[halves] = [round(float(value), decimals) for value in values[halves]]
+    return rounded
+
+def subject_points(df, subjects):
+    """Points of every subject found in the sheet as a (rows, 4) array in POINT_TYPES order, rounded to
+    one decimal. A row missing any of the four points is NaN in all of them (the subject is left out)"""
+    points = {}
+    for subject, prefix in subjects.items():
+        if subject not in df.columns:
+            continue
+        # The applying, reviewing and all point columns follow the subject column without a header
+        location = df.columns.get_loc(subject)
+        columns = [subject] + [f'Unnamed: {location + offset}' for offset in (1, 2, 3)]
+        if not all(column in df.columns for column in columns):
+            continue
+        values = round_points(df[columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float))
+        values[np.isnan(values).any(axis=1)] = np.nan
+        points[prefix] = values
+    return points
+
+def results_json(points, index):
+    """The results column as JSON text, the same as json.dumps of {subject: {point_type: point}}"""
+    results = pd.Series('', index=index, dtype=object)
+    for prefix, values in points.items():
+        text = pd.DataFrame(values, index=index).astype(str)
+        entry = pd.Series(json.dumps(prefix) + ': {', index=index, dtype=object)
+        for column, point_type in enumerate(POINT_TYPES):
+            entry = entry + (', ' if column else '') + f'"{point_type}": ' + text[column]
+        entry = entry + '}'
+
+        valid = ~np.isnan(values[:, 0])
+        results = results.where(~valid, results.where(results == '', results + ', ') + entry)
+    return '{' + results + '}'
+
+def average_points(points, index):
+    """Mean all_point over the subjects of each row rounded to one decimal, NaN for a row without any"""
+    if not points:
+        return pd.Series(np.nan, index=index)
+    all_points = np.column_stack([values[:, POINT_TYPES.index('all_point')] for values in points.values()])
+    counts = (~np.isnan(all_points)).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        averages = np.nansum(all_points, axis=1) / counts
+    return pd.Series(round_points(averages), index=index)
+
+def transform_to_results_column_v2(df, subjects, points=None):
+    # Column-wise: the point matrices of all subjects give both the results JSON and the average
+    if points is None:
+        points = subject_points(df, subjects)
+    df['results'] = results_json(points, df.index)
+    df['average_point'] = average_points(points, df.index)
 
     return df
 
@@ -80,347 +111,377 @@ def update_first_row(df, subjects):
                     df.at[0, col] = f"{subjects[subject]}_all_point"
     return df
 
+def generate_hash_teachers(row):
+    return hashlib.md5("|".join(str(value) for value in row.values).encode("utf-8")).hexdigest()
+
 def insert_on_conflict_do_nothing(table, conn, keys, data_iter):
     # Build insert statement with ON CONFLICT DO NOTHING
     insert_stmt = insert(table.table).values([dict(zip(keys, row)) for row in data_iter])
     insert_stmt = insert_stmt.on_conflict_do_nothing()
     conn.execute(insert_stmt)
 
-def calculate_average_points(results):
-    try:
-        # Convert the input string to a valid JSON format
-        results = results.replace("NaN", "null").replace("'", "\"")
-        result_data = json.loads(results)  # Parse the JSON
-
-        # Calculate average of all "all_point" values
-        total_points = 0
-        count = 0
-
-        for subject, subject_data in result_data.items():
-            all_point = subject_data.get('all_point')
-            if all_point is not None:
-                total_points += all_point
-                count += 1
-
-        if count > 0:
-            return round(total_points / count, 1)
-        else:
-            return None  # No valid points to average
-    except Exception as e:
-        print(f"Error: {e}")  # Print the error for debugging
-        return None  # Handle any parsing or calculation errors
-
-def calculate_results_by_school(df):
-    # List to store results
-    results_list = []
-    
-    # Group by school_id
-    for school_id, group in df.groupby('school_id'):
-        school_results = {}
-        average_point = {}
-
-        # Process "on" and "off" exam methods
-        for exam_method in ['on', 'off']:
-            class_averages = {}
-            method_group = group[group['exam_method'] == exam_method]
-
-            # Only process if there is data for this exam_method
-            if not method_group.empty:
-                exam_method_results = {}
-                subject_totals_schoolwide = {}
-                subject_counts_schoolwide = {}
-
-                # Group by studyclass within each school_id and exam_method group
-                for studyclass, class_group in method_group.groupby('studystream'):
-                    subject_totals = {}
-                    subject_counts = {}
-
-                    # Initialize subject totals and counts
-                    for _, row in class_group.iterrows():
-                        results = json.loads(row['results'])
-
-                        for subject, data in results.items():
-                            for point_type in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']:
-                                point_value = data.get(point_type)
-                                if point_value is not None:
-                                    if subject not in subject_totals:
-                                        subject_totals[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
-                                        subject_counts[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
-                                    
-                                    # Accumulate values for the current study class
-                                    subject_totals[subject][point_type] += point_value
-                                    subject_counts[subject][point_type] += 1
-
-                                    # Accumulate values for the whole school
-                                    if subject not in subject_totals_schoolwide:
-                                        subject_totals_schoolwide[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
-                                        subject_counts_schoolwide[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
-                                    subject_totals_schoolwide[subject][point_type] += point_value
-                                    subject_counts_schoolwide[subject][point_type] += 1
-
-                    # Calculate rounded averages for each point type in each subject
-                    studyclass_averages = {
-                        subject: {
-                            point_type: round(subject_totals[subject][point_type] / subject_counts[subject][point_type], 2) 
-                            if subject_counts[subject][point_type] > 0 else None
-                            for point_type in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']
-                        } for subject in subject_totals
-                    }
-
-                    # Calculate the rounded average "all_point" for this studyclass
-                    studyclass_average_point = round(np.nanmean([
-                        subject_data['all_point']
-                        for subject_data in studyclass_averages.values()
-                        if 'all_point' in subject_data
-                    ]), 2) if studyclass_averages else None
-
-                    # Add to results if not empty
-                    if studyclass_averages:
-                        exam_method_results[studyclass] = studyclass_averages
-                    if studyclass_average_point is not None:
-                        class_averages[studyclass] = studyclass_average_point
-
-                # Calculate the overall average for this exam method
-                overall_average_point = round(np.nanmean(list(class_averages.values())), 2) if class_averages else None
-                if overall_average_point is not None:
-                    class_averages['overall'] = overall_average_point
-
-                # Calculate school-wide averages for this exam method
-                school_avg = {
-                    subject: {
-                        point_type: round(subject_totals_schoolwide[subject][point_type] / subject_counts_schoolwide[subject][point_type], 5)
-                        if subject_counts_schoolwide[subject][point_type] > 0 else None
-                        for point_type in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']
-                    } for subject in subject_totals_schoolwide
-                }
-
-                # Only add non-empty results and averages to final output
-                if exam_method_results:
-                    school_results[exam_method] = {**exam_method_results, 'school_avg': school_avg}
-                if class_averages:
-                    average_point[exam_method] = class_averages
-
-        # Calculate "all" based on the original logic (without combining "on" and "off" exam methods)
-        school_results_all = {}
-        subject_totals_schoolwide_all = {}
-        subject_counts_schoolwide_all = {}
-
-        # Group by studyclass within each school_id group
-        for studyclass, class_group in group.groupby('studystream'):
-            subject_totals = {}
-            subject_counts = {}
-
-            for _, row in class_group.iterrows():
-                results = json.loads(row['results'])
-
-                for subject, data in results.items():
-                    for point_type in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']:
-                        point_value = data.get(point_type)
-                        if point_value is not None:
-                            if subject not in subject_totals:
-                                subject_totals[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
-                                subject_counts[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
-                            
-                            # Accumulate values for the current study class
-                            subject_totals[subject][point_type] += point_value
-                            subject_counts[subject][point_type] += 1
-                            
-                            # Accumulate values for the whole school
-                            if subject not in subject_totals_schoolwide_all:
-                                subject_totals_schoolwide_all[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
-                                subject_counts_schoolwide_all[subject] = {pt: 0 for pt in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']}
-                            subject_totals_schoolwide_all[subject][point_type] += point_value
-                            subject_counts_schoolwide_all[subject][point_type] += 1
-
-            studyclass_averages = {
-                subject: {
-                    point_type: round(subject_totals[subject][point_type] / subject_counts[subject][point_type], 2) 
-                    if subject_counts[subject][point_type] > 0 else None
-                    for point_type in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']
-                } for subject in subject_totals
-            }
-
-            # Calculate the overall average for "all_point" in this study class
-            studyclass_average_point = np.nanmean([
-                subject_data['all_point']
-                for subject_data in studyclass_averages.values()
-                if 'all_point' in subject_data
-            ])
-            class_averages[studyclass] = studyclass_average_point
-
-            # Add the studyclass results to school_results
-            school_results_all[studyclass] = studyclass_averages
-
-        # Calculate school-wide averages across all exam methods
-        school_avg_all = {
-            subject: {
-                point_type: round(subject_totals_schoolwide_all[subject][point_type] / subject_counts_schoolwide_all[subject][point_type], 5)
-                if subject_counts_schoolwide_all[subject][point_type] > 0 else None
-                for point_type in ['knowing_point', 'applying_point', 'reviewing_point', 'all_point']
-            } for subject in subject_totals_schoolwide_all
-        }
-
-        # Calculate the overall average for the school based on 'all_point' only, using the school-wide data
-        overall_average_point = round(np.nanmean([
-            subject_data['all_point']
-            for subject_data in school_avg_all.values()
-            if 'all_point' in subject_data
-        ]), 5)
-        
-        # Add the overall school average to class_averages under 'overall'
-        class_averages['overall'] = overall_average_point
-        school_results_all = {**school_results_all, 'school_avg': school_avg_all}
-        school_results['all'] = school_results_all
-        average_point['all'] = class_averages
-
-        # Append the final results to the list
-        results_list.append({
-            'school_id': school_id,
-            'results': school_results,
-            'average_point': average_point
+def score_frame(df, points):
+    """Long format of the subject points of the rows of `df` (subject_points): one row per student,
+    subject and point type"""
+    keys = df[['school_id', 'exam_method', 'studystream']].reset_index(drop=True)
+    frames = []
+    for subject, values in points.items():
+        # Left out subjects are NaN in all four points
+        valid = ~np.isnan(values[:, 0])
+        frames.append(keys.iloc[np.repeat(np.flatnonzero(valid), len(POINT_TYPES))].assign(
+            subject=subject,
+            point_type=np.tile(POINT_TYPES, int(valid.sum())),
+            point=values[valid].ravel(),
+        ))
+    if not frames:
+        return keys.iloc[:0].assign(subject=[], point_type=[], point=np.array([], dtype=float))
+    return pd.concat(frames, ignore_index=True)
+
+SCORE_KEYS = ['school_id', 'exam_method', 'studystream', 'subject', 'point_type']
+
+def score_totals(df, points):
+    """Sum and count of the points of every school, method, class, subject and point type in `df`,
+    the totals of several chunks add up to the totals of the whole sheet"""
+    return score_frame(df, points).groupby(SCORE_KEYS, as_index=False).agg(total=('point', 'sum'), count=('point', 'count'))
+
+def combine_totals(totals):
+    return pd.concat(totals, ignore_index=True).groupby(SCORE_KEYS, as_index=False)[['total', 'count']].sum()
+
+def class_keys(df):
+    return df[['school_id', 'studystream']].drop_duplicates()
+
+def school_results_frame(totals, classes):
+    """School results and average points from the score totals, the averages are computed on the
+    grouped totals and the nested dicts are only assembled from the aggregated rows"""
+    # 'all' covers every exam, the per method results only the online and offline ones
+    all_totals = totals.groupby(['school_id', 'studystream', 'subject', 'point_type'], as_index=False)[['total', 'count']].sum()
+    totals = pd.concat([totals[totals['exam_method'].isin(['on', 'off'])], all_totals.assign(exam_method='all')], ignore_index=True)
+
+    by_class = ['school_id', 'exam_method', 'studystream']
+    # The subject means are rounded like round(float, n), the class and overall means like numpy's
+    # round of np.nanmean, as the row by row version did
+    class_points = totals.assign(point=round_points(totals['total'] / totals['count'], 2))
+    school_points = totals.groupby(['school_id', 'exam_method', 'subject', 'point_type'], as_index=False)[['total', 'count']].sum()
+    school_points['point'] = round_points(school_points['total'] / school_points['count'], 5)
+
+    # Average point of a class: mean all_point of its subjects, rounded for 'on' / 'off' but not for 'all'
+    class_average = class_points[class_points['point_type'] == 'all_point'].groupby(by_class, as_index=False)['point'].mean()
+    per_method = class_average['exam_method'] != 'all'
+    class_average.loc[per_method, 'point'] = class_average.loc[per_method, 'point'].round(2)
+    method_overall = class_average[per_method].groupby(['school_id', 'exam_method'], as_index=False)['point'].mean()
+    method_overall['point'] = method_overall['point'].round(2)
+    # Overall 'all' average: mean of the school-wide subject all_points
+    school_all_points = school_points[(school_points['exam_method'] == 'all') & (school_points['point_type'] == 'all_point')]
+    all_overall = school_all_points.groupby('school_id')['point'].mean().round(5)
+
+    results = {}
+    average_point = {}
+    # Every class is listed under 'all', even one without any subject results
+    for row in classes.sort_values(['school_id', 'studystream']).to_dict('records'):
+        results.setdefault(row['school_id'], {'all': {}})['all'][row['studystream']] = {}
+        average_point.setdefault(row['school_id'], {'all': {}})['all'][row['studystream']] = float('nan')
+
+    for row in class_points.to_dict('records'):
+        subjects = results[row['school_id']].setdefault(row['exam_method'], {}).setdefault(row['studystream'], {})
+        subjects.setdefault(row['subject'], dict.fromkeys(POINT_TYPES))[row['point_type']] = row['point']
+    for school_results in results.values():
+        school_results['all'].setdefault('school_avg', {})
+    for row in school_points.to_dict('records'):
+        school_avg = results[row['school_id']][row['exam_method']].setdefault('school_avg', {})
+        school_avg.setdefault(row['subject'], dict.fromkeys(POINT_TYPES))[row['point_type']] = row['point']
+
+    for row in class_average.to_dict('records'):
+        average_point[row['school_id']].setdefault(row['exam_method'], {})[row['studystream']] = row['point']
+    for row in method_overall.to_dict('records'):
+        average_point[row['school_id']][row['exam_method']]['overall'] = row['point']
+    for school_id, school_averages in average_point.items():
+        school_averages['all']['overall'] = float(all_overall.get(school_id, np.nan))
+        if 'off' in school_averages:
+            # The row by row version filled 'all' into the dict it had built for 'off', keep that output
+            school_averages['off'] = school_averages['all']
+
+    return pd.DataFrame(
+        [{'school_id': school_id, 'results': results[school_id], 'average_point': average_point[school_id]} for school_id in results],
+        columns=['school_id', 'results', 'average_point'],
+    )
+
+def school_results(totals, classes, workers=SCHOOL_RESULTS_WORKERS):
+    """school_results_frame, with workers > 1 the schools are split into that many shards
+    computed in a process pool"""
+    school_ids = np.sort(classes['school_id'].unique())
+    if workers <= 1 or len(school_ids) < workers:
+        return school_results_frame(totals, classes)
+
+    shards = np.array_split(school_ids, workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        frames = executor.map(school_results_frame,
+                              [totals[totals['school_id'].isin(shard_ids)] for shard_ids in shards],
+                              [classes[classes['school_id'].isin(shard_ids)] for shard_ids in shards])
+        return pd.concat(list(frames), ignore_index=True)
+
+def without_nan(value):
+    """`value` with NaN as None: JSONB has no NaN, a class without results gets a null average point
+    like rebuild_school_results writes"""
+    if isinstance(value, dict):
+        return {key: without_nan(item) for key, item in value.items()}
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+def calculate_results_by_school(df, points, workers=SCHOOL_RESULTS_WORKERS):
+    """Per school results and average points of the imported exams and their subject points"""
+    return school_results(score_totals(df, points), class_keys(df), workers)
+
+def report_load(stats):
+    print(f"{stats['table']}: {stats['written']}/{stats['rows']} rows in {stats['seconds']}s ({stats['rows_per_sec']} rows/s)")
+
+def combine_loads(table, loads):
+    """bulk_load stats of the chunks of one table added up"""
+    rows = sum(stats['rows'] for stats in loads)
+    seconds = sum(stats['seconds'] for stats in loads)
+    return {
+        "table": table,
+        "rows": rows,
+        "written": sum(stats['written'] for stats in loads),
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows / seconds) if seconds else None,
+    }
+
+def school_rows(chunk):
+    school_df = chunk[['SchoolId', 'Hudud', 'Tuman/Shahar', 'Maktab']].copy()
+
+    # Rename for consistency
+    school_df.columns = ['id', 'territory', 'region', 'name']
+
+    # Drop duplicates to ensure unique combinations
+    school_df['territory'] = school_df['territory'].str.strip()
+    school_df['name'] = school_df['name'].str.strip()
+    school_df['region'] = school_df['region'].str.strip()
+    school_df['id'] = school_df['id'].astype(int)
+    school_df = school_df.drop_duplicates()
+    school_df['row_hash'] = pd.util.hash_pandas_object(school_df.astype(str), index=False).to_numpy().view('int64')
+    return school_df
+
+def rate_rows(rate_row, quarter, year):
+    """um_rate rows parsed from the row under the header (question counts and points per question)"""
+    corrected_result_dict = {}
+
+    for subject in subjects_umum.keys():
+        if subject in rate_row.index:
+            # Find the index of the subject column
+            subject_index = rate_row.index.get_loc(subject)
+            # Extract only the subject and the next 3 columns
+            lil_df = rate_row.iloc[subject_index:subject_index + 4]
+            # Convert the extracted row into a list and store in the dictionary
+            corrected_result_dict[subject] = lil_df.dropna().astype(str).tolist()
+
+    transformed_data = []
+
+    for subject, data in corrected_result_dict.items():
+
+        knowing = extract_numbers(data[0])
+        applying = extract_numbers(data[1])
+        reviewing = extract_numbers(data[2])
+        overall = extract_numbers(data[3])
+
+        transformed_data.append({
+            "knowing_question_count": int(knowing[0]),
+            "knowing_point_per_question": whole_points(knowing[1]),
+            "applying_question_count": int(applying[0]),
+            "applying_point_per_question": whole_points(applying[1]),
+            "reviewing_question_count": int(reviewing[0]),
+            "reviewing_point_per_question": whole_points(reviewing[1]),
+            "all_question_count": int(overall[0]),
+            "max_point_over_all": whole_points(overall[1]),
+            "subject": subjects_umum[subject]
         })
 
-    # Create a new DataFrame from the results
-    results_df = pd.DataFrame(results_list)
-
-    return results_df
-
-def insert_data_to_tables(filename, quarter, year):
+    rate_df = pd.DataFrame(transformed_data)
+    rate_df['exam_year'] = year
+    rate_df['exam_quarter'] = quarter
+    return rate_df
+
+def rates_differ(rate_df, stored):
+    """Whether the rate rows of a sheet add or correct any of the `stored` rates of the period (PgConn.get_rates)"""
+    stored = {rate['subject']: rate['rate'] for rate in stored}
+    return any(any(stored.get(row['subject'], {}).get(column) != value for column, value in row.items())
+               for row in rate_df.to_dict('records'))
+
+EXAM_ID_COLUMN = "Javoblar \nvarag'i ID \nraqami"
+
+def exam_rows(chunk, points, quarter, year):
+    exams_df = transform_to_results_column_v2(chunk, subjects_umum, points)
+
+    exams_df = exams_df.rename(columns={
+        'Familya': 'surname',
+        'Ism': 'name',
+        "Otasining ismi": "patronymic",
+        "Guruh": "studyclass",
+        "Sinf": "studystream",
+        "Ta'lim tili": "studylang",
+        EXAM_ID_COLUMN: "id",
+        "user ID": "student_id",
+        "SchoolId": "school_id",
+    # Add more mappings for subjects and other columns if required
+    })
+
+    exams_df.loc[exams_df['student_id'].isna(), 'student_id'] = exams_df.loc[exams_df['student_id'].isna(), 'person ID']
+
+    exams_df['name'] = exams_df['name'].str.strip()
+    exams_df['surname'] = exams_df['surname'].str.strip()
+    exams_df['patronymic'] = exams_df['patronymic'].str.strip()
+    exams_df['id'] = exams_df['id'].astype(int)
+    exams_df['student_id'] = exams_df['student_id'].astype(int)
+    exams_df['school_id'] = exams_df['school_id'].astype(int)
+    exams_df['studystream'] = exams_df['studystream'].astype(int)
+
+    exams_df = exams_df[['id', 'student_id', 'surname', 'name', 'patronymic', 'studyclass', 'studystream', 'studylang', 'results', 'average_point', 'school_id', 'row_hash']].copy()
+
+    exams_df['exam_year'] = year
+    exams_df['exam_quarter'] = quarter
+    exams_df['exam_method'] = 'off'
+    return exams_df
+
+def insert_data_to_tables(filename, quarter, year, report=None):
+    """Import one period from its Excel sheet, returns the ImportReport of the stages"""
+    report = report or ImportReport(f"{filename} ({year} Q{quarter})")
     try:
-        df = pd.read_excel(filename)
-
-        # Create SQLAlchemy engine to connect to PostgreSQL
-        engine = create_engine(DB_URL)
-
-
-        # SCHOOL TABLE INSERTION
-        # ------------------------------------------------------------------------------------------------
-        school_df = df.copy()
-        school_df = school_df[1:]
-
-        school_df = school_df[['SchoolId', 'Hudud', 'Tuman/Shahar', 'Maktab']]
-
-        # Rename for consistency
-        school_df.columns = ['id', 'territory', 'region', 'name']
-
-        # Drop duplicates to ensure unique combinations
-        school_df['territory'] = school_df['territory'].str.strip()
-        school_df['name'] = school_df['name'].str.strip()
-        school_df['region'] = school_df['region'].str.strip()
-        school_df['id'] = school_df['id'].astype(int)
-        school_df = school_df.drop_duplicates()
-
-        school_df.to_sql('um_school', engine, if_exists='append', index=False, method=insert_on_conflict_do_nothing)
-
-        # ------------------------------------------------------------------------------------------------
+        # The sheet is streamed: header, rate row, then the students in chunks of IMPORT_CHUNK_ROWS
+        with report.stage('read'):
+            row_count = sheet_row_count(filename)
+            # Without the header and rate rows
+            report.update_progress(rows_total=max(row_count - 2, 0) if row_count else None)
+            rows = sheet_rows(filename)
+            columns = header_columns(next(rows))
+            rate_row = to_frame([next(rows)], columns).iloc[0]
 
         # RATE TABLE INSERTION
         # ------------------------------------------------------------------------------------------------
-        corrected_result_dict = {}
-
-        for subject in subjects_umum.keys():
-            if subject in df.columns:
-                # Find the index of the subject column
-                subject_index = df.columns.get_loc(subject)
-                # Extract only the first row for the subject and the next 3 columns
-                lil_df = df.iloc[0, subject_index:subject_index + 4]
-                # Convert the extracted row into a list and store in the dictionary
-                corrected_result_dict[subject] = lil_df.dropna().astype(str).tolist()
-
-        transformed_data = []
-
-        for subject, data in corrected_result_dict.items():
-
-            knowing = extract_numbers(data[0])
-            applying = extract_numbers(data[1])
-            reviewing = extract_numbers(data[2])
-            overall = extract_numbers(data[3])
-
-            transformed_data.append({
-                "knowing_question_count": int(knowing[0]),
-                "knowing_point_per_question": knowing[1],
-                "applying_question_count": int(applying[0]),
-                "applying_point_per_question": applying[1],
-                "reviewing_question_count": int(reviewing[0]),
-                "reviewing_point_per_question": reviewing[1],
-                "all_question_count": int(overall[0]),
-                "max_point_over_all": overall[1],
-                "subject": subjects_umum[subject]
-            })
-
-        rate_df = pd.DataFrame(transformed_data)
-        rate_df['exam_year'] = year
-        rate_df['exam_quarter'] = quarter
-
-        rate_df.to_sql('um_rate', engine, if_exists='append', index=False, method=insert_on_conflict_do_nothing)
-
+        with report.stage('transform'):
+            rate_df = rate_rows(rate_row, quarter, year)
+        with report.stage('read'):
+            # Written by publish_period, the period is not listed before its exams are published
+            rates_changed = rates_differ(rate_df, PgConn().get_rates(year, quarter))
 
         # ------------------------------------------------------------------------------------------------
 
-        # STUDENT_EXAMS TABLE INSERTION
+        # SCHOOL AND STUDENT_EXAMS TABLES INSERTION
         # ------------------------------------------------------------------------------------------------
 
-        exams_df = df.copy()
-        exams_df = transform_to_results_column_v2(exams_df, subjects_umum)
-
-        exams_df.loc[0, 'results'] = 'results'
-        exams_df = exams_df[1:]
-
-        exams_df = exams_df.rename(columns={
-            'Familya': 'surname',
-            'Ism': 'name',
-            "Otasining ismi": "patronymic",
-            "Guruh": "studyclass",
-            "Sinf": "studystream",
-            "Ta'lim tili": "studylang",
-            "Javoblar \nvarag'i ID \nraqami": "id",
-            "user ID": "student_id",
-            "SchoolId": "school_id",
-        # Add more mappings for subjects and other columns if required
-        })
-
-        exams_df.loc[exams_df['student_id'].isna(), 'student_id'] = exams_df.loc[exams_df['student_id'].isna(), 'person ID']
-
-        exams_df['name'] = exams_df['name'].str.strip()
-        exams_df['surname'] = exams_df['surname'].str.strip()
-        exams_df['patronymic'] = exams_df['patronymic'].str.strip()
-        exams_df['id'] = exams_df['id'].astype(int)
-        exams_df['student_id'] = exams_df['student_id'].astype(int)
-        exams_df['school_id'] = exams_df['school_id'].astype(int)
-        exams_df['studystream'] = exams_df['studystream'].astype(int)
-
-        exams_df = exams_df[['id', 'student_id', 'surname', 'name', 'patronymic', 'studyclass', 'studystream', 'studylang', 'results', 'school_id']]
-
-        exams_df['results'] = exams_df['results'].apply(json.dumps)
-        exams_df['average_point'] = exams_df['results'].apply(calculate_average_points)
-
-        exams_df['exam_year'] = year
-        exams_df['exam_quarter'] = quarter
-        exams_df['exam_method'] = 'off'
-
-        exams_df.to_sql('um_student_exams', engine, if_exists='append', index=False, method=insert_on_conflict_do_nothing)
+        with report.stage('load'):
+            # um_student_exams and um_school_results are partitioned by period, the period is loaded into
+            # staging tables next to its partitions and swapped in by publish_period at the end
+            PgConn().ensure_period_partitions(year, quarter)
+            targets = PgConn().create_period_staging(year, quarter)
+
+        # Rows of a previous import of the period: a re-import only transforms and writes the rows
+        # whose content hash changed, deletes the ones the sheet no longer has, and recomputes the
+        # results of the schools they belong to
+        with report.stage('read'):
+            existing = pd.DataFrame(PgConn().get_exam_hashes(year, quarter), columns=['id', 'row_hash', 'school_id'], dtype=object)
+            known = pd.MultiIndex.from_arrays([existing['id'], existing['row_hash']])
+        incremental = not existing.empty
+
+        school_loads, exam_loads = [], []
+        # Only the score totals per class are kept for um_school_results, not the students
+        totals, classes = [], []
+        affected_schools = set()
+        changed_ids = set()
+        seen_ids = set()
+        unchanged = 0
+        chunks = iter_chunks(rows, columns, IMPORT_CHUNK_ROWS, hash_column='row_hash')
+        while True:
+            with report.stage('read'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+
+            report.update_progress(rows_parsed=report.progress['rows_parsed'] + len(chunk))
+
+            with report.stage('transform'):
+                ids = chunk[EXAM_ID_COLUMN].astype(int).astype(str)
+                seen_ids.update(ids)
+                changed = ~pd.MultiIndex.from_arrays([ids, chunk['row_hash']]).isin(known)
+                unchanged += int((~changed).sum())
+                if not changed.any():
+                    continue
+                if incremental:
+                    # A corrected row may have moved the student to another school
+                    affected_schools.update(existing.loc[existing['id'].isin(ids[changed]), 'school_id'])
+                    changed_ids.update(ids[changed])
+
+                chunk = chunk[changed].copy()
+                # The points are parsed once for the results JSON and the school totals
+                points = subject_points(chunk, subjects_umum)
+                school_df = school_rows(chunk)
+                exams_df = exam_rows(chunk, points, quarter, year)
+            with report.stage('load'):
+                school_loads.append(PgConn().bulk_load('um_school', school_df, conflict=('id',)))
+                exam_loads.append(PgConn().bulk_load(targets['um_student_exams'], exams_df, conflict=('id', 'exam_year', 'exam_quarter')))
+            report.update_progress(rows_loaded=report.progress['rows_loaded'] + exam_loads[-1]['written'])
+            with report.stage('school aggregation'):
+                if incremental:
+                    affected_schools.update(exams_df['school_id'].astype(str))
+                else:
+                    totals.append(score_totals(exams_df, points))
+                    classes.append(class_keys(exams_df))
+
+        removed = existing.loc[~existing['id'].isin(seen_ids)]
+        if not removed.empty:
+            with report.stage('load'):
+                PgConn().delete_exams(year, quarter, removed['id'], targets['um_student_exams'])
+            affected_schools.update(removed['school_id'])
+            changed_ids.update(removed['id'])
+
+        if not exam_loads and removed.empty and not rates_changed:
+            print(f"{filename}: {unchanged} rows unchanged, nothing to import")
+            PgConn().drop_period_staging(year, quarter)
+            return report.finish()
+        print(f"{filename}: {unchanged} rows unchanged and skipped, {len(removed)} removed")
+        report_load(combine_loads('um_school', school_loads))
+        report_load(combine_loads('um_student_exams', exam_loads))
 
         # ------------------------------------------------------------------------------------------------
 
 
         # SCHOOL_RESULTS TABLE INSERTION
         # ------------------------------------------------------------------------------------------------
-        results_df = calculate_results_by_school(exams_df)
-        results_df['exam_year'] = year
-        results_df['exam_quarter'] = quarter
-        results_df['results'] = results_df['results'].apply(json.dumps)
-        results_df['average_point'] = results_df['average_point'].apply(json.dumps)
-
-        results_df.to_sql('um_school_results', engine, if_exists='append', index=False, method=insert_on_conflict_do_nothing)
+        if incremental:
+            with report.stage('school aggregation'):
+                # Only the affected schools, recomputed in the database from every exam they have in the period
+                PgConn().rebuild_school_results(year, quarter, affected_schools,
+                                                targets['um_student_exams'], targets['um_school_results'])
+        else:
+            with report.stage('school aggregation'):
+                results_df = school_results(combine_totals(totals), pd.concat(classes).drop_duplicates())
+                results_df['exam_year'] = year
+                results_df['exam_quarter'] = quarter
+                results_df['results'] = results_df['results'].apply(json.dumps)
+                results_df['average_point'] = results_df['average_point'].map(without_nan).apply(json.dumps)
+
+            with report.stage('load'):
+                report_load(PgConn().bulk_load(targets['um_school_results'], results_df, conflict=('school_id', 'exam_year', 'exam_quarter')))
+
+        with report.stage('index/analyze'):
+            PgConn().analyze_period(year, quarter, targets)
+
+        with report.stage('publish'):
+            # Swap the staging tables in, rebuild the normalized per-subject percentages, the /home
+            # dashboard and the territory -> region -> school tree, and bump the data version so the
+            # running app drops what it cached, all in one transaction
+            PgConn().publish_period(year, quarter, changed_ids if incremental else None, rate_df)
     except Exception as e:
         print(e)
+        PgConn().drop_period_staging(year, quarter)
+        return report.finish(error=str(e))
+    return report.finish()
 
 def inserting_teachers(filename, year):
     # try:
 
         engine = create_engine(DB_URL)
 
-        teachers_df = pd.read_excel(filename)
+        teachers_df = read_sheet(filename)
 
         teachers_df.drop(columns=['T/r'], inplace=True)
 
@@ -492,5 +553,8 @@ def inserting_teachers(filename, year):
         teachers_df['teachers_hash'] = teachers_df.apply(generate_hash_teachers, axis=1)
 
         teachers_df.to_sql('teachers', engine, if_exists='append', index=False, method=insert_on_conflict_do_nothing)
+
+        # Teachers are yearly, so every quarter of that year shows them on /home
+        PgConn().refresh_dashboard_summaries(year)
     # except Exception as e:
     #     print(e)
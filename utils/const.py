@@ -43,4 +43,23 @@ all_exam_methods = {
 
 SUPERADMIN_ROLE = "Superadmin"
 ADMIN_ROLE = "Admin"
-USER_ROLE = "User"
\ No newline at end of file
+USER_ROLE = "User"
+
+# Normalized score columns of um_student_scores and the um_rate subjects they are computed from,
+# the first subject the student actually took wins (e.g. math is math_5&6 or math_7)
+score_subjects = {
+    "math": ["math_5&6", "math_7"],
+    "mother_tongue_literature": ["mother_tongue_literature_7", "mother_tongue_literature_8&10&11"],
+    "literature": ["literature_5&6"],
+    "mother_tongue": ["mother_tongue_5&6"],
+    "russian": ["russian-qaraqalpaq_5&6"],
+    "chemistry": ["chemistry_8"],
+    "biology": ["biology_7"],
+    "english": ["english_9&10&11"],
+    "physics": ["physics_9"],
+    "algebra": ["algebra_8&9&10&11"],
+    "geometry": ["geometry_8&9&10&11"],
+}
+
+# Points stored per subject in um_student_exams.results and um_school_results.results
+point_types = ("knowing_point", "applying_point", "reviewing_point", "all_point")
@@ -0,0 +1,65 @@
+""" This module reads Excel sheets row by row (openpyxl read-only mode), so an import never holds a whole sheet in memory"""
+
+from itertools import islice
+
+import pandas as pd
+from openpyxl import load_workbook
+
+
+def sheet_rows(filename):
+    """Yield the non-empty rows of the first sheet as tuples of cell values"""
+    workbook = load_workbook(filename, read_only=True, data_only=True)
+    try:
+        for row in workbook.worksheets[0].iter_rows(values_only=True):
+            if any(value is not None for value in row):
+                yield row
+    finally:
+        workbook.close()
+
+
+def sheet_row_count(filename):
+    """Row count of the first sheet as stored in the file (its dimension), None when not recorded"""
+    workbook = load_workbook(filename, read_only=True)
+    try:
+        return workbook.worksheets[0].max_row
+    finally:
+        workbook.close()
+
+
+def header_columns(header):
+    """Column names as pd.read_excel gives them, a cell without a header becomes 'Unnamed: <index>'"""
+    header = list(header)
+    while header and header[-1] is None:
+        header.pop()
+    return [value if value is not None else f'Unnamed: {index}' for index, value in enumerate(header)]
+
+
+def to_frame(rows, columns):
+    width = len(columns)
+    return pd.DataFrame([tuple(row[:width]) + (None,) * (width - len(row)) for row in rows], columns=columns)
+
+
+def row_hashes(rows):
+    """64-bit content hash of every row, taken on the raw cell values so it does not depend on the
+    dtypes pandas infers for one chunk"""
+    return pd.util.hash_pandas_object(pd.DataFrame(rows, dtype=object), index=False).to_numpy().view('int64')
+
+
+def iter_chunks(rows, columns, chunk_rows, hash_column=None):
+    """DataFrames of at most `chunk_rows` rows taken from the `rows` iterator, with the row_hashes
+    in `hash_column` if given"""
+    while True:
+        chunk = list(islice(rows, chunk_rows))
+        if not chunk:
+            return
+        frame = to_frame(chunk, columns)
+        if hash_column:
+            frame[hash_column] = row_hashes(chunk)
+        yield frame
+
+
+def read_sheet(filename):
+    """The whole first sheet as one DataFrame, for small sheets"""
+    rows = sheet_rows(filename)
+    columns = header_columns(next(rows))
+    return to_frame(rows, columns)
@@ -0,0 +1,61 @@
+""" This module writes the rows of a report export as CSV or XLSX while they are streamed from the database"""
+
+import asyncio
+import csv
+import io
+import tempfile
+
+from openpyxl import Workbook
+
+from utils.const import table_headers
+
+MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+# Bytes of the finished XLSX file sent per chunk
+XLSX_CHUNK_BYTES = 64 * 1024
+
+
+def header_row(columns):
+    """Column titles as the report tables show them, without their line breaks"""
+    return [table_headers.get(column, column).replace("-<br>", "").replace("<br>", " ") for column in columns]
+
+
+async def csv_stream(batches):
+    """CSV text of every batch as soon as it is fetched, the header first. The BOM makes Excel read it as UTF-8"""
+    header = False
+    async for columns, rows in batches:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if not header:
+            buffer.write("\ufeff")
+            writer.writerow(header_row(columns))
+            header = True
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
+def _append_rows(sheet, rows):
+    for row in rows:
+        sheet.append(row)
+
+
+async def xlsx_stream(batches, title):
+    """XLSX file of the batches. A write-only workbook keeps every appended row in a temporary file
+    instead of memory, the zipped file is only complete at the end and is then sent in chunks"""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    header = False
+    async for columns, rows in batches:
+        if not header:
+            sheet.append(header_row(columns))
+            header = True
+        await asyncio.to_thread(_append_rows, sheet, rows)
+
+    with tempfile.TemporaryFile() as file:
+        await asyncio.to_thread(workbook.save, file)
+        file.seek(0)
+        while chunk := await asyncio.to_thread(file.read, XLSX_CHUNK_BYTES):
+            yield chunk
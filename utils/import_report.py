@@ -0,0 +1,63 @@
+""" This module times the stages of an Excel import and records the memory the process holds after them"""
+
+import time
+from contextlib import contextmanager
+
+import psutil
+
+
+def _rss_mb():
+    return psutil.Process().memory_info().rss / (1024 * 1024)
+
+
+class ImportReport:
+    """Wall time of every stage of one import (summed over the chunks) and the largest resident
+    memory seen at the end of the stage. `on_progress` is called with the current stage and row
+    counts whenever they change (the background worker stores them on the import job)."""
+    def __init__(self, label, on_progress=None):
+        self.label = label
+        self.stages = {}
+        self.error = None
+        self.seconds = None
+        self.progress = {"stage": None, "rows_total": None, "rows_parsed": 0, "rows_loaded": 0}
+        self._on_progress = on_progress
+        self._started = time.perf_counter()
+
+    def update_progress(self, **progress):
+        if all(self.progress.get(key) == value for key, value in progress.items()):
+            return
+        self.progress.update(progress)
+        if self._on_progress is not None:
+            self._on_progress(dict(self.progress))
+
+    @contextmanager
+    def stage(self, name):
+        self.update_progress(stage=name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "max_rss_mb": 0.0})
+            stage["seconds"] += time.perf_counter() - started
+            stage["calls"] += 1
+            stage["max_rss_mb"] = max(stage["max_rss_mb"], _rss_mb())
+
+    def finish(self, error=None):
+        self.seconds = time.perf_counter() - self._started
+        self.error = error
+        return self
+
+    def as_dict(self):
+        return {
+            "seconds": round(self.seconds, 3) if self.seconds is not None else None,
+            "error": self.error,
+            "stages": {name: {**stage, "seconds": round(stage["seconds"], 3), "max_rss_mb": round(stage["max_rss_mb"], 1)}
+                       for name, stage in self.stages.items()},
+        }
+
+    def format(self):
+        status = f"FAILED: {self.error}" if self.error else "ok"
+        lines = [f"{self.label}: {self.seconds:.2f}s, {status}"]
+        for name, stage in self.stages.items():
+            lines.append(f"  {name:<20} {stage['seconds']:>9.2f}s  x{stage['calls']:<6} rss {stage['max_rss_mb']:>8.1f} MB")
+        return "\n".join(lines)
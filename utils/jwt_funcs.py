@@ -1,8 +1,9 @@
-# from fastapi import FastAPI, HTTPException, Depends
+from fastapi import HTTPException, Request, Depends
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from typing import Optional
 from config.config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from utils.const import ADMIN_ROLE, SUPERADMIN_ROLE
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -19,4 +20,22 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 def parse_token(token: str):
     payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     return payload
-        
\ No newline at end of file
+        
+
+def jwt_checker(request: Request):
+    # Extract the token from cookies
+    token = request.cookies.get("access_token")
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    try:
+        # Decode the token
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        return payload  # Return the payload for use in protected routes
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+
+def admin_checker(payload: dict = Depends(jwt_checker)):
+    # Tokens issued before the role was added to them have to log in again
+    if payload.get("role") not in (ADMIN_ROLE, SUPERADMIN_ROLE):
+        raise HTTPException(status_code=403, detail="Admin role required")
+    return payload